@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+Load generator for "usb.py bootstrap-server".
+
+Writes a synthetic USB kit (a shared conveyed information and owner
+certificate, a random ownership voucher per device), starts the bootstrap
+server on it in a subprocess and has many concurrent devices request their
+bootstrapping data, and optionally report their progress, over keep-alive
+connections. The load is generated by -P processes, one per CPU by
+default, so the client is not the bottleneck. Throughput and latency
+percentiles are written as JSON so runs can be compared across releases.
+
+usage: python3 benchmarks/bootstrap_server.py [-d DEVICES] [-c CONNECTIONS]
+                                              [-n REQUESTS] [-P PROCESSES]
+                                              [-r] [-nk] [-o OUTPUT]
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ztp.const import Constants  # noqa: E402
+from ztp.server import raiseFileLimit  # noqa: E402
+
+FORMAT_VERSION = 1
+_OPERATIONS = '/restconf/operations/ietf-sztp-bootstrap-server:'
+_REPORT = json.dumps({'ietf-sztp-bootstrap-server:input': {
+    'progress-type': 'bootstrap-complete',
+    'message': 'benchmark'}}).encode()
+
+
+def writeKit(outDir, devices, ciSize):
+    """
+    : return : serial numbers of the devices of the kit
+    """
+    ci = os.urandom(ciSize * 1024)
+    oc = os.urandom(2 * 1024)
+    serials = ['BENCH{:05d}'.format(i) for i in range(devices)]
+    for serialNum in serials:
+        bsdDir = os.path.join(outDir, Constants.EN_DIR, serialNum,
+                              Constants.BSD_DIR)
+        os.makedirs(bsdDir)
+        # The server sends the artifacts as they are, their content is
+        # not parsed
+        for fileName, data in ((Constants.CI_FILE, ci),
+                               (Constants.OC_FILE, oc),
+                               (Constants.OV_FILE, os.urandom(3 * 1024))):
+            with open(os.path.join(bsdDir, fileName), 'wb') as f:
+                f.write(data)
+
+    return serials
+
+
+def _freePort():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def startServer(outDir, port):
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'usb.py'), 'bootstrap-server',
+         '-o', outDir, '-a', '127.0.0.1', '-p', str(port)],
+        stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            sys.exit('The bootstrap server exited with {}'.format(
+                server.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.kill()
+    sys.exit('The bootstrap server did not start')
+
+
+def _request(target, serialNum, body=b''):
+    credentials = base64.b64encode('{}:bench'.format(serialNum).encode())
+    head = ('POST {}{} HTTP/1.1\r\n'
+            'Host: bench\r\n'
+            'Authorization: Basic {}\r\n'
+            'Content-Type: application/yang-data+json\r\n'
+            'Content-Length: {}\r\n\r\n').format(_OPERATIONS, target,
+                                                 credentials.decode(),
+                                                 len(body))
+    return head.encode() + body
+
+
+async def _response(reader):
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    length = 0
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    if length:
+        await reader.readexactly(length)
+
+    return int(lines[0].split(' ', 2)[1])
+
+
+async def _device(port, requests, report, keepAlive, latencies, errors):
+    """
+    A connection requesting the bootstrapping data of the serial numbers
+    of requests in turn
+    """
+    connection = None
+    for serialNum in requests:
+        for target, body, expected in (
+                ('get-bootstrapping-data', b'', 200),
+                ('report-progress', _REPORT, 204))[:2 if report else 1]:
+            start = time.perf_counter()
+            try:
+                if connection is None:
+                    connection = await asyncio.open_connection('127.0.0.1',
+                                                               port)
+                reader, writer = connection
+                writer.write(_request(target, serialNum, body))
+                status = await _response(reader)
+            except (OSError, asyncio.IncompleteReadError) as e:
+                errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                connection = None
+                continue
+            latencies[target].append(time.perf_counter() - start)
+            if status != expected:
+                errors[str(status)] = errors.get(str(status), 0) + 1
+            if not keepAlive:
+                connection[1].close()
+                connection = None
+    if connection is not None:
+        connection[1].close()
+
+
+def generateLoad(port, serials, connections, report, keepAlive):
+    """
+    Runs in a load generator process
+    : param serials : serial numbers to request, in order
+    : return : ({request: [latencies]}, {error: count}, seconds)
+    """
+    raiseFileLimit()
+    latencies = {'get-bootstrapping-data': list(), 'report-progress': list()}
+    errors = dict()
+
+    async def run():
+        await asyncio.gather(*(
+            _device(port, serials[i::connections], report, keepAlive,
+                    latencies, errors) for i in range(connections)))
+
+    start = time.perf_counter()
+    asyncio.run(run())
+
+    return latencies, errors, time.perf_counter() - start
+
+
+def _percentiles(samples):
+    if not samples:
+        return None
+    samples = sorted(samples)
+
+    def at(p):
+        return samples[min(len(samples) - 1, int(p * len(samples)))] * 1e3
+
+    return {
+        'requests': len(samples),
+        'mean_ms': statistics.mean(samples) * 1e3,
+        'p50_ms': at(0.50),
+        'p90_ms': at(0.90),
+        'p99_ms': at(0.99),
+        'max_ms': samples[-1] * 1e3,
+    }
+
+
+def _revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                              check=True, capture_output=True,
+                              text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Bootstrap server load generator')
+    parser.add_argument('-d', '--devices', dest='devices', type=int,
+                        default=1000,
+                        help='Number of devices in the kit. Default: 1000')
+    parser.add_argument('-cs', '--ci-size', dest='ciSize', type=int,
+                        default=8,
+                        help='Size in KiB of the conveyed information. Default: 8')
+    parser.add_argument('-c', '--connections', dest='connections', type=int,
+                        default=1000,
+                        help='Concurrent connections. Default: 1000')
+    parser.add_argument('-n', '--requests', dest='requests', type=int,
+                        default=20000,
+                        help='get-bootstrapping-data requests. Default: 20000')
+    parser.add_argument('-P', '--processes', dest='processes', type=int,
+                        default=os.cpu_count() or 1,
+                        help='Load generator processes, sharing the connections. Default: number of CPUs')
+    parser.add_argument('-r', '--report', dest='report', action='store_true',
+                        help='Follow each get-bootstrapping-data with a report-progress')
+    parser.add_argument('-nk', '--no-keep-alive', dest='keepAlive',
+                        action='store_false',
+                        help='Open a connection per request')
+    parser.add_argument('-w', '--work-dir', dest='workDir',
+                        help='Directory for the synthetic kit. Default: a temporary directory')
+    parser.add_argument('-o', '--output', dest='output',
+                        help='Write the JSON results to OUTPUT instead of stdout')
+    options = parser.parse_args()
+    if min(options.devices, options.ciSize, options.connections,
+           options.requests, options.processes) < 1:
+        parser.error('sizes and counts must be at least 1')
+    options.processes = min(options.processes, options.connections)
+
+    raiseFileLimit()
+    workDir = tempfile.mkdtemp(prefix='sztp-bench-', dir=options.workDir)
+    server = None
+    try:
+        serials = writeKit(workDir, options.devices, options.ciSize)
+        port = _freePort()
+        server = startServer(workDir, port)
+
+        requests = [serials[i % len(serials)]
+                    for i in range(options.requests)]
+        share = options.connections // options.processes
+        with ProcessPoolExecutor(max_workers=options.processes) as executor:
+            start = time.perf_counter()
+            runs = list(executor.map(
+                generateLoad, [port] * options.processes,
+                [requests[i::options.processes]
+                 for i in range(options.processes)],
+                [share + (i < options.connections % options.processes)
+                 for i in range(options.processes)],
+                [options.report] * options.processes,
+                [options.keepAlive] * options.processes))
+            seconds = time.perf_counter() - start
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(workDir)
+
+    latencies = dict()
+    errors = dict()
+    for runLatencies, runErrors, _ in runs:
+        for target, samples in runLatencies.items():
+            latencies.setdefault(target, list()).extend(samples)
+        for error, count in runErrors.items():
+            errors[error] = errors.get(error, 0) + count
+    total = sum(len(samples) for samples in latencies.values())
+
+    results = {
+        'format': FORMAT_VERSION,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'revision': _revision(),
+        'host': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'parameters': {
+            'devices': options.devices,
+            'ci_kib': options.ciSize,
+            'connections': options.connections,
+            'requests': options.requests,
+            'processes': options.processes,
+            'report': options.report,
+            'keep_alive': options.keepAlive,
+        },
+        'seconds': seconds,
+        'requests_per_s': total / seconds,
+        'errors': errors,
+        'latency': {target: _percentiles(samples)
+                    for target, samples in latencies.items() if samples},
+    }
+
+    print('{} requests in {:.2f} s, {:.0f} requests/s, {} errors'.format(
+        total, seconds, total / seconds, sum(errors.values())),
+        file=sys.stderr)
+    for target, latency in results['latency'].items():
+        print('{:<24} p50 {:7.2f} ms  p90 {:7.2f} ms  p99 {:7.2f} ms  '
+              'max {:7.2f} ms'.format(target, latency['p50_ms'],
+                                      latency['p90_ms'], latency['p99_ms'],
+                                      latency['max_ms']), file=sys.stderr)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
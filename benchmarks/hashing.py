@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the image hashing path.
+
+Compares the previous util.genHash (64 KiB f.read chunks) with the
+mmap path of util.genHash and the readinto path of util.copyAndHash, for
+several buffer sizes.
+The file is read once before timing, so the numbers are the throughput
+from the page cache, i.e. the cost of the hashing loop itself.
+
+usage: python3 benchmarks/hashing.py [-f FILE] [-s SIZE_MIB] [-r REPEAT]
+"""
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ztp import util  # noqa: E402
+
+MIB = 1024 * 1024
+
+
+def legacyGenHash(fileName, hashAlg=hashlib.sha256):
+    # util.genHash before it hashed through mmap
+    sha = hashAlg()
+    with open(fileName, 'rb') as f:
+        while True:
+            data = f.read(65536)
+            if not data:
+                break
+
+            sha.update(data)
+    return util.toHexString(sha.hexdigest())
+
+
+def timeIt(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Image hashing micro-benchmark')
+    parser.add_argument('-f', '--file', dest='fileName',
+                        help='File to hash. Default: a random temporary file')
+    parser.add_argument('-s', '--size', dest='size', type=int, default=512,
+                        help='Size in MiB of the temporary file. Default: 512')
+    parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=3,
+                        help='Runs per case, the best one is reported. Default: 3')
+    options = parser.parse_args()
+
+    tmp = None
+    fileName = options.fileName
+    if fileName is None:
+        tmp = tempfile.NamedTemporaryFile(prefix='sztp-bench-', delete=False)
+        with tmp:
+            for _ in range(options.size):
+                tmp.write(os.urandom(MIB))
+        fileName = tmp.name
+
+    try:
+        size = os.path.getsize(fileName)
+        legacyGenHash(fileName)  # warm the page cache
+
+        cases = [('f.read 64 KiB (previous)', lambda: legacyGenHash(fileName))]
+        for bufSize in (64 * 1024, MIB, 8 * MIB, 32 * MIB):
+            label = '{} KiB'.format(bufSize // 1024) if bufSize < MIB \
+                else '{} MiB'.format(bufSize // MIB)
+            cases.append(('genHash mmap ' + label,
+                          lambda b=bufSize: util.genHash(fileName, bufSize=b)))
+            cases.append(('copyAndHash readinto ' + label,
+                          lambda b=bufSize: util.copyAndHash(
+                              fileName, None, [hashlib.sha256], bufSize=b)[0]))
+
+        print('{} ({:.0f} MiB), sha-256, best of {}'.format(
+            fileName, size / MIB, options.repeat))
+        baseline = None
+        expected = None
+        for label, func in cases:
+            elapsed, digest = timeIt(func, options.repeat)
+            if expected is None:
+                expected = digest
+            elif digest != expected:
+                sys.exit('{}: digest mismatch'.format(label))
+            baseline = baseline or elapsed
+            print('  {:<32} {:6.2f} GB/s  x{:.2f}'.format(
+                label, size / elapsed / 1e9, baseline / elapsed))
+    finally:
+        if tmp:
+            os.unlink(tmp.name)
+
+
+if __name__ == '__main__':
+    main()
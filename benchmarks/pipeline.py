@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of the bootstrapping data pipeline.
+
+Generates synthetic inputs in a temporary directory (random ISOs, fake
+ownership vouchers, a throwaway self-signed owner certificate and key,
+configuration and scripts) and times each stage of the pipeline
+separately. The results are written as JSON so runs can be compared
+across releases.
+
+usage: python3 benchmarks/pipeline.py [-s ISO_MIB] [-i IMAGES] [-d DEVICES]
+                                      [-r REPEAT] [-o OUTPUT]
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import usb  # noqa: E402
+from ztp import model, util  # noqa: E402
+from ztp.const import Constants  # noqa: E402
+from ztp._cms import _NativeCMS, getCMSBackend  # noqa: E402
+from ztp.crypto import CMS, PKCS7, X509  # noqa: E402
+
+MIB = 1024 * 1024
+FORMAT_VERSION = 1
+
+
+class _Counter:
+    """
+    Binary file object counting the bytes written to it
+    """
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+
+class Inputs:
+    """
+    Synthetic inputs of a benchmark run, created under workDir
+    """
+    def __init__(self, workDir, isoSize, images, devices):
+        self.workDir = workDir
+        self.ownerCert = os.path.join(workDir, 'owner.cert')
+        self.ownerKey = os.path.join(workDir, 'owner.key')
+        self._createOwnerCertificate()
+
+        self.config = self._writeFile('configs.cfg',
+                                      b'hostname bench\n' * 64)
+        self.preConfig = self._writeFile('pre_config_script.py',
+                                         b'print("pre config")\n')
+        self.postConfig = self._writeFile('post_config_script.py',
+                                          b'print("post config")\n')
+
+        self.images = list()
+        for i in range(images):
+            path = os.path.join(workDir, 'image{}.iso'.format(i))
+            with open(path, 'wb') as f:
+                for _ in range(isoSize):
+                    f.write(os.urandom(MIB))
+            self.images.append(path)
+        self.imageBytes = sum(os.path.getsize(i) for i in self.images)
+
+        self.voucherDir = os.path.join(workDir, 'vouchers')
+        os.makedirs(self.voucherDir)
+        for i in range(devices):
+            # The tool copies vouchers as they are, their content is not
+            # parsed
+            self._writeFile(os.path.join('vouchers', 'BENCH{:05d}.vcj'.format(i)),
+                            os.urandom(3 * 1024))
+
+    def _writeFile(self, name, content):
+        path = os.path.join(self.workDir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def _createOwnerCertificate(self):
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                        '-nodes', '-days', '2', '-subj', '/CN=sztp-bench-owner',
+                        '-addext', 'keyUsage=critical,digitalSignature',
+                        '-keyout', self.ownerKey, '-out', self.ownerCert],
+                       check=True, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+
+    def imagePaths(self):
+        return {
+            'src': list(self.images),
+            'dest': ['images/' + os.path.basename(i) for i in self.images]
+        }
+
+    def certificates(self):
+        certs = util.AttrDict()
+        certs.ownerPrivateKey = self.ownerKey
+        certs.ownerCert = self.ownerCert
+        return certs
+
+    def usbData(self, outDir, hashAlg, jobs):
+        data = util.AttrDict()
+        data.preConfig = self.preConfig
+        data.postConfig = self.postConfig
+        data.config = self.config
+        data.configHandle = 'merge'
+        data.imageUrl = self.imagePaths()
+        data.hashAlg = hashAlg
+        data.osName = 'Cisco IOSXR'
+        data.osVersion = '7.11.1'
+        data.oc = self.ownerCert
+        data.ocChain = None
+        data.outDir = outDir
+        data.bootable = False
+        data.copyImage = False
+        data.imgRelPath = None
+        data.bootFile = None
+        data.genActions = False
+        data.deviceCertDir = None
+        data.jobs = jobs
+        data.force = True
+        data.digestCache = None
+        data.signedCache = None
+        data.devices = usb.Devices.fromDir(self.voucherDir)
+        return data
+
+
+class Stage:
+    """
+    Timings of one stage over all the repetitions
+    """
+    def __init__(self, name, size=None):
+        self.name = name
+        self.size = size
+        self.samples = list()
+
+    def run(self, func):
+        # Progress messages of the tool are not part of the results
+        with redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = func()
+            self.samples.append(time.perf_counter() - start)
+        return result
+
+    def serialize(self):
+        d = {
+            'samples': self.samples,
+            'min': min(self.samples),
+            'median': statistics.median(self.samples),
+            'mean': statistics.mean(self.samples),
+        }
+        if self.size is not None:
+            d['bytes'] = self.size
+            d['gb_per_s'] = self.size / d['min'] / 1e9
+        return d
+
+
+def _revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                              check=True, capture_output=True,
+                              text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(inputs, options):
+    stages = dict()
+
+    def stage(name, size=None):
+        return stages.setdefault(name, Stage(name, size))
+
+    certs = inputs.certificates()
+    rootDirs = Constants.ROOT_DIRS
+    for i in range(options.repeat):
+        runDir = os.path.join(inputs.workDir, 'run{}'.format(i))
+        os.makedirs(runDir)
+
+        # The certificate is parsed and checked once per process
+        X509._checked.clear()
+        stage('validate_oc').run(
+            lambda: usb.Validate.oc(inputs.ownerCert, inputs.ownerKey))
+
+        image = stage('image_hash', inputs.imageBytes).run(
+            lambda: model.Image(osName='Cisco IOSXR', osVersion='7.11.1',
+                                paths=inputs.imagePaths(),
+                                hashAlg=options.hashAlg, rootPath=rootDirs))
+        stage('image_copy', inputs.imageBytes).run(
+            lambda: model.Image(osName='Cisco IOSXR', osVersion='7.11.1',
+                                paths=inputs.imagePaths(),
+                                hashAlg=options.hashAlg, rootPath=rootDirs,
+                                copyDir=os.path.join(runDir, 'copy')))
+
+        oi = model.OnboardingInformation(bootImage=image,
+                                         configHandle='merge',
+                                         preConfigScript=inputs.preConfig,
+                                         configFile=inputs.config,
+                                         postConfigScript=inputs.postConfig,
+                                         config=inputs.config)
+        counter = _Counter()
+        stage('oi_encode').run(lambda: oi.write(counter))
+        stage('oi_encode').size = counter.size
+
+        pd = model.ProvisioningData(configHandle='merge',
+                                    preConfigScript=inputs.preConfig,
+                                    configuration=inputs.config,
+                                    postConfigScript=inputs.postConfig,
+                                    osName='Cisco IOSXR',
+                                    osVersion='7.11.1',
+                                    imagePath=inputs.imagePaths(),
+                                    hashAlg=options.hashAlg,
+                                    usbRootDirs=rootDirs,
+                                    imageDigests={
+                                        src: digests for src, digests in zip(
+                                            inputs.images, image.imgHash)
+                                    })
+        bsd = model.BootstrapData(pd=pd, oc=inputs.ownerCert,
+                                  certificates=certs)
+        stage('cms_encode').run(lambda: bsd._cmsEncode(bsd.oi.write))
+        # Building bsd already made the owner certificate PKCS#7, which is
+        # cached per process
+        PKCS7._degenerate.clear()
+        stage('prepare_oc').run(bsd._prepareOC)
+
+        data = inputs.usbData(os.path.join(runDir, 'usb'), options.hashAlg,
+                              options.jobs)
+        device = usb.USB(data=data, certificates=certs)
+        stage('usb_create').run(device.create)
+        results = stage('usb_save').run(device.save)
+        failed = [serial for serial, error in results if error]
+        if failed:
+            sys.exit('Failed to generate bootstrapping data for {}'.format(
+                ', '.join(failed)))
+
+        if not options.keep:
+            shutil.rmtree(runDir)
+
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Bootstrapping data pipeline benchmark')
+    parser.add_argument('-s', '--iso-size', dest='isoSize', type=int,
+                        default=256,
+                        help='Size in MiB of each synthetic ISO. Default: 256')
+    parser.add_argument('-i', '--images', dest='images', type=int, default=1,
+                        help='Number of ISOs. Default: 1')
+    parser.add_argument('-d', '--devices', dest='devices', type=int,
+                        default=16,
+                        help='Number of devices (ownership vouchers). Default: 16')
+    parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=3,
+                        help='Runs of each stage. Default: 3')
+    parser.add_argument('-ia', '--image-hash-alg', dest='hashAlg',
+                        default='sha-256',
+                        help='Image hash algorithm(s). Default: sha-256')
+    parser.add_argument('-cb', '--crypto-backend', dest='cryptoBackend',
+                        choices=['native', 'openssl'],
+                        help='CMS implementation. Default: native when available')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='Writer threads of the usb_save stage. Default: 1')
+    parser.add_argument('-w', '--work-dir', dest='workDir',
+                        help='Directory for the synthetic inputs. Default: a temporary directory')
+    parser.add_argument('-k', '--keep', dest='keep', action='store_true',
+                        help='Keep the inputs and outputs of the runs')
+    parser.add_argument('-o', '--output', dest='output',
+                        help='Write the JSON results to OUTPUT instead of stdout')
+    options = parser.parse_args()
+    if min(options.isoSize, options.images, options.devices,
+           options.repeat, options.jobs) < 1:
+        parser.error('sizes and counts must be at least 1')
+
+    CMS.backend = options.cryptoBackend
+    workDir = tempfile.mkdtemp(prefix='sztp-bench-', dir=options.workDir)
+    try:
+        inputs = Inputs(workDir, options.isoSize, options.images,
+                        options.devices)
+        stages = benchmark(inputs, options)
+    finally:
+        if not options.keep:
+            shutil.rmtree(workDir)
+
+    results = {
+        'format': FORMAT_VERSION,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'revision': _revision(),
+        'host': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'crypto_backend': options.cryptoBackend or (
+                'native' if isinstance(getCMSBackend(), _NativeCMS)
+                else 'openssl'),
+        },
+        'parameters': {
+            'iso_mib': options.isoSize,
+            'images': options.images,
+            'devices': options.devices,
+            'repeat': options.repeat,
+            'hash_alg': options.hashAlg,
+            'jobs': options.jobs,
+        },
+        'stages': {name: s.serialize() for name, s in stages.items()},
+    }
+
+    for name, s in stages.items():
+        print('{:<12} {:9.4f} s{}'.format(
+            name, min(s.samples),
+            '  {:6.2f} GB/s'.format(s.size / min(s.samples) / 1e9)
+            if s.size else ''), file=sys.stderr)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
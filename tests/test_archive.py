@@ -0,0 +1,91 @@
+"""
+Extraction of the bootable zip: members are extracted and hashed on the
+fly, and a member whose name would escape the output directory (zip slip)
+is refused.
+"""
+import hashlib
+import os
+import sys
+import zipfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ztp import archive, util  # noqa: E402
+from ztp.exceptions import Error  # noqa: E402
+
+
+def _zip(path, members):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, data in members.items():
+            zf.writestr(name, data)
+
+    return path
+
+
+@pytest.mark.parametrize('name', [
+    '../evil',
+    'boot/../../evil',
+    '..\\evil',
+    'boot\\..\\..\\evil',
+    '/etc/evil',
+])
+def test_target_refuses_escaping_names(tmp_path, name):
+    with pytest.raises(Error):
+        archive._target(str(tmp_path), name)
+
+
+@pytest.mark.parametrize('name, parts', [
+    ('boot/install-image.iso', ['boot', 'install-image.iso']),
+    ('./boot//install-image.iso', ['boot', 'install-image.iso']),
+    ('boot\\efi\\grub.cfg', ['boot', 'efi', 'grub.cfg']),
+    ('boot/..data', ['boot', '..data']),
+])
+def test_target(tmp_path, name, parts):
+    assert archive._target(str(tmp_path), name) == os.path.join(
+        str(tmp_path), *parts)
+
+
+def test_extract_refuses_zip_slip(tmp_path):
+    outDir = tmp_path / 'usb'
+    zipPath = _zip(str(tmp_path / 'boot.zip'), {
+        'boot/install-image.iso': b'image',
+        '../evil': b'evil',
+    })
+
+    with pytest.raises(Error):
+        archive.extract(zipPath, str(outDir), jobs=2)
+    assert not (tmp_path / 'evil').exists()
+
+
+def test_extract_hashes_members(tmp_path):
+    outDir = tmp_path / 'usb'
+    members = {
+        'boot/install-image.iso': os.urandom(256 * 1024),
+        'boot/efi/grub.cfg': b'menuentry',
+        'README': b'',
+    }
+    zipPath = _zip(str(tmp_path / 'boot.zip'), members)
+
+    digests = archive.extract(
+        zipPath, str(outDir),
+        hashes={'boot/install-image.iso': [hashlib.sha256, hashlib.sha384]},
+        jobs=2)
+
+    image = members['boot/install-image.iso']
+    assert digests == {'boot/install-image.iso': [
+        util.toHexString(hashlib.sha256(image).hexdigest()),
+        util.toHexString(hashlib.sha384(image).hexdigest()),
+    ]}
+    for name, data in members.items():
+        assert (outDir / name).read_bytes() == data
+
+
+def test_extract_refuses_other_files(tmp_path):
+    notZip = tmp_path / 'boot.zip'
+    notZip.write_bytes(b'not a zip')
+
+    with pytest.raises(Error):
+        archive.extract(str(notZip), str(tmp_path / 'usb'))
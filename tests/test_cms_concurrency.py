@@ -0,0 +1,81 @@
+"""
+Stress test of concurrent CMS operations: each openssl call works in its
+own scratch directory, so round trips running at the same time on a
+thread pool must never get each other's data.
+"""
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ztp import util  # noqa: E402
+from ztp._cms import getCMSBackend  # noqa: E402
+from ztp.crypto import CMS  # noqa: E402
+from ztp.exceptions import Error  # noqa: E402
+
+ROUND_TRIPS = 64
+THREADS = 16
+
+
+def _backend(name):
+    try:
+        getCMSBackend(name)
+    except Error:
+        pytest.skip('The {} CMS backend is not available'.format(name))
+
+    return name
+
+
+@pytest.fixture(params=['openssl', 'native'])
+def backend(request):
+    previous = CMS.backend
+    CMS.backend = _backend(request.param)
+    yield request.param
+    CMS.backend = previous
+
+
+@pytest.fixture
+def certificates():
+    certs = util.AttrDict()
+    certs.ownerCert = os.path.join(ROOT, 'certificates', 'owner.cert')
+    certs.ownerPrivateKey = os.path.join(ROOT, 'certificates', 'owner.key')
+    return certs
+
+
+def _roundTrip(certificates, i):
+    # Payloads differ in content and size, so a mix-up cannot go unnoticed
+    data = 'round trip {}\n'.format(i).encode() * (i + 1)
+    signed = CMS(data, certificates).sign(outform=CMS.DER_ENCODING).data
+    content = CMS(signed, certificates).verify(
+        inform=CMS.DER_ENCODING).data
+
+    return data, content
+
+
+def test_concurrent_sign_verify(backend, certificates):
+    with ThreadPoolExecutor(max_workers=THREADS) as executor:
+        results = list(executor.map(lambda i: _roundTrip(certificates, i),
+                                     range(ROUND_TRIPS)))
+
+    for i, (data, content) in enumerate(results):
+        assert content == data, 'round trip {} got another payload'.format(i)
+
+
+def test_concurrent_sign_streamed(backend, certificates):
+    # The callable input is streamed into the scratch file of its own call
+    def sign(i):
+        data = 'streamed {}\n'.format(i).encode() * (i + 1)
+        signed = CMS(lambda f: f.write(data), certificates).sign(
+            outform=CMS.DER_ENCODING).data
+        return data, CMS(signed, certificates).verify(
+            inform=CMS.DER_ENCODING).data
+
+    with ThreadPoolExecutor(max_workers=THREADS) as executor:
+        results = list(executor.map(sign, range(ROUND_TRIPS)))
+
+    for data, content in results:
+        assert content == data
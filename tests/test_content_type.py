@@ -0,0 +1,102 @@
+"""
+The CMS content type is read from the ContentInfo header in-process, and
+only BER with indefinite lengths, which the DER reader does not decode,
+falls back to openssl cms -print.
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ztp._cms import CMSType, _ContentType, _DER, _Unsupported  # noqa: E402
+from ztp.exceptions import Error  # noqa: E402
+
+OWNER_CERT = os.path.join(ROOT, 'certificates', 'owner.cert')
+OWNER_KEY = os.path.join(ROOT, 'certificates', 'owner.key')
+
+DATA = '1.2.840.113549.1.7.1'
+SIGNED_DATA = '1.2.840.113549.1.7.2'
+ENVELOPED_DATA = '1.2.840.113549.1.7.3'
+
+
+def _openssl(tmpDir, name, *args):
+    content = os.path.join(tmpDir, 'content')
+    with open(content, 'wb') as f:
+        f.write(b'content type test\n')
+    out = os.path.join(tmpDir, name)
+    subprocess.run(['openssl', 'cms', '-in', content, '-binary',
+                    '-out', out] + list(args),
+                   check=True, capture_output=True)
+    with open(out, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture(scope='module')
+def samples(tmp_path_factory):
+    tmpDir = str(tmp_path_factory.mktemp('cms'))
+    sign = ['-sign', '-nodetach', '-signer', OWNER_CERT, '-inkey', OWNER_KEY]
+    return {
+        'signed-der': _openssl(tmpDir, 'signed.der', *sign, '-outform', 'DER'),
+        'signed-pem': _openssl(tmpDir, 'signed.pem', *sign, '-outform', 'PEM'),
+        'signed-smime': _openssl(tmpDir, 'signed.smime', *sign),
+        # -stream writes BER with indefinite lengths
+        'signed-ber': _openssl(tmpDir, 'signed.ber', *sign, '-stream',
+                               '-outform', 'DER'),
+        'enveloped-der': _openssl(tmpDir, 'enveloped.der', '-encrypt',
+                                  '-aes256', '-outform', 'DER', OWNER_CERT),
+        'enveloped-ber': _openssl(tmpDir, 'enveloped.ber', '-encrypt',
+                                  '-aes256', '-stream', '-outform', 'DER',
+                                  OWNER_CERT),
+        'data-der': _openssl(tmpDir, 'data.der', '-data_create',
+                             '-outform', 'DER'),
+    }
+
+
+@pytest.mark.parametrize('name, oid, inner, cmsType', [
+    ('signed-der', SIGNED_DATA, DATA, CMSType.SIGNED),
+    ('signed-pem', SIGNED_DATA, DATA, CMSType.SIGNED),
+    ('signed-smime', SIGNED_DATA, DATA, CMSType.SIGNED),
+    ('enveloped-der', ENVELOPED_DATA, DATA, CMSType.ENCRYPTED),
+    ('data-der', DATA, None, CMSType.UNENCRYPTED),
+])
+def test_header(samples, name, oid, inner, cmsType):
+    contentType = _ContentType()
+
+    assert contentType.getContentTypeOID(samples[name]) == oid
+    assert contentType.getInnerContentTypeOID(samples[name]) == inner
+    assert contentType.getContentType(samples[name]) == cmsType
+
+
+@pytest.mark.parametrize('name, oid', [
+    ('signed-ber', SIGNED_DATA),
+    ('enveloped-ber', ENVELOPED_DATA),
+])
+def test_ber_fallback(samples, name, oid):
+    # The DER reader refuses the indefinite lengths...
+    with pytest.raises(_Unsupported):
+        _DER.read(samples[name])
+
+    # ...and openssl decodes them instead
+    contentType = _ContentType()
+    assert contentType.getContentTypeOID(samples[name]) == oid
+    assert contentType.getInnerContentTypeOID(samples[name]) == DATA
+
+
+def test_str_input(samples):
+    pem = samples['signed-pem'].decode()
+
+    assert _ContentType().getContentTypeOID(pem) == SIGNED_DATA
+
+
+@pytest.mark.parametrize('data', [
+    b'\x30\x82\x10\x00\x06\x09',
+    b'\x30\x03\x02\x01\x01',
+    b'\x04\x03abc',
+])
+def test_not_content_info(data):
+    with pytest.raises(Error):
+        _ContentType().getContentTypeOID(data)
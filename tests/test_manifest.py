@@ -0,0 +1,118 @@
+"""
+The build manifest tells which outputs and images of an output directory
+are up to date, so a later run only regenerates what changed.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ztp.manifest import BuildManifest  # noqa: E402
+
+
+@pytest.fixture
+def outDir(tmp_path):
+    path = tmp_path / 'usb'
+    path.mkdir()
+    return path
+
+
+@pytest.fixture
+def cacheDir(tmp_path):
+    return str(tmp_path / 'builds')
+
+
+def _write(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return str(path)
+
+
+def _reload(outDir, cacheDir):
+    return BuildManifest(str(outDir), directory=cacheDir)
+
+
+def test_output_is_current_across_runs(outDir, cacheDir):
+    output = _write(outDir / 'EN9' / 'SN01' / 'ci.cms', b'signed')
+    fingerprint = BuildManifest.fingerprint('ci', 'inputs')
+    manifest = _reload(outDir, cacheDir)
+    assert not manifest.isCurrent(output, fingerprint)
+
+    manifest.recordOutput(output, fingerprint)
+    manifest.save()
+
+    manifest = _reload(outDir, cacheDir)
+    assert manifest.isCurrent(output, fingerprint)
+    assert not manifest.isCurrent(output, BuildManifest.fingerprint(
+        'ci', 'other inputs'))
+
+
+def test_changed_or_missing_output_is_stale(outDir, cacheDir):
+    output = _write(outDir / 'EN9' / 'SN01' / 'ci.cms', b'signed')
+    fingerprint = BuildManifest.fingerprint('ci')
+    manifest = _reload(outDir, cacheDir)
+    manifest.recordOutput(output, fingerprint)
+    manifest.save()
+
+    # Same size, another mtime, e.g. another drive on the same path
+    st = os.stat(output)
+    _write(outDir / 'EN9' / 'SN01' / 'ci.cms', b'SIGNED')
+    os.utime(output, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert not _reload(outDir, cacheDir).isCurrent(output, fingerprint)
+
+    os.remove(output)
+    assert not _reload(outDir, cacheDir).isCurrent(output, fingerprint)
+
+
+def test_reset(outDir, cacheDir):
+    output = _write(outDir / 'ci.cms', b'signed')
+    manifest = _reload(outDir, cacheDir)
+    manifest.recordOutput(output, 'fingerprint')
+    manifest.reset()
+
+    assert not manifest.isCurrent(output, 'fingerprint')
+
+
+def test_file_digests(outDir, cacheDir, tmp_path):
+    source = _write(tmp_path / 'image.iso', b'image')
+    copy = _write(outDir / 'images' / 'image.iso', b'image')
+    manifest = _reload(outDir, cacheDir)
+    manifest.recordFile(copy, {'sha-256': 'aa', 'sha-384': 'bb'},
+                        source=source)
+    manifest.save()
+
+    manifest = _reload(outDir, cacheDir)
+    assert manifest.fileDigests(copy, ['sha-384', 'sha-256'],
+                                source=source) == ['bb', 'aa']
+    # An algorithm that was not recorded must be computed
+    assert manifest.fileDigests(copy, ['sha-512'], source=source) is None
+
+    _write(tmp_path / 'image.iso', b'new image')
+    assert manifest.fileDigests(copy, ['sha-256'], source=source) is None
+
+
+def test_changed_file_is_stale(outDir, cacheDir):
+    copy = _write(outDir / 'images' / 'image.iso', b'image')
+    manifest = _reload(outDir, cacheDir)
+    manifest.recordFile(copy, {'sha-256': 'aa'})
+
+    _write(outDir / 'images' / 'image.iso', b'changed image')
+    assert manifest.fileDigests(copy, ['sha-256']) is None
+    os.remove(copy)
+    assert manifest.fileDigests(copy, ['sha-256']) is None
+
+
+def test_kept_off_the_output_directory(outDir, cacheDir):
+    legacy = _write(outDir / '.sztp-build.json', b'{}')
+    manifest = _reload(outDir, cacheDir)
+    manifest.recordOutput(_write(outDir / 'ci.cms', b'signed'), 'fingerprint')
+    manifest.save()
+
+    assert not os.path.exists(legacy)
+    assert os.listdir(str(outDir)) == ['ci.cms']
+    assert os.path.dirname(manifest.path) == cacheDir
+    # Each output directory has its own manifest
+    assert _reload(outDir / 'EN9', cacheDir).path != manifest.path
@@ -0,0 +1,114 @@
+"""
+OnboardingInformation.write() streams the same JSON as serialize(), with
+the files it references written in place of per-call placeholders.
+"""
+import builtins
+import io
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ztp import model  # noqa: E402
+
+
+def _written(oi):
+    fp = io.BytesIO()
+    oi.write(fp)
+    return fp.getvalue()
+
+
+def _image(tmp_path):
+    return model.Image(osName='Cisco IOSXR',
+                       osVersion='7.11.1',
+                       paths={'src': [str(tmp_path / 'image.iso')],
+                              'dest': ['images/image.iso']},
+                       hashAlg='sha-256,sha-384',
+                       rootPath=['/disk2:', '/disk3:'],
+                       digests={str(tmp_path / 'image.iso'): ['aa', 'bb']})
+
+
+@pytest.fixture
+def files(tmp_path):
+    paths = dict()
+    for name, data in (('pre', b'#!/bin/sh\necho pre\n'),
+                       ('config', os.urandom(64 * 1024)),
+                       ('post', b'')):
+        path = tmp_path / name
+        path.write_bytes(data)
+        paths[name] = str(path)
+    return paths
+
+
+def test_write_matches_serialize(tmp_path, files):
+    oi = model.OnboardingInformation(bootImage=_image(tmp_path),
+                                     configHandle='replace',
+                                     preConfigScript=files['pre'],
+                                     configFile=files['config'],
+                                     postConfigScript=files['post'])
+
+    assert _written(oi) == json.dumps(oi.serialize()).encode()
+
+
+def test_write_without_files():
+    oi = model.OnboardingInformation()
+
+    written = _written(oi)
+    assert written == json.dumps(oi.serialize()).encode()
+    assert json.loads(written) == {
+        'ietf-sztp-conveyed-info:onboarding-information': {
+            'configuration-handling': 'merge',
+            'pre-configuration-script': None,
+            'configuration': None,
+            'post-configuration-script': None,
+        }
+    }
+
+
+def test_placeholder_lookalikes(tmp_path, files):
+    # Values looking like placeholders are not taken for files
+    fake = model.OnboardingInformation._FILE_PLACEHOLDER.format('0' * 32, 0)
+    (tmp_path / 'pre').write_text(fake)
+    oi = model.OnboardingInformation(configHandle=fake,
+                                     preConfigScript=files['pre'],
+                                     configFile=files['config'])
+
+    assert _written(oi) == json.dumps(oi.serialize()).encode()
+
+
+def test_placeholder_token_per_call(monkeypatch, files):
+    oi = model.OnboardingInformation(preConfigScript=files['pre'])
+    tokens = list()
+    tokenHex = model.secrets.token_hex
+
+    def recordingTokenHex(nbytes):
+        tokens.append(tokenHex(nbytes))
+        return tokens[-1]
+
+    monkeypatch.setattr(model.secrets, 'token_hex', recordingTokenHex)
+    assert _written(oi) == _written(oi)
+
+    assert len(tokens) == 2 and tokens[0] != tokens[1]
+
+
+def test_files_read_once(monkeypatch, files):
+    oi = model.OnboardingInformation(preConfigScript=files['pre'],
+                                     configFile=files['config'],
+                                     postConfigScript=files['post'])
+    opened = list()
+    realOpen = builtins.open
+
+    def recordingOpen(fileName, *args, **kwargs):
+        opened.append(fileName)
+        return realOpen(fileName, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, 'open', recordingOpen)
+    first = _written(oi)
+    assert _written(oi) == first
+    assert oi.config is not None and oi.preConfigScript is not None
+
+    assert sorted(opened) == sorted(files.values())
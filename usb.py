@@ -1,13 +1,26 @@
 # Standard
 import argparse
+import asyncio
 import os
-import shutil
+import signal
+import ssl
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # from ztp.crypto import CMS, X509
-from ztp import model, util
+from ztp import archive, model, util
+from ztp.cache import DigestCache, SignedCache
 from ztp.const import Constants
-from ztp.crypto import X509
+from ztp.crypto import CMS, X509, getCMSBackend
+from ztp.daemon import JobServer, submit
 from ztp.exceptions import Error, ErrorCode
+from ztp.manifest import BuildManifest
+from ztp.profiling import Profile
+from ztp.server import ArtifactIndex, BootstrapServer, raiseFileLimit
+from ztp.verify import KitVerifier
+from ztp.writer import ArtifactWriter
 
 InvalidOV = Exception('Invalid Ownership Voucher')
 InvalidSN = Exception('Invalid Serial Number')
@@ -22,9 +35,9 @@ class USB:
 
     def __init__(self, data, certificates) -> None:
         self.data = data
+        self.certificates = certificates
         self._validate()
         self.bsd = None
-        self.certificates = certificates
 
     def _validate(self) -> None:
         # Validate.
@@ -50,12 +63,70 @@ class USB:
         for f in files:
             Validate.filename(f)
 
-        Validate.serial(self.data.serialNum)
-        Validate.oc(self.data.oc)
+        if not self.data.devices:
+            raise Error(errorCode=ErrorCode.INVALID_DATA,
+                        error='No devices provided')
+
+        serials = set()
+        for device in self.data.devices:
+            Validate.serial(device.serialNum)
+            Validate.filename(device.ov)
+            if device.serialNum in serials:
+                raise Error(errorCode=ErrorCode.INVALID_SERIAL_NUM,
+                            error='Duplicate serial number {}'.format(
+                                device.serialNum))
+            serials.add(device.serialNum)
+            if self.data.deviceCertDir and not device.cert:
+                raise Error(errorCode=ErrorCode.INVALID_CERTIFICATE,
+                            error='No device certificate for {} in {}'.format(
+                                device.serialNum, self.data.deviceCertDir))
+        # Checked before anything gets hashed or signed
+        Validate.oc(self.data.oc, self.certificates.ownerPrivateKey)
+        for f in self.data.ocChain or []:
+            Validate.filename(f)
 
+    @Profile.timed('USB.create')
     def create(self) -> None:
-        if self.data.bootable:
-            shutil.unpack_archive(self.data.bootFile, self.data.outDir)
+        self.manifest = BuildManifest(self.data.outDir)
+        if self.data.force:
+            self.manifest.reset()
+        self.hashAlgs = model.Image.normalizeHashAlgs(self.data.hashAlg)
+        fingerprints = self._fingerprints()
+
+        # Only the artifacts whose inputs changed since the last run are
+        # generated again
+        stale = set()
+        self.upToDate = list()
+        for device in self.data.devices:
+            device.fingerprints = dict()
+            device.write = list()
+            for artifact, fingerprint in fingerprints(device).items():
+                path = _artifactPath(self.data.outDir, device.serialNum,
+                                     artifact)
+                device.fingerprints[artifact] = fingerprint
+                if not self.manifest.isCurrent(path, fingerprint):
+                    device.write.append(artifact)
+            if device.write:
+                stale.update(device.write)
+            else:
+                self.upToDate.append(device.serialNum)
+
+        self.bsd = None
+        self.encrypted = dict()
+        # The images copied or extracted to the USB are outputs too, they
+        # are written again when they were removed or changed
+        imagesOnUSB = self.data.copyImage or self.data.bootable
+        if not stale - {'ov'} and (not imagesOnUSB or
+                                   self._extractedIsCurrent()):
+            # At most some ownership vouchers changed, nothing to sign
+            return
+
+        imageDigests = self._knownImageDigests()
+        if self.data.bootable and not self._extractedIsCurrent():
+            imageDigests = self._extract()
+
+        # With --copy-image the image is hashed while it is copied to the USB
+        imageCopyDir = self.data.outDir if self.data.copyImage else None
 
         pd = model.ProvisioningData(configHandle=self.data.configHandle,
                                     preConfigScript=self.data.preConfig,
@@ -63,39 +134,204 @@ class USB:
                                     postConfigScript=self.data.postConfig,
                                     osName=self.data.osName,
                                     osVersion=self.data.osVersion,
-                                    imagePath=self.data.imageUrl,
+                                    imagePath=self.data.imageUrl
+                                    if self.data.imageUrl['src'] else None,
                                     hashAlg=self.data.hashAlg,
-                                    usbRootDirs=Constants.ROOT_DIRS)
+                                    usbRootDirs=Constants.ROOT_DIRS,
+                                    imageCopyDir=imageCopyDir,
+                                    digestCache=self.data.digestCache,
+                                    imageDigests=imageDigests)
+        self._recordImages(pd.bootImage)
+        if not stale - {'ov'}:
+            # Only the images on the USB had to be written again
+            return
+        # Everything except the ownership voucher is independent of the
+        # serial number, so it is built and signed once and shared by all
+        # the devices.
         self.bsd = model.BootstrapData(pd=pd,
                                        oc=self.data.oc,
-                                       ov=self.data.ov,
+                                       ocChain=self.data.ocChain,
                                        certificates=self.certificates,
                                        bootable=self.data.bootable,
-                                       genActions=self.data.genActions)
+                                       genActions=self.data.genActions,
+                                       signedCache=self.data.signedCache)
+        if self.data.deviceCertDir:
+            self.encrypted = self._encryptCI()
 
-    def save(self) -> None:
-        self.outPath = os.path.join(self.data.outDir, Constants.EN_DIR,
-                                    self.data.serialNum, Constants.BSD_DIR)
-        if not os.path.exists(self.outPath):
-            os.makedirs(self.outPath)
-        cif = os.path.join(self.outPath, Constants.CI_FILE)
-        ocf = os.path.join(self.outPath, Constants.OC_FILE)
-        ovf = os.path.join(self.outPath, Constants.OV_FILE)
-        act = os.path.join(self.outPath, Constants.ACTIONS_FILE)
-
-        util.writeToFile(self.bsd.ci, cif)
-        util.writeToFile(self.bsd.oc, ocf)
-        util.writeToFile(self.bsd.ov, ovf)
-        if self.data.bootable or self.data.genActions:
-            util.writeToFile(self.bsd.actions, act)
+    @Profile.timed('USB.encrypt')
+    def _encryptCI(self):
+        """
+        Encrypts the signed conveyed information for the certificate of
+        each device it is written for, on --jobs threads
+        : return : {serial number: encrypted conveyed information or Error}
+        """
+        devices = [d for d in self.data.devices if 'ci' in d.write]
+        if not devices:
+            return dict()
+
+        def encrypt(device):
+            try:
+                return self.bsd.encryptCI(device.cert)
+            except Error as e:
+                return e
+
+        # With the openssl backend each device is an openssl run
+        workers = min(len(devices), self.data.jobs)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return dict(zip([d.serialNum for d in devices],
+                            executor.map(encrypt, devices)))
+
+    @Profile.timed('USB.extract')
+    def _extract(self):
+        """
+        Extracts the bootable zip to the output path, hashing the images
+        while they are extracted
+        : return : digests of the extracted images, by path
+        """
+        hashMethods = [model.Image.hashMethod(alg) for alg in self.hashAlgs]
+        if None in hashMethods:
+            raise Error(errorCode=ErrorCode.INVALID_DATA,
+                        error='Unsupported image hash algorithm {}'.format(
+                            self.data.hashAlg))
+
+        members = {
+            os.path.relpath(src, self.data.outDir).replace(os.sep, '/'): src
+            for src in self.data.imageUrl['src']
+        }
+        digests = archive.extract(self.data.bootFile, self.data.outDir,
+                                  hashes={m: hashMethods for m in members})
+
+        return {members[m]: d for m, d in digests.items()}
+
+    def _fingerprints(self):
+        """
+        : return : function returning the fingerprint of the inputs of each
+                   artifact of a device
+        """
+        digest = lambda f: util.genHash(f) if f else None
+        cert = [digest(f) for f in [self.data.oc] + (self.data.ocChain or [])]
+        key = digest(self.certificates.ownerPrivateKey)
+
+        if self.data.bootable:
+            # The image is extracted from the boot file
+            images = [BuildManifest.identity(self.data.bootFile)]
+        else:
+            images = [BuildManifest.identity(i) for i in self.data.imageUrl['src']]
+
+        ci = BuildManifest.fingerprint(
+            'ci', cert, key, self.data.configHandle,
+            digest(self.data.preConfig), digest(self.data.config),
+            digest(self.data.postConfig), self.data.osName,
+            self.data.osVersion, self.hashAlgs, images,
+            self.data.imageUrl['dest'], Constants.ROOT_DIRS)
+        oc = BuildManifest.fingerprint('oc', cert)
+        actions = BuildManifest.fingerprint('actions', cert, key)
 
+        def fingerprints(device):
+            artifacts = {
+                # An encrypted conveyed information is per device
+                'ci': BuildManifest.fingerprint(ci, digest(device.cert))
+                if device.cert else ci,
+                'oc': oc,
+                'ov': BuildManifest.fingerprint('ov', digest(device.ov)),
+            }
+            if self.data.bootable or self.data.genActions:
+                artifacts['actions'] = actions
+
+            return artifacts
+
+        return fingerprints
+
+    def _imageSources(self):
+        """
+        : return : [(image path, path of the file it comes from or None)]
+        """
+        if self.data.bootable:
+            return [(src, self.data.bootFile) for src in self.data.imageUrl['src']]
         if self.data.copyImage:
-            imgPath = os.path.join(self.data.outDir, self.data.imageUrl['dest'][0])
-            self.imgDest = os.path.dirname(imgPath)
-            if not os.path.exists(self.imgDest):
-                os.makedirs(self.imgDest)
-            shutil.copyfile(self.data.imageUrl['src'][0], imgPath)
-            print('Copied image to {}'.format(imgPath))
+            return [(os.path.join(self.data.outDir, dest), src)
+                    for src, dest in zip(self.data.imageUrl['src'],
+                                         self.data.imageUrl['dest'])]
+
+        return [(src, None) for src in self.data.imageUrl['src']]
+
+    def _extractedIsCurrent(self):
+        return all(
+            self.manifest.fileDigests(path, self.hashAlgs, source=source)
+            for path, source in self._imageSources())
+
+    def _knownImageDigests(self):
+        """
+        : return : digests of the source images that are unchanged since the
+                   last run (and, with --copy-image, whose copy is too)
+        """
+        digests = dict()
+        for src, (path, source) in zip(self.data.imageUrl['src'],
+                                       self._imageSources()):
+            digest = self.manifest.fileDigests(path, self.hashAlgs, source=source)
+            if digest and (not self.data.copyImage or
+                           self.manifest.fileDigests(src, self.hashAlgs)):
+                digests[src] = digest
+
+        return digests
+
+    def _recordImages(self, image):
+        if image is None:
+            return
+
+        for imgHash, src, (path, source) in zip(image.imgHash,
+                                                self.data.imageUrl['src'],
+                                                self._imageSources()):
+            digests = dict(zip(self.hashAlgs, imgHash))
+            self.manifest.recordFile(path, digests, source=source)
+            if source and not self.data.bootable:
+                self.manifest.recordFile(src, digests)
+
+    @Profile.timed('USB.save')
+    def save(self) -> None:
+        artifacts = util.AttrDict()
+        artifacts.ci = self.bsd.ci if self.bsd else None
+        artifacts.oc = self.bsd.oc if self.bsd else None
+        artifacts.actions = self.bsd.actions if self.bsd else None
+        artifacts.encrypted = self.encrypted
+
+        # The directories of all the devices are created first, then the
+        # files are written by --jobs writer threads while the ownership
+        # vouchers of the next devices are read
+        writer = ArtifactWriter(threads=self.data.jobs)
+        writer.makedirs({
+            os.path.dirname(_artifactPath(self.data.outDir, d.serialNum, a)):
+            d.serialNum
+            for d in self.data.devices for a in d.write
+        })
+        for device in self.data.devices:
+            for artifact in device.write:
+                if device.serialNum in writer.errors:
+                    break
+                try:
+                    data = _artifactData(artifacts, device, artifact)
+                except (Error, OSError) as e:
+                    writer.fail(device.serialNum, e)
+                    break
+                writer.write(_artifactPath(self.data.outDir, device.serialNum,
+                                           artifact),
+                             data,
+                             tag=device.serialNum)
+        self.writeStats = writer.close()
+
+        # Results are returned in the order of self.data.devices
+        self.results = [(d.serialNum, writer.errors.get(d.serialNum))
+                        for d in self.data.devices]
+        for device, (_, error) in zip(self.data.devices, self.results):
+            if error:
+                continue
+            for artifact in device.write:
+                self.manifest.recordOutput(
+                    _artifactPath(self.data.outDir, device.serialNum,
+                                  artifact), device.fingerprints[artifact])
+        self.manifest.save()
+
+        return self.results
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
@@ -106,21 +342,57 @@ class USB:
     def __str__(self) -> str:
         return str(self.__dict__)
 
+def _artifactPath(outDir, serialNum, artifact):
+    return os.path.join(outDir, Constants.EN_DIR, serialNum, Constants.BSD_DIR,
+                        _ARTIFACT_FILES[artifact])
+
+
+_ARTIFACT_FILES = {
+    'ci': Constants.CI_FILE,
+    'oc': Constants.OC_FILE,
+    'ov': Constants.OV_FILE,
+    'actions': Constants.ACTIONS_FILE,
+}
+
+
+def _artifactData(artifacts, device, artifact):
+    if artifact == 'ov':
+        data = model.OwnershipVoucher(voucher=device.ov).voucher
+    elif artifact == 'ci' and device.cert:
+        data = artifacts.encrypted[device.serialNum]
+        if isinstance(data, Error):
+            raise data
+    else:
+        data = artifacts[artifact]
+    if not data:
+        raise Error(errorCode=ErrorCode.INVALID_DATA,
+                    error='No data to write to {}'.format(
+                        _ARTIFACT_FILES[artifact]))
+
+    return data
+
+
 class Validate:
     @staticmethod
-    def oc(cert):
+    def oc(cert, privateKey=None):
         if not os.path.isfile(cert):
             raise Error(errorCode=ErrorCode.FILE_NOT_FOUND)
+        if privateKey and not os.path.isfile(privateKey):
+            raise Error(errorCode=ErrorCode.FILE_NOT_FOUND)
 
-        ret = X509.isValid(cert, encoding='PEM')
+        ret = X509.check(cert, privateKey)
         if ret is not None:
-            raise Error(ErrorCode.X509_VERIFICATION_FAILED,
-                        'Not a valid x509 PEM certificate')
+            raise Error(ErrorCode.X509_VERIFICATION_FAILED, ret)
 
     @staticmethod
     def serial(serialNum):
         if serialNum is None or serialNum == '':
             raise Error(errorCode=ErrorCode.INVALID_SERIAL_NUM)
+        # The serial number is the name of the device directory under EN9
+        if '/' in serialNum or os.sep in serialNum or '..' in serialNum:
+            raise Error(errorCode=ErrorCode.INVALID_SERIAL_NUM,
+                        error='{} is not a valid serial number'.format(
+                            serialNum))
 
     @staticmethod
     def filename(filePath):
@@ -128,8 +400,106 @@ class Validate:
             raise Error(errorCode=ErrorCode.FILE_NOT_FOUND)
 
 
-def main():
-    parser = argparse.ArgumentParser()
+class Devices:
+    """
+    Builds the list of (serial number, ownership voucher) pairs to generate
+    bootstrapping data for.
+    """
+    _VOUCHER_EXT = '.vcj'
+    _CERT_EXTS = ('.pem', '.cert', '.crt', '.der')
+
+    @staticmethod
+    def _device(serialNum, ov):
+        device = util.AttrDict()
+        device.serialNum = serialNum
+        device.ov = ov
+        device.cert = None
+        return device
+
+    @staticmethod
+    def fromArgs(serialNum, ov):
+        return [Devices._device(serialNum, ov)]
+
+    @staticmethod
+    def fromDir(voucherDir):
+        """
+        Every <serial>.vcj file in voucherDir is the ownership voucher of the
+        device with that serial number
+        """
+        if not os.path.isdir(voucherDir):
+            raise Error(errorCode=ErrorCode.FILE_NOT_FOUND,
+                        error='{} is not a directory'.format(voucherDir))
+
+        devices = list()
+        for fileName in sorted(os.listdir(voucherDir)):
+            serialNum, ext = os.path.splitext(fileName)
+            if ext != Devices._VOUCHER_EXT:
+                continue
+            devices.append(
+                Devices._device(serialNum, os.path.join(voucherDir, fileName)))
+
+        return devices
+
+    @staticmethod
+    def withCerts(devices, certDir):
+        """
+        Sets the device certificate of each device to the <serial>.pem
+        (or .cert, .crt, .der) file of certDir, None when there is none
+        """
+        if not os.path.isdir(certDir):
+            raise Error(errorCode=ErrorCode.FILE_NOT_FOUND,
+                        error='{} is not a directory'.format(certDir))
+
+        certs = dict()
+        for fileName in sorted(os.listdir(certDir)):
+            serialNum, ext = os.path.splitext(fileName)
+            if ext not in Devices._CERT_EXTS:
+                continue
+            if serialNum in certs:
+                raise Error(errorCode=ErrorCode.INVALID_CERTIFICATE,
+                            error='Several certificates for {} in {}'.format(
+                                serialNum, certDir))
+            certs[serialNum] = os.path.join(certDir, fileName)
+
+        for device in devices:
+            device.cert = certs.get(device.serialNum)
+
+        return devices
+
+    @staticmethod
+    def fromManifest(manifest):
+        """
+        Reads a manifest with one '<serial>,<voucher path>' entry per line.
+        Empty lines and lines starting with '#' are ignored, relative voucher
+        paths are relative to the manifest.
+        """
+        if not util.fileExists(manifest):
+            raise Error(errorCode=ErrorCode.FILE_NOT_FOUND,
+                        error='{} not found'.format(manifest))
+
+        baseDir = os.path.dirname(manifest)
+        devices = list()
+        with open(manifest, 'r') as f:
+            for lineNum, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+
+                fields = [field.strip() for field in line.split(',')]
+                if len(fields) != 2:
+                    raise Error(errorCode=ErrorCode.INVALID_DATA,
+                                error='{}:{}: expected <serial>,<voucher>'.
+                                format(manifest, lineNum))
+                serialNum, ov = fields
+                devices.append(
+                    Devices._device(serialNum, os.path.join(baseDir, ov)))
+
+        return devices
+
+
+def _buildParser(parserClass=argparse.ArgumentParser):
+    parser = parserClass(
+        epilog='Run "%(prog)s verify -h" to check the bootstrapping data of an existing USB drive, "%(prog)s serve -h" to run the build daemon, "%(prog)s bootstrap-server -h" to serve the bootstrapping data over RESTCONF')
 
     parser.add_argument('-prc',
                         '--pre-config',
@@ -152,7 +522,8 @@ def main():
     parser.add_argument('-ia',
                         '--image-hash-alg',
                         dest='hashAlg',
-                        help='Image Hash Alg')
+                        action='append',
+                        help='Image Hash Alg, sha-256 (default) or sha-384. Repeat the option or use a comma separated list to publish several digests')
     parser.add_argument('-cp',
                         '--copy-image',
                         dest='copyImage',
@@ -161,8 +532,9 @@ def main():
     parser.add_argument('-ip',
                         '--image-relative-path',
                         dest='imgRelPath',
+                        action='append',
                         required=False,
-                        help='Relative folder path in USB where image (is present / should be copied to). Make sure to end the path with a /')
+                        help='Relative folder path in USB where image (is present / should be copied to). Make sure to end the path with a /. Repeat it once per --image-url to place each image in its own folder')
     parser.add_argument('-ver',
                         '--os-version',
                         dest='osVersion',
@@ -176,6 +548,11 @@ def main():
                         dest='oc',
                         required=True,
                         help='Path to Owner Certificate Private key')
+    parser.add_argument('-occ',
+                        '--owner-cert-chain',
+                        dest='ocChain',
+                        action='append',
+                        help='Path to a PEM file with intermediate certificates of the Owner Certificate, added to the owner certificate artifact. Repeat it for several files, from the Owner Certificate issuer up')
     parser.add_argument('-ocpk',
                         '--owner-cert-pk',
                         dest='ocpk',
@@ -184,7 +561,6 @@ def main():
     parser.add_argument('-ov',
                         '--ownership-voucher',
                         dest='ov',
-                        required=True,
                         help='Path to Ownership Voucher')
     parser.add_argument('-o',
                         '--output',
@@ -194,8 +570,19 @@ def main():
     parser.add_argument('-sn',
                         '--serial-num',
                         dest='serialNum',
-                        required=True,
                         help='RP Serial Number')
+    parser.add_argument('-vd',
+                        '--voucher-dir',
+                        dest='voucherDir',
+                        help='Batch mode: directory of <serial>.vcj Ownership Vouchers, one per device')
+    parser.add_argument('-m',
+                        '--manifest',
+                        dest='manifest',
+                        help='Batch mode: file with one <serial>,<voucher path> entry per line')
+    parser.add_argument('-dcd',
+                        '--device-cert-dir',
+                        dest='deviceCertDir',
+                        help='Directory of <serial>.pem (or .cert, .crt, .der) device certificates (IDevID), one per device. The conveyed information of each device is encrypted for its certificate')
     parser.add_argument('-b',
                         '--bootable',
                         dest='bootable',
@@ -211,11 +598,111 @@ def main():
                         dest='genActions',
                         action='store_true',
                         help='Generate signed actions file artifact with \'reload-bootmedia-usb\' set to true')
+    parser.add_argument('-cb',
+                        '--crypto-backend',
+                        dest='cryptoBackend',
+                        choices=['native', 'openssl'],
+                        help='CMS implementation: in-process (native, requires the cryptography package) or the openssl CLI. Default: native when available')
+
+    parser.add_argument('-j',
+                        '--jobs',
+                        dest='jobs',
+                        type=int,
+                        help='Number of threads encrypting (with --device-cert-dir) and writing the per device bootstrapping data. Default: number of CPUs')
+
+    parser.add_argument('-dc',
+                        '--digest-cache',
+                        dest='digestCache',
+                        nargs='?',
+                        const=DigestCache.DEFAULT_PATH,
+                        help='Reuse image digests computed by previous runs, stored in DIGESTCACHE (default: {})'.format(DigestCache.DEFAULT_PATH))
+    parser.add_argument('-dcs',
+                        '--digest-cache-strict',
+                        dest='digestCacheStrict',
+                        action='store_true',
+                        help='Always re-hash the images and refresh stale --digest-cache entries')
+    parser.add_argument('-hbs',
+                        '--hash-buffer-size',
+                        dest='hashBufSize',
+                        type=int,
+                        default=util.HASH_BUF_SIZE // 1024,
+                        help='Size in KiB of the reads when hashing and copying images. Default: {}'.format(util.HASH_BUF_SIZE // 1024))
+
+    parser.add_argument('-sc',
+                        '--signed-cache',
+                        dest='signedCache',
+                        nargs='?',
+                        const=SignedCache.DEFAULT_DIR,
+                        help='Reuse signed artifacts of identical content and owner certificate PKCS#7 from previous runs, stored in SIGNEDCACHE (default: {})'.format(SignedCache.DEFAULT_DIR))
+
+    parser.add_argument('-pf',
+                        '--profile',
+                        dest='profile',
+                        action='store_true',
+                        help='Print the time, bytes processed, subprocesses and peak memory of each stage')
+    parser.add_argument('-pj',
+                        '--profile-json',
+                        dest='profileJSON',
+                        help='Write the --profile summary as JSON to PROFILEJSON')
+    parser.add_argument('-pt',
+                        '--profile-trace',
+                        dest='profileTrace',
+                        help='Write the --profile spans to PROFILETRACE in the Chrome trace event format')
+
+    parser.add_argument('-f',
+                        '--force',
+                        dest='force',
+                        action='store_true',
+                        help='Regenerate all the bootstrapping data, even when the build manifest of a previous run for the output path shows it is up to date')
 
+    return parser
+
+
+def main():
+    if sys.argv[1:2] == ['verify']:
+        return verifyMain(sys.argv[2:])
+    if sys.argv[1:2] == ['serve']:
+        return serveMain(sys.argv[2:])
+    if sys.argv[1:2] == ['submit']:
+        return submitMain(sys.argv[2:])
+    if sys.argv[1:2] == ['bootstrap-server']:
+        return bootstrapServerMain(sys.argv[2:])
+
+    parser = _buildParser()
     options = parser.parse_args()
+    if options.profile or options.profileJSON or options.profileTrace:
+        Profile.enable()
+    if options.hashBufSize < 1:
+        parser.error('--hash-buffer-size must be at least 1')
+    if options.digestCacheStrict and not options.digestCache:
+        parser.error('--digest-cache-strict requires --digest-cache')
+    data = _buildData(parser, options)
+
+    util.HASH_BUF_SIZE = options.hashBufSize * 1024
+    if options.digestCache:
+        data.digestCache = DigestCache(options.digestCache,
+                                       strict=options.digestCacheStrict)
+    if options.signedCache:
+        data.signedCache = SignedCache(options.signedCache)
+
+    _setCMSBackend(parser, options)
+    try:
+        _generate(data, options)
+    finally:
+        if Profile.enabled:
+            _reportProfile(options)
+
+
+def _buildData(parser, options):
+    """
+    Checks the options of a build
+    : return : the data of the USB, without caches
+    """
+    if options.jobs is not None and options.jobs < 1:
+        parser.error('--jobs must be at least 1')
     if (vars(options)['bootable']):
         options.copyImage = False
-        options.imgRelPath = 'boot/install-image.iso'
+        options.imgRelPath = ['boot/install-image.iso']
         options.imageUrl = [os.path.join(options.outDir, 'boot/install-image.iso')]
 
         if not vars(options)['bootFile']:
@@ -223,7 +710,16 @@ def main():
 
     if (vars(options)['copyImage'] and not vars(options)['imgRelPath']):
         parser.error('The --copyImage argument requires the --image-relative-path')
+    if options.imgRelPath and len(options.imgRelPath) not in (1, len(options.imageUrl or [])):
+        parser.error('Give one --image-relative-path for all the images or one per --image-url')
 
+    batch = [o for o in (options.voucherDir, options.manifest) if o]
+    if len(batch) > 1:
+        parser.error('Use only one of --voucher-dir and --manifest')
+    if batch and (options.serialNum or options.ov):
+        parser.error('--serial-num and --ownership-voucher cannot be used in batch mode')
+    if not batch and not (options.serialNum and options.ov):
+        parser.error('--serial-num and --ownership-voucher are required unless --voucher-dir or --manifest is used')
 
     data = util.AttrDict()
     data.preConfig = options.preConfig
@@ -235,38 +731,519 @@ def main():
     data.osName = options.osName
     data.osVersion = options.osVersion
     data.oc = options.oc
-    data.ov = options.ov
-    data.serialNum = options.serialNum
+    data.ocChain = options.ocChain
     data.outDir = options.outDir
     data.bootable = options.bootable
     data.copyImage = options.copyImage
     data.imgRelPath = options.imgRelPath
     data.bootFile = options.bootFile
     data.genActions = options.genActions
+    data.deviceCertDir = options.deviceCertDir
+    data.jobs = options.jobs or os.cpu_count() or 1
+    data.force = options.force
+    data.digestCache = None
+    data.signedCache = None
 
+    # Each image goes to the folder of its own --image-relative-path, or
+    # all of them to the folder of a single one
     pathDict = {'src':[], 'dest':[]}
-    pathDict['src'].append(data.imageUrl[0])
-    if data.imgRelPath:
-        dir = os.path.dirname(data.imgRelPath)
-        file = os.path.basename(data.imageUrl[0])
-        pathDict['dest'].append(os.path.join(dir, file))
-    else:
-        pathDict['dest'].append(data.imageUrl[0])
+    for i, imageUrl in enumerate(data.imageUrl or []):
+        pathDict['src'].append(imageUrl)
+        if data.imgRelPath:
+            imgRelPath = data.imgRelPath[i if len(data.imgRelPath) > 1 else 0]
+            dir = os.path.dirname(imgRelPath)
+            file = os.path.basename(imageUrl)
+            pathDict['dest'].append(os.path.join(dir, file))
+        else:
+            pathDict['dest'].append(imageUrl)
+    if len(set(pathDict['dest'])) < len(pathDict['dest']):
+        parser.error('Several --image-url would have the same path on the USB')
     data.imageUrl = pathDict
 
+    return data
+
 
+def _setCMSBackend(parser, options):
+    try:
+        getCMSBackend(options.cryptoBackend)
+    except Error as e:
+        parser.error(e.error)
+    CMS.backend = options.cryptoBackend
+
+
+def _reportProfile(options):
+    print(Profile.table())
+    if options.profileJSON:
+        Profile.writeJSON(options.profileJSON)
+    if options.profileTrace:
+        Profile.writeTrace(options.profileTrace)
+
+
+def _build(data, options, timings=None):
+    """
+    Generates and saves the bootstrapping data of the devices
+    : param timings : dict receiving the seconds taken by each step
+    : return : the USB
+    """
+    timings = timings if timings is not None else dict()
     certs = util.AttrDict()
     certs.ownerPrivateKey = options.ocpk
     certs.ownerCert = options.oc
 
-    try:
+    start = time.perf_counter()
+    if options.voucherDir:
+        data.devices = Devices.fromDir(options.voucherDir)
+    elif options.manifest:
+        data.devices = Devices.fromManifest(options.manifest)
+    else:
+        data.devices = Devices.fromArgs(options.serialNum, options.ov)
+    if options.deviceCertDir:
+        Devices.withCerts(data.devices, options.deviceCertDir)
+
+    usb = USB(data=data, certificates=certs)
+    timings['validate'] = time.perf_counter() - start
+    start = time.perf_counter()
+    usb.create()
+    timings['create'] = time.perf_counter() - start
+    start = time.perf_counter()
+    usb.save()
+    timings['save'] = time.perf_counter() - start
+    if data.digestCache:
+        data.digestCache.flush()
+
+    return usb
+
 
-        usb = USB(data=data, certificates=certs)
-        usb.create()
-        usb.save()
+def _generate(data, options):
+    try:
+        usb = _build(data, options)
+        results = usb.results
     except Error as e:
         print('Failed to generate Bootstrapping data')
         print(e)
+        return
+
+    failed = 0
+    for serialNum, error in results:
+        if error:
+            failed += 1
+            print('{}: Failed to generate Bootstrapping data. {}'.format(
+                serialNum, error))
+        elif serialNum in usb.upToDate:
+            print('{}: up to date'.format(serialNum))
+        else:
+            print('{}: OK'.format(serialNum))
+    print('Generated Bootstrapping data for {} of {} devices'.format(
+        len(results) - failed, len(results)))
+    stats = usb.writeStats
+    if stats['files']:
+        print('Wrote {} files, {:.1f} KiB in {:.3f} s ({:.1f} KiB/s, {:.3f} s to sync)'.format(
+            stats['files'], stats['bytes'] / 1024, stats['seconds'],
+            stats['bytes'] / 1024 / stats['seconds'], stats['syncSeconds']))
+
+
+def verifyMain(args):
+    parser = argparse.ArgumentParser(
+        prog='usb.py verify',
+        description='Verify the bootstrapping data of an existing USB drive: the signatures of the artifacts of every device, its onboarding information and the digests of the images it references')
+
+    parser.add_argument('-o',
+                        '--output',
+                        dest='outDir',
+                        required=True,
+                        help='Path of the USB drive, the --output of the run which generated it')
+    parser.add_argument('-oc',
+                        '--owner-cert',
+                        dest='oc',
+                        help='Path to Owner Certificate the owner certificate artifacts must contain')
+    parser.add_argument('-ca',
+                        '--trust-anchor',
+                        dest='trustAnchor',
+                        help='Path to PEM certificates the Owner Certificate must chain up to. Without it only the signatures are verified')
+    parser.add_argument('-cb',
+                        '--crypto-backend',
+                        dest='cryptoBackend',
+                        choices=['native', 'openssl'],
+                        help='CMS implementation: in-process (native, requires the cryptography package) or the openssl CLI. Default: native when available')
+    parser.add_argument('-j',
+                        '--jobs',
+                        dest='jobs',
+                        type=int,
+                        help='Number of signatures verified and images hashed at the same time. Default: number of CPUs')
+    parser.add_argument('-pf',
+                        '--profile',
+                        dest='profile',
+                        action='store_true',
+                        help='Print the time, bytes processed, subprocesses and peak memory of each stage')
+    parser.add_argument('-pj',
+                        '--profile-json',
+                        dest='profileJSON',
+                        help='Write the --profile summary as JSON to PROFILEJSON')
+    parser.add_argument('-pt',
+                        '--profile-trace',
+                        dest='profileTrace',
+                        help='Write the --profile spans to PROFILETRACE in the Chrome trace event format')
+
+    options = parser.parse_args(args)
+    if options.profile or options.profileJSON or options.profileTrace:
+        Profile.enable()
+    if options.jobs is not None and options.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    for path in (options.oc, options.trustAnchor):
+        if path and not util.fileExists(path):
+            parser.error('{} does not exist'.format(path))
+
+    _setCMSBackend(parser, options)
+    try:
+        ok = _verify(options)
+    finally:
+        if Profile.enabled:
+            _reportProfile(options)
+    if not ok:
+        sys.exit(1)
+
+
+def _verify(options):
+    verifier = KitVerifier(options.outDir,
+                           ownerCert=options.oc,
+                           trustAnchor=options.trustAnchor,
+                           jobs=options.jobs)
+    try:
+        results = verifier.verify()
+    except Error as e:
+        print('Failed to verify Bootstrapping data')
+        print(e)
+        return False
+
+    failed = 0
+    for serialNum, problems in results:
+        if problems:
+            failed += 1
+            print('{}: FAILED'.format(serialNum))
+            for problem in problems:
+                print('    {}'.format(problem))
+        elif serialNum in verifier.encrypted:
+            print('{}: OK, {} not checked (encrypted)'.format(
+                serialNum, Constants.CI_FILE))
+        else:
+            print('{}: OK'.format(serialNum))
+    stats = verifier.stats
+    print('Verified Bootstrapping data of {} of {} devices: {} signatures, {} images ({:.1f} MiB)'.format(
+        len(results) - failed, len(results), stats['signatures'],
+        stats['images'], stats['bytes'] / 2**20))
+    if stats['encrypted']:
+        print('{} encrypted conveyed information not checked'.format(
+            stats['encrypted']))
+    if results and not stats['signatures'] and not stats['images']:
+        print('Nothing could be verified')
+        return False
+
+    return bool(results) and not failed
+
+
+class _JobArgumentParser(argparse.ArgumentParser):
+    """
+    Parser of the arguments of a daemon job, its errors and -h help are
+    returned to the client instead of exiting the daemon
+    """
+    output = ''
+
+    def _print_message(self, message, file=None):
+        if message:
+            self.output += message
+
+    def error(self, message):
+        raise Error(errorCode=ErrorCode.INVALID_DATA, error=message)
+
+    def exit(self, status=0, message=None):
+        if status == 0:
+            raise _JobExit(self.output)
+        raise Error(errorCode=ErrorCode.INVALID_DATA, error=message)
+
+
+class _JobExit(Exception):
+    """
+    Raised when the arguments of a job only ask for the help
+    """
+    def __init__(self, output):
+        self.output = output
+        super().__init__(output)
+
+
+class Daemon:
+    """
+    Runs the builds submitted to usb.py serve.
+
+    The daemon outlives the builds, so what one build loads or computes is
+    kept for the next ones: the checked owner certificates, the loaded
+    private keys, the owner certificate PKCS#7, the image digests and the
+    signed artifacts. The builds of an output path run one at a time, the
+    builds of different paths concurrently.
+    """
+    def __init__(self, digestCache, signedCache):
+        self.digestCache = digestCache
+        self.signedCache = signedCache
+        self._locks = dict()
+        self._lock = threading.Lock()
+
+    def _outDirLock(self, outDir):
+        with self._lock:
+            return self._locks.setdefault(os.path.realpath(outDir),
+                                          threading.Lock())
+
+    # Options of a build naming files of the host, relative to the working
+    # directory of the client
+    _PATH_OPTIONS = ('preConfig', 'config', 'postConfig', 'imageUrl', 'oc',
+                     'ocChain', 'ocpk', 'ov', 'outDir', 'voucherDir',
+                     'manifest', 'bootFile', 'deviceCertDir')
+
+    @classmethod
+    def _absolutePaths(cls, options, cwd):
+        for name in cls._PATH_OPTIONS:
+            value = getattr(options, name)
+            if isinstance(value, list):
+                setattr(options, name, [os.path.join(cwd, v) for v in value])
+            elif value:
+                setattr(options, name, os.path.join(cwd, value))
+
+    def run(self, job):
+        """
+        : param job : {"args": [usb.py arguments of the build], "cwd":
+                      directory the relative paths of args are in}
+        : return : the result of each device and the timings of the build
+        """
+        args = job.get('args')
+        if not isinstance(args, list) or not all(isinstance(a, str) for a in args):
+            raise Error(errorCode=ErrorCode.INVALID_DATA,
+                        error='"args" must be the list of the usb.py arguments of the build')
+
+        parser = _buildParser(_JobArgumentParser)
+        try:
+            options = parser.parse_args(args)
+        except _JobExit as e:
+            return {'ok': True, 'output': e.output}
+        if job.get('cwd'):
+            self._absolutePaths(options, job['cwd'])
+        data = _buildData(parser, options)
+        data.digestCache = self.digestCache
+        data.signedCache = self.signedCache
+
+        timings = dict()
+        start = time.perf_counter()
+        with self._outDirLock(data.outDir):
+            timings['queued'] = time.perf_counter() - start
+            usb = _build(data, options, timings)
+
+        devices = list()
+        for serialNum, error in usb.results:
+            if error:
+                status = 'failed'
+            elif serialNum in usb.upToDate:
+                status = 'up-to-date'
+            else:
+                status = 'ok'
+            devices.append({'serialNum': serialNum, 'status': status,
+                            'error': error})
+
+        return {
+            'ok': not any(error for _, error in usb.results),
+            'devices': devices,
+            'timings': timings,
+            'written': usb.writeStats,
+        }
+
+
+def serveMain(args):
+    parser = argparse.ArgumentParser(
+        prog='usb.py serve',
+        description='Run the build daemon: it serves the builds submitted with "usb.py submit" on a Unix domain socket, keeping the owner certificates and keys, image digests and signed artifacts in memory from one build to the next. The --crypto-backend, cache, --hash-buffer-size and profile options of the builds are ignored, those of the daemon apply.')
+
+    parser.add_argument('-s',
+                        '--socket',
+                        dest='socket',
+                        required=True,
+                        help='Path of the Unix domain socket to serve on')
+    parser.add_argument('-cb',
+                        '--crypto-backend',
+                        dest='cryptoBackend',
+                        choices=['native', 'openssl'],
+                        help='CMS implementation: in-process (native, requires the cryptography package) or the openssl CLI. Default: native when available')
+    parser.add_argument('-dc',
+                        '--digest-cache',
+                        dest='digestCache',
+                        nargs='?',
+                        const=DigestCache.DEFAULT_PATH,
+                        help='Also store the image digests in DIGESTCACHE (default: {}), to share them with other runs'.format(DigestCache.DEFAULT_PATH))
+    parser.add_argument('-sc',
+                        '--signed-cache',
+                        dest='signedCache',
+                        nargs='?',
+                        const=SignedCache.DEFAULT_DIR,
+                        help='Also store the signed artifacts in SIGNEDCACHE (default: {}), to share them with other runs'.format(SignedCache.DEFAULT_DIR))
+    parser.add_argument('-hbs',
+                        '--hash-buffer-size',
+                        dest='hashBufSize',
+                        type=int,
+                        default=util.HASH_BUF_SIZE // 1024,
+                        help='Size in KiB of the reads when hashing and copying images. Default: {}'.format(util.HASH_BUF_SIZE // 1024))
+
+    options = parser.parse_args(args)
+    if options.hashBufSize < 1:
+        parser.error('--hash-buffer-size must be at least 1')
+
+    util.HASH_BUF_SIZE = options.hashBufSize * 1024
+    _setCMSBackend(parser, options)
+    daemon = Daemon(DigestCache(options.digestCache),
+                    SignedCache(options.signedCache))
+    try:
+        server = JobServer(options.socket, daemon.run)
+    except (Error, OSError) as e:
+        print('Failed to serve on {}. {}'.format(options.socket, e))
+        sys.exit(1)
+
+    # Remove the socket on kill as well as on Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print('Serving builds on {}'.format(options.socket))
+    with server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def submitMain(args):
+    parser = argparse.ArgumentParser(
+        prog='usb.py submit',
+        usage='%(prog)s [-h] -s SOCKET [-t TIMEOUT] -- BUILD_ARGS',
+        description='Submit a build to the daemon started by "usb.py serve" and print its result. BUILD_ARGS are the usb.py arguments of the build, with paths the daemon can read.')
+
+    parser.add_argument('-s',
+                        '--socket',
+                        dest='socket',
+                        required=True,
+                        help='Path of the Unix domain socket of the daemon')
+    parser.add_argument('-t',
+                        '--timeout',
+                        dest='timeout',
+                        type=float,
+                        help='Seconds to wait for the result. Default: no limit')
+    parser.add_argument('args',
+                        nargs=argparse.REMAINDER,
+                        help=argparse.SUPPRESS)
+
+    options = parser.parse_args(args)
+    buildArgs = options.args[1:] if options.args[:1] == ['--'] else options.args
+    try:
+        answer = submit(options.socket,
+                        {'args': buildArgs, 'cwd': os.getcwd()},
+                        timeout=options.timeout)
+    except (Error, OSError, ValueError) as e:
+        print('Failed to submit the build to {}. {}'.format(options.socket, e))
+        sys.exit(1)
+
+    if answer.get('output'):
+        print(answer['output'], end='')
+    if answer.get('error'):
+        print('Failed to generate Bootstrapping data')
+        print(answer['error'])
+    for device in answer.get('devices', []):
+        if device['status'] == 'failed':
+            print('{}: Failed to generate Bootstrapping data. {}'.format(
+                device['serialNum'], device['error']))
+        elif device['status'] == 'up-to-date':
+            print('{}: up to date'.format(device['serialNum']))
+        else:
+            print('{}: OK'.format(device['serialNum']))
+    timings = answer.get('timings', dict())
+    if 'create' in timings:
+        print('Done in {:.3f} s ({})'.format(
+            timings['total'], ', '.join(
+                '{} {:.3f} s'.format(step, seconds)
+                for step, seconds in timings.items() if step != 'total')))
+    if not answer.get('ok'):
+        sys.exit(1)
+
+
+def bootstrapServerMain(args):
+    parser = argparse.ArgumentParser(
+        prog='usb.py bootstrap-server',
+        description='Serve the bootstrapping data of a USB drive written by usb.py over RESTCONF, as an RFC 8572 bootstrap server would: devices POST get-bootstrapping-data with their serial number as the HTTP basic authentication username (passwords are not checked) and their progress reports are printed. Send SIGHUP to reload the bootstrapping data after a build. For the lab only.')
+
+    parser.add_argument('-o',
+                        '--output',
+                        dest='outDir',
+                        required=True,
+                        help='Path of the USB drive, the --output of the run which generated it')
+    parser.add_argument('-a',
+                        '--address',
+                        dest='address',
+                        default='0.0.0.0',
+                        help='Address to listen on. Default: 0.0.0.0')
+    parser.add_argument('-p',
+                        '--port',
+                        dest='port',
+                        type=int,
+                        help='Port to listen on. Default: 8443 with --tls-cert, 8080 otherwise')
+    parser.add_argument('-tc',
+                        '--tls-cert',
+                        dest='tlsCert',
+                        help='PEM certificate (chain) of the server, to serve HTTPS')
+    parser.add_argument('-tk',
+                        '--tls-key',
+                        dest='tlsKey',
+                        help='PEM private key of --tls-cert')
+
+    options = parser.parse_args(args)
+    if bool(options.tlsCert) != bool(options.tlsKey):
+        parser.error('--tls-cert and --tls-key go together')
+
+    sslContext = None
+    if options.tlsCert:
+        sslContext = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        sslContext.load_cert_chain(options.tlsCert, options.tlsKey)
+    if options.port is None:
+        options.port = 8443 if sslContext else 8080
+
+    try:
+        index = ArtifactIndex(options.outDir)
+    except Error as e:
+        print('Failed to load the bootstrapping data. {}'.format(e))
+        sys.exit(1)
+    raiseFileLimit()
+    server = BootstrapServer(index, options.address, options.port,
+                             sslContext)
+
+    def reload():
+        try:
+            print('Reloaded the bootstrapping data of {} devices'.format(
+                index.load()))
+        except Error as e:
+            print('Failed to reload the bootstrapping data. {}'.format(e))
+
+    async def serve():
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGHUP, reload)
+        loop.add_signal_handler(signal.SIGTERM, server.close)
+        try:
+            addresses = await server.start()
+        except OSError as e:
+            print('Failed to serve on {}:{}. {}'.format(
+                options.address, options.port, e))
+            sys.exit(1)
+        print('Serving the bootstrapping data of {} devices on {}'.format(
+            len(index.responses), ', '.join(
+                '{}://{}:{}'.format('https' if sslContext else 'http',
+                                    *address[:2]) for address in addresses)))
+        await server.serveForever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    print('Served {requests} requests on {connections} connections: '
+          '{served} bootstrapping data, {unknown} unknown devices, '
+          '{reports} progress reports, {errors} bad requests'.format(
+              **server.stats))
 
 
 if __name__ == '__main__':
@@ -1,8 +1,27 @@
+import base64
+import email
+import hashlib
+import io
+import itertools
+import os
+import re
 import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timezone
 
 from . import util
 from .exceptions import *
 
+try:
+    from cryptography import x509
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.ciphers import algorithms
+    from cryptography.hazmat.primitives.asymmetric import ec, ed25519, padding, rsa
+    from cryptography.hazmat.primitives.serialization import pkcs7
+except ImportError:
+    x509 = None
+
 
 class CMSType(Enum):
     UNENCRYPTED = 0
@@ -28,46 +47,133 @@ class _ContentType:
 
     def getContentType(self, cmsData):
         """
-        Read the CMS data and return the outermost content type
-        : param cmsData : CMS structured data
+        Read the CMS data and return the outermost content type. Only the
+        ContentInfo header is decoded, in-process.
+        : param cmsData : CMS structured data in DER, PEM or S/MIME
         : return : CMS type
         """
-        if not cmsData:
-            raise DecodeError('CMS Data is empty')
+        return self._cmsType(self.getContentTypeOID(cmsData))
+
+    def getContentTypeOID(self, cmsData):
+        """
+        : return : OID of the outermost content type of cmsData
+        """
+        try:
+            der, contentInfo = self._contentInfo(cmsData)
+        except _Unsupported:
+            # BER indefinite lengths, let openssl decode the structure
+            return self._printedContentTypes(cmsData)[0]
 
-        contentType = None
-        for i in cmsData.split('\n'):
-            if 'contentType' in i:
-                contentType = i.strip()
-                break
+        return _DER.decodeOID(_DER.value(der, contentInfo[0]))
+
+    def getInnerContentTypeOID(self, cmsData):
+        """
+        : return : OID of the content type of the data a SignedData
+                   (eContentType) or an EnvelopedData encapsulates, None
+                   for the other content types
+        """
+        try:
+            return self._innerContentType(*self._contentInfo(cmsData))
+        except _Unsupported:
+            contentTypes = self._printedContentTypes(cmsData)
+            return contentTypes[1] if len(contentTypes) > 1 else None
 
-        if not contentType:
-            raise CryptoError('Invalid CMS data type')
+    def _innerContentType(self, der, contentInfo):
+        contentType = _DER.decodeOID(_DER.value(der, contentInfo[0]))
+        if len(contentInfo) < 2:
+            return None
+        content = _DER.read(der, contentInfo[1][2])
 
-        if self._contentType.data in contentType:
+        # SignedData: version, digestAlgorithms, encapContentInfo, ...
+        # EnvelopedData: version, [0] originatorInfo, recipientInfos,
+        # encryptedContentInfo, ...
+        if contentType == self._contentType.signedData:
+            fields = itertools.islice(_DER.children(der, content), 2, 3)
+        elif contentType == self._contentType.envelopedData:
+            fields = itertools.islice(
+                (f for f in _DER.children(der, content)
+                 if f[0] == _DER.SEQUENCE), 0, 1)
+        else:
+            return None
+
+        for field in fields:
+            oid = _DER.read(der, field[2])
+            if oid[0] == _DER.OID:
+                return _DER.decodeOID(_DER.value(der, oid))
+
+        raise DecodeError(ErrorCode.DATA_DECODING_FAILED,
+                          'No content type in {}'.format(contentType))
+
+    @staticmethod
+    def _contentInfo(cmsData):
+        """
+        : return : (DER data, [contentType, [0] content] elements of the
+                   ContentInfo)
+        """
+        der = _DER.fromCMS(cmsData)
+        contentInfo = _DER.read(der)
+        if contentInfo[0] != _DER.SEQUENCE:
+            raise DecodeError(ErrorCode.DATA_DECODING_FAILED,
+                              'Not a CMS ContentInfo')
+        fields = list(_DER.children(der, contentInfo))
+        if not fields or fields[0][0] != _DER.OID:
+            raise DecodeError(ErrorCode.DATA_DECODING_FAILED,
+                              'Not a CMS ContentInfo')
+
+        return der, fields
+
+    _PRINTED_CONTENT_TYPE = re.compile(r'^\s*e?[cC]ontentType: .*\(([0-9.]+)\)$')
+
+    @classmethod
+    def _printedContentTypes(cls, cmsData):
+        """
+        Decodes cmsData with openssl cms -print, for the encodings _DER
+        does not read
+        : return : OIDs of the outer content type, then of the content it
+                   encapsulates
+        """
+        if isinstance(cmsData, str):
+            cmsData = cmsData.encode()
+        inform = _CMS._SMIME_ENCODING
+        if cmsData[:1] == bytes([_DER.SEQUENCE]):
+            inform = _CMS._DER_ENCODING
+        elif cmsData.lstrip().startswith(b'-----BEGIN'):
+            inform = 'PEM'
+
+        contentTypes = list()
+        for line in _CMS().cmsout(cmsData, inform=inform).split('\n'):
+            match = cls._PRINTED_CONTENT_TYPE.match(line)
+            if match:
+                contentTypes.append(match.group(1))
+        if not contentTypes:
+            raise CryptoError(ErrorCode.INVALID_DATA, 'Invalid CMS data type')
+
+        return contentTypes
+
+    def _cmsType(self, oid):
+        if oid == self._contentType.data:
             return CMSType.UNENCRYPTED
 
-        if self._contentType.signedData in contentType:
+        if oid == self._contentType.signedData:
             return CMSType.SIGNED
 
         # From RFC8572 envelopedData is signed and encrypted
-        if self._contentType.envelopedData in contentType:
+        if oid == self._contentType.envelopedData:
             return CMSType.ENCRYPTED
 
-        raise CryptoError('Invalid CMS data type')
+        raise CryptoError(ErrorCode.INVALID_DATA,
+                          'Invalid CMS data type {}'.format(oid))
 
 
 class _CMS:
-    _TMP_CMS_IN = tempfile.NamedTemporaryFile(prefix='ztp-').name
-    _TMP_CMS_OUT = tempfile.NamedTemporaryFile(prefix='ztp-').name
-
     _CMS_DATA_CREATE_CMD = 'openssl cms -data_create -in {infile} -outform {outform} -out {outfile}'
 
     _CMS_SIGN_CMD = 'openssl cms -sign -nodetach -binary -in {infile} -inkey {inkey} -signer {signer} -out {outfile} -outform {outform}'
-    _CMS_ENCRYPT_CMD = 'openssl cms -encrypt -in {infile} -inform {inform} -binary -out {outfile} -outform {outform} {cert}'
+    _CMS_ENCRYPT_CMD = 'openssl cms -encrypt -in {infile} -inform {inform} -binary -aes256 -out {outfile} -outform {outform} {cert}'
     _CMS_ENCODE_CMD = 'openssl cms -cmsout -in {infile} -outform {encoding} -out {outfile}'
 
-    _CMS_VERIFY_SIGN_CMD = 'openssl cms -in {infile} -verify -CAfile {cafile} -certfile {certfile} -out {outfile}'
+    _CMS_VERIFY_SIGN_CMD = 'openssl cms -in {infile} -inform {inform} -verify -noverify {intern} -certfile {certfile} -signer {signer} -out {outfile}'
+    _X509_VERIFY_CMD = 'openssl verify -CAfile {cafile} {untrusted} {cert}'
     _CMS_DECRYPT_CMD = 'openssl cms -decrypt -in {infile} -out {outfile} -recip {recip} -inkey {inkey}'
     _CMS_DECODE_CMD = 'openssl cms -cmsout -in {infile} -inform {inform} -out {outfile} -outform {outform}'
     _CMS_CMSOUT_CMD = 'openssl cms -cmsout -in {infile} -inform {inform} -print'
@@ -79,220 +185,857 @@ class _CMS:
 
     _DEFAULT_TIMEOUT = 10
 
-    def _writeToCMSIn(data, f=_TMP_CMS_IN):
-        util.removeFiles(files=[_CMS._TMP_CMS_IN, _CMS._TMP_CMS_OUT])
+    @staticmethod
+    @contextmanager
+    def _scratch(data):
+        """
+        Creates a private scratch directory for one openssl call holding
+        the input file with data, so concurrent calls never share files
+        : param data : str, bytes or a callable streaming the data to the
+                       binary file it is given
+        : return : (input file path, output file path)
+        """
         if data is None:
             raise CryptoError(ErrorCode.INVALID_DATA)
+        if isinstance(data, str):
+            data = data.encode()
 
-        with open(_CMS._TMP_CMS_IN, 'wb') as cmsFile:
-            cmsFile.write(data)
+        with tempfile.TemporaryDirectory(prefix='ztp-') as scratchDir:
+            infile = os.path.join(scratchDir, 'in')
+            with open(infile, 'wb') as cmsFile:
+                if callable(data):
+                    data(cmsFile)
+                else:
+                    cmsFile.write(data)
 
-    def _readFromCMSOut():
-        with open(_CMS._TMP_CMS_OUT, 'rb') as cmsFile:
-            data = cmsFile.read()
+            yield infile, os.path.join(scratchDir, 'out')
 
-        if data is None or data.strip() == '':
+    @staticmethod
+    def _bytes(data):
+        """
+        Returns data as bytes, see _scratch() for the accepted types
+        """
+        if callable(data):
+            buf = io.BytesIO()
+            data(buf)
+            return buf.getvalue()
+        if isinstance(data, str):
+            return data.encode()
+
+        return data
+
+    @staticmethod
+    def _readOut(outfile):
+        try:
+            with open(outfile, 'rb') as cmsFile:
+                data = cmsFile.read()
+        except FileNotFoundError:
+            data = None
+
+        if not data or data.strip() == b'':
             raise CryptoError(ErrorCode.CMS_DATA_CREATION_FAILED)
 
-        util.removeFiles(files=[_CMS._TMP_CMS_IN, _CMS._TMP_CMS_OUT])
         return data
 
-    def dataCreate(self,
-                   data,
-                   outform=_SMIME_ENCODING,
-                   infile=_TMP_CMS_IN,
-                   outfile=_TMP_CMS_OUT):
-        _CMS._writeToCMSIn(data=data)
-        cmd = self._CMS_DATA_CREATE_CMD.format(outform=outform,
-                                               infile=infile,
-                                               outfile=outfile)
-        err, _ = util.execShellCmd(cmd,
-                                   shell=True,
-                                   timeout=self._DEFAULT_TIMEOUT)
-        if err:
-            raise CryptoError(ErrorCode.CMS_DATA_CREATION_FAILED, err)
-
-        return _CMS._readFromCMSOut()
-
-    def sign(self,
-             data,
-             inkey,
-             signer,
-             outform=_SMIME_ENCODING,
-             infile=_TMP_CMS_IN,
-             outfile=_TMP_CMS_OUT):
-        _CMS._writeToCMSIn(data=data)
-        cmd = self._CMS_SIGN_CMD.format(infile=infile,
-                                        inkey=inkey,
-                                        signer=signer,
-                                        outform=outform,
-                                        outfile=outfile)
-        err, _ = util.execShellCmd(cmd,
-                                   shell=True,
-                                   timeout=self._DEFAULT_TIMEOUT)
-        if err:
-            raise CryptoError(ErrorCode.DATA_SIGNING_FAILED, err)
-
-        return _CMS._readFromCMSOut()
-
-    def verify(self,
-               data,
-               cafile,
-               certfile,
-               infile=_TMP_CMS_IN,
-               outfile=_TMP_CMS_OUT):
-        _CMS._writeToCMSIn(data=data)
-        cmd = self._CMS_VERIFY_SIGN_CMD.format(cafile=cafile,
-                                               certfile=certfile,
-                                               infile=infile,
-                                               outfile=outfile)
-        err, _ = util.execShellCmd(cmd,
-                                   shell=True,
-                                   timeout=self._DEFAULT_TIMEOUT)
+    @staticmethod
+    def _cmd(template, **kwargs):
+        """
+        Builds the argument list of a command from its template. openssl is
+        run without a shell, a placeholder is one argument, or one per item
+        of a list, so paths need no quoting.
+        """
+        cmd = list()
+        for arg in template.split():
+            if arg.startswith('{') and arg.endswith('}'):
+                value = kwargs[arg[1:-1]]
+                cmd.extend(value if isinstance(value, (list, tuple)) else [value])
+            else:
+                cmd.append(arg)
+
+        return cmd
+
+    def _run(self, cmd, errorCode):
+        err, out = util.execShellCmd(cmd, timeout=self._DEFAULT_TIMEOUT)
         if err:
-            raise CryptoError(ErrorCode.SIGNATURE_VERIFICATION_ON_DATA_FAILED,
-                              err)
+            raise CryptoError(errorCode, err)
+
+        return out
+
+    def dataCreate(self, data, outform=_SMIME_ENCODING):
+        with self._scratch(data) as (infile, outfile):
+            cmd = self._cmd(self._CMS_DATA_CREATE_CMD,
+                            outform=outform,
+                            infile=infile,
+                            outfile=outfile)
+            self._run(cmd, ErrorCode.CMS_DATA_CREATION_FAILED)
+            return self._readOut(outfile)
 
-        return _CMS._readFromCMSOut()
+    def sign(self, data, inkey, signer, outform=_SMIME_ENCODING):
+        with self._scratch(data) as (infile, outfile):
+            cmd = self._cmd(self._CMS_SIGN_CMD,
+                            infile=infile,
+                            inkey=inkey,
+                            signer=signer,
+                            outform=outform,
+                            outfile=outfile)
+            self._run(cmd, ErrorCode.DATA_SIGNING_FAILED)
+            return self._readOut(outfile)
+
+    def verify(self, data, cafile, certfile, inform=_SMIME_ENCODING):
+        """
+        Verifies the signature of data and returns the signed content. The
+        signer certificate must chain up to cafile, or without cafile be
+        one of the certificates in certfile.
+        """
+        # Without a trust anchor only the signature is checked, by a signer
+        # from certfile rather than one embedded in data. openssl cms does
+        # not build the chain with the -certfile certificates, so the chain
+        # of the signer it writes out is checked by openssl verify instead.
+        intern = [] if cafile else ['-nointern']
+        with self._scratch(data) as (infile, outfile):
+            signer = os.path.join(os.path.dirname(outfile), 'signer')
+            cmd = self._cmd(self._CMS_VERIFY_SIGN_CMD,
+                            inform=inform,
+                            intern=intern,
+                            certfile=certfile,
+                            signer=signer,
+                            infile=infile,
+                            outfile=outfile)
+            self._run(cmd, ErrorCode.SIGNATURE_VERIFICATION_ON_DATA_FAILED)
+            if cafile:
+                cmd = self._cmd(self._X509_VERIFY_CMD,
+                                cafile=cafile,
+                                untrusted=['-untrusted', certfile] if certfile else [],
+                                cert=signer)
+                self._run(cmd, ErrorCode.SIGNATURE_VERIFICATION_ON_DATA_FAILED)
+            return self._readOut(outfile)
 
     def encrypt(self,
                 data,
                 cert,
-                infile=_TMP_CMS_IN,
-                outfile=_TMP_CMS_OUT,
                 inform=_DER_ENCODING,
                 outform=_DER_ENCODING):
-        _CMS._writeToCMSIn(data=data)
-        cmd = self._CMS_ENCRYPT_CMD.format(infile=infile,
-                                           inform=inform,
-                                           outfile=outfile,
-                                           outform=outform,
-                                           cert=cert)
-        err, _ = util.execShellCmd(cmd,
-                                   shell=True,
-                                   timeout=self._DEFAULT_TIMEOUT)
-        if err:
-            raise CryptoError(ErrorCode.DATA_ENCRYPTION_FAILED, err)
+        with self._scratch(data) as (infile, outfile):
+            cmd = self._cmd(self._CMS_ENCRYPT_CMD,
+                            infile=infile,
+                            inform=inform,
+                            outfile=outfile,
+                            outform=outform,
+                            cert=cert)
+            self._run(cmd, ErrorCode.DATA_ENCRYPTION_FAILED)
+            return self._readOut(outfile)
 
-        return _CMS._readFromCMSOut()
+    def decrypt(self, data, inkey, recip):
+        with self._scratch(data) as (infile, outfile):
+            cmd = self._cmd(self._CMS_DECRYPT_CMD,
+                            recip=recip,
+                            inkey=inkey,
+                            infile=infile,
+                            outfile=outfile)
+            self._run(cmd, ErrorCode.DATA_DECRYPTION_FAILED)
+            return self._readOut(outfile)
 
-    def decrypt(self,
-                data,
-                inkey,
-                recip,
-                infile=_TMP_CMS_IN,
-                outfile=_TMP_CMS_OUT):
-        _CMS._writeToCMSIn(data=data)
-        cmd = self._CMS_DECRYPT_CMD.format(recip=recip,
-                                           inkey=inkey,
-                                           infile=infile,
-                                           outfile=outfile)
-        err, _ = util.execShellCmd(cmd,
-                                   shell=True,
-                                   timeout=self._DEFAULT_TIMEOUT)
-        if err:
-            raise CryptoError(ErrorCode.DATA_DECRYPTION_FAILED, err)
-
-        return _CMS._readFromCMSOut()
-
-    def encode(self,
-               data,
-               encoding=_DER_ENCODING,
-               infile=_TMP_CMS_IN,
-               outfile=_TMP_CMS_OUT):
-        _CMS._writeToCMSIn(data=data)
-        cmd = self._CMS_ENCODE_CMD.format(encoding=encoding,
-                                          infile=infile,
-                                          outfile=outfile)
-        err, _ = util.execShellCmd(cmd,
-                                   shell=True,
-                                   timeout=self._DEFAULT_TIMEOUT)
-        if err:
-            raise CryptoError(ErrorCode.DATA_ENCODING_FAILED, err)
-
-        return _CMS._readFromCMSOut()
-
-    def decode(self,
-               data,
-               inform=_DER_ENCODING,
-               outform=_SMIME_ENCODING,
-               infile=_TMP_CMS_IN,
-               outfile=_TMP_CMS_OUT):
-        _CMS._writeToCMSIn(data=data)
-        cmd = self._CMS_DECODE_CMD.format(infile=infile,
-                                          outfile=outfile,
-                                          inform=inform,
-                                          outform=outform)
-        err, _ = util.execShellCmd(cmd,
-                                   shell=True,
-                                   timeout=self._DEFAULT_TIMEOUT)
-        if err:
-            raise CryptoError(ErrorCode.DATA_ENCODING_FAILED, err)
-
-        return _CMS._readFromCMSOut()
-
-    def extractEnvelopedData(self,
-                             data,
-                             inform=_SMIME_ENCODING,
-                             infile=_TMP_CMS_IN,
-                             outfile=_TMP_CMS_OUT):
-        _CMS._writeToCMSIn(data=data)
-        cmd = self._CMS_DATA_OUT.format(inform=inform,
-                                        infile=infile,
-                                        outfile=outfile)
-        err, _ = util.execShellCmd(cmd,
-                                   shell=True,
-                                   timeout=self._DEFAULT_TIMEOUT)
-        if err:
-            raise CryptoError(ErrorCode.CMS_DATA_EXTRACTION_FAILED, err)
+    def encode(self, data, encoding=_DER_ENCODING):
+        with self._scratch(data) as (infile, outfile):
+            cmd = self._cmd(self._CMS_ENCODE_CMD,
+                            encoding=encoding,
+                            infile=infile,
+                            outfile=outfile)
+            self._run(cmd, ErrorCode.DATA_ENCODING_FAILED)
+            return self._readOut(outfile)
 
-        return _CMS._readFromCMSOut()
+    def decode(self, data, inform=_DER_ENCODING, outform=_SMIME_ENCODING):
+        with self._scratch(data) as (infile, outfile):
+            cmd = self._cmd(self._CMS_DECODE_CMD,
+                            infile=infile,
+                            outfile=outfile,
+                            inform=inform,
+                            outform=outform)
+            self._run(cmd, ErrorCode.DATA_ENCODING_FAILED)
+            return self._readOut(outfile)
 
-    def cmsout(self, data, inform=_SMIME_ENCODING, infile=_TMP_CMS_IN):
-        _CMS._writeToCMSIn(data=data)
-        cmd = self._CMS_CMSOUT_CMD.format(inform=inform, infile=infile)
-        err, out = util.execShellCmd(cmd,
-                                     shell=True,
-                                     timeout=self._DEFAULT_TIMEOUT)
-        if err:
-            raise CryptoError(ErrorCode.INVALID_DATA, err)
+    def extractEnvelopedData(self, data, inform=_SMIME_ENCODING):
+        with self._scratch(data) as (infile, outfile):
+            cmd = self._cmd(self._CMS_DATA_OUT,
+                            inform=inform,
+                            infile=infile,
+                            outfile=outfile)
+            self._run(cmd, ErrorCode.CMS_DATA_EXTRACTION_FAILED)
+            return self._readOut(outfile)
 
-        return out
+    def crl2pkcs7(self, cert, outform='DER'):
+        return _CRL2PKCS7.pkcs7(cert, outform=outform)
+
+    def inspectCertificate(self, cert, privateKey=None):
+        """
+        Checks everything about cert but its validity period, which
+        checkValidity() checks at the time of use
+        : return : (None when the certificate is fine, the reason otherwise,
+                   notBefore, notAfter)
+        """
+        return _X509.inspect(cert, privateKey)
+
+    def checkCertificate(self, cert, privateKey=None):
+        """
+        Checks that cert is a PEM X.509 certificate valid now, allowed to
+        sign and matching privateKey
+        : return : None when the certificate is fine, the reason otherwise
+        """
+        problem, notBefore, notAfter = self.inspectCertificate(cert,
+                                                               privateKey)
+        if notBefore is None:
+            return problem
+
+        return checkValidity(notBefore, notAfter) or problem
+
+    def cmsout(self, data, inform=_SMIME_ENCODING):
+        with self._scratch(data) as (infile, _):
+            cmd = self._cmd(self._CMS_CMSOUT_CMD,
+                            inform=inform,
+                            infile=infile)
+            return self._run(cmd, ErrorCode.INVALID_DATA)
 
 
 class _CRL2PKCS7:
     @staticmethod
     def pkcs7(cert, outform='DER'):
-        certFile = tempfile.NamedTemporaryFile(prefix='ztp-').name
-        with open(certFile, 'w') as f:
-            f.write(cert)
-        cmd = [
-            'openssl', 'crl2pkcs7', '-nocrl', '-certfile', certFile, '-outform',
-            outform, '-out', _CMS._TMP_CMS_OUT
-        ]
-        err, _ = util.execShellCmd(cmd,
-                                   shell=False,
-                                   timeout=_CMS._DEFAULT_TIMEOUT)
-        util.removeFiles([certFile])
+        with _CMS._scratch(cert) as (certFile, outfile):
+            cmd = [
+                'openssl', 'crl2pkcs7', '-nocrl', '-certfile', certFile,
+                '-outform', outform, '-out', outfile
+            ]
+            err, _ = util.execShellCmd(cmd, timeout=_CMS._DEFAULT_TIMEOUT)
+            if err:
+                raise CryptoError(ErrorCode.INVALID_DATA, err)
+
+            return _CMS._readOut(outfile)
+
+
+class _X509:
+    _NOT_BEFORE = 'notBefore='
+    _NOT_AFTER = 'notAfter='
+
+    @staticmethod
+    def _date(out, prefix):
+        value = next((l[len(prefix):] for l in out.splitlines()
+                      if l.startswith(prefix)), None)
+
+        return datetime.strptime(
+            value, '%b %d %H:%M:%S %Y GMT').replace(tzinfo=timezone.utc)
+
+    @staticmethod
+    def inspect(cert, privateKey=None):
+        """
+        Checks with the openssl CLI that cert is a PEM X.509 certificate
+        allowed to sign and matching privateKey
+        : return : (None when the certificate is fine, the reason otherwise,
+                   notBefore, notAfter), the validity period is None when
+                   the certificate cannot be read
+        """
+        cmds = [[
+            'openssl', 'x509', '-in', cert, '-inform', 'PEM', '-noout',
+            '-pubkey', '-startdate', '-enddate', '-ext', 'keyUsage'
+        ]]
+        if privateKey:
+            cmds.append(['openssl', 'pkey', '-in', privateKey, '-pubout'])
+        # Both commands run at the same time
+        results = util.execShellCmds(cmds, timeout=_CMS._DEFAULT_TIMEOUT)
+
+        err, out = results[0]
         if err:
-            raise CryptoError(ErrorCode.INVALID_DATA, err)
+            return 'Not a valid x509 PEM certificate', None, None
+        try:
+            notBefore = _X509._date(out, _X509._NOT_BEFORE)
+            notAfter = _X509._date(out, _X509._NOT_AFTER)
+        except (TypeError, ValueError):
+            return 'Not a valid x509 PEM certificate', None, None
+
+        if 'Key Usage' in out and 'Digital Signature' not in out:
+            return ('Certificate key usage does not allow digital signature',
+                    notBefore, notAfter)
 
-        return _CMS._readFromCMSOut()
+        if privateKey:
+            err, pubKey = results[1]
+            if err:
+                return 'Not a valid PEM private key', notBefore, notAfter
+            if pubKey not in out:
+                return ('Certificate does not match the private key',
+                        notBefore, notAfter)
+
+        return None, notBefore, notAfter
+
+
+def checkValidity(notBefore, notAfter):
+    """
+    : return : None when now is within the validity period of a
+               certificate, the reason otherwise
+    """
+    now = datetime.now(timezone.utc)
+    if now < notBefore:
+        return 'Certificate is not valid yet'
+    if now > notAfter:
+        return 'Certificate has expired'
+
+    return None
 
 
 class _PKCS7:
     @staticmethod
     def getCerts(data, inform='DER'):
-        certFile = tempfile.NamedTemporaryFile(prefix='ztp-').name
-        with open(certFile, 'wb') as f:
-            f.write(data)
-        cmd = [
-            'openssl', 'pkcs7', '-in', certFile, '-inform', inform,
-            '-print_certs'
-        ]
-        err, out = util.execShellCmd(cmd, timeout=_CMS._DEFAULT_TIMEOUT)
-        util.removeFiles([certFile])
-        if err:
-            raise CryptoError(ErrorCode.INVALID_DATA, err)
+        with _CMS._scratch(data) as (certFile, _):
+            cmd = [
+                'openssl', 'pkcs7', '-in', certFile, '-inform', inform,
+                '-print_certs'
+            ]
+            err, out = util.execShellCmd(cmd, timeout=_CMS._DEFAULT_TIMEOUT)
+            if err:
+                raise CryptoError(ErrorCode.INVALID_DATA, err)
 
-        return out
+            return out
+
+
+class _Unsupported(Exception):
+    """
+    Raised by the native backend for inputs it does not handle, the
+    operation is then retried with the openssl CLI
+    """
+    pass
+
+
+class _DER:
+    SEQUENCE = 0x30
+    SET = 0x31
+    INTEGER = 0x02
+    OCTET_STRING = 0x04
+    OID = 0x06
+    CONTEXT_0 = 0xa0
+    CONTEXT_1 = 0xa1
+
+    @staticmethod
+    def encode(tag, value):
+        size = len(value)
+        if size < 0x80:
+            length = bytes([size])
+        else:
+            sizeBytes = size.to_bytes((size.bit_length() + 7) // 8, 'big')
+            length = bytes([0x80 | len(sizeBytes)]) + sizeBytes
+
+        return bytes([tag]) + length + value
+
+    @staticmethod
+    def encodeOID(oid):
+        arcs = [int(arc) for arc in oid.split('.')]
+        body = bytearray([40 * arcs[0] + arcs[1]])
+        for arc in arcs[2:]:
+            chunk = [arc & 0x7f]
+            arc >>= 7
+            while arc:
+                chunk.append(0x80 | (arc & 0x7f))
+                arc >>= 7
+            body.extend(reversed(chunk))
+
+        return _DER.encode(_DER.OID, bytes(body))
+
+    @staticmethod
+    def decodeOID(value):
+        arcs = []
+        arc = 0
+        for byte in value:
+            arc = (arc << 7) | (byte & 0x7f)
+            if not byte & 0x80:
+                arcs.append(arc)
+                arc = 0
+        if not arcs:
+            raise DecodeError(ErrorCode.DATA_DECODING_FAILED, 'Empty OID')
+        first = min(arcs[0] // 40, 2)
+
+        return '.'.join(str(a) for a in [first, arcs[0] - 40 * first] + arcs[1:])
+
+    @staticmethod
+    def read(data, offset=0):
+        """
+        Reads the element at offset
+        : return : (tag, header start, value start, end)
+        """
+        try:
+            tag = data[offset]
+            size = data[offset + 1]
+            valueStart = offset + 2
+            if size & 0x80:
+                count = size & 0x7f
+                if count == 0:
+                    # Indefinite length, BER only
+                    raise _Unsupported('Indefinite length encoding')
+                size = int.from_bytes(data[valueStart:valueStart + count], 'big')
+                valueStart += count
+        except IndexError:
+            raise DecodeError(ErrorCode.DATA_DECODING_FAILED,
+                              'Truncated DER data') from None
+
+        end = valueStart + size
+        if end > len(data):
+            raise DecodeError(ErrorCode.DATA_DECODING_FAILED,
+                              'Truncated DER data')
+
+        return tag, offset, valueStart, end
+
+    @staticmethod
+    def children(data, element):
+        _, _, offset, end = element
+        while offset < end:
+            child = _DER.read(data, offset)
+            yield child
+            offset = child[3]
+
+    @staticmethod
+    def value(data, element):
+        return data[element[2]:element[3]]
+
+    @staticmethod
+    def raw(data, element):
+        return data[element[1]:element[3]]
+
+    @staticmethod
+    def fromCMS(data):
+        """
+        : param data : CMS data in DER, PEM or S/MIME (application/pkcs7-mime)
+        : return : the DER encoding of data
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        if not data:
+            raise CryptoError(ErrorCode.INVALID_DATA)
+        if data[0] == _DER.SEQUENCE:
+            return data
+        if data.lstrip().startswith(b'-----BEGIN'):
+            body = [l for l in data.strip().splitlines()[1:-1] if b':' not in l]
+            return base64.b64decode(b''.join(body))
+
+        msg = email.message_from_bytes(data)
+        if msg.get_content_type() == 'multipart/signed':
+            # Detached signature, the SignedData is the signature part
+            for part in msg.get_payload():
+                if part.get_content_type() in ('application/pkcs7-signature',
+                                               'application/x-pkcs7-signature'):
+                    msg = part
+                    break
+        elif msg.get_content_type() not in ('application/pkcs7-mime',
+                                            'application/x-pkcs7-mime'):
+            raise _Unsupported('S/MIME type {}'.format(msg.get_content_type()))
+
+        return msg.get_payload(decode=True)
+
+
+class _NativeCMS(_CMS):
+    """
+    In-process implementation of the _CMS operations on top of the
+    cryptography package. Operations and encodings it does not implement
+    are handed to the openssl CLI backend.
+    """
+    _OID_DATA = '1.2.840.113549.1.7.1'
+    _OID_SIGNED_DATA = '1.2.840.113549.1.7.2'
+    _OID_CONTENT_TYPE = '1.2.840.113549.1.9.3'
+    _OID_MESSAGE_DIGEST = '1.2.840.113549.1.9.4'
+    _OID_RSASSA_PSS = '1.2.840.113549.1.1.10'
+
+    _DIGESTS = {
+        '1.3.14.3.2.26': 'SHA1',
+        '2.16.840.1.101.3.4.2.1': 'SHA256',
+        '2.16.840.1.101.3.4.2.2': 'SHA384',
+        '2.16.840.1.101.3.4.2.3': 'SHA512',
+        '2.16.840.1.101.3.4.2.4': 'SHA224',
+    }
+
+    _PEM_HEADER = b'-----BEGIN CMS-----'
+    _PEM_FOOTER = b'-----END CMS-----'
+
+    @staticmethod
+    def _form(encoding):
+        # openssl only looks at the first letter: DER, PEM, S/MIME
+        return encoding.upper()[0] if encoding else 'S'
+
+    def _toForm(self, der, outform):
+        form = self._form(outform)
+        if form == 'D':
+            return der
+        if form == 'P':
+            b64 = base64.b64encode(der)
+            lines = [b64[i:i + 64] for i in range(0, len(b64), 64)]
+            return b'\n'.join([self._PEM_HEADER] + lines + [self._PEM_FOOTER, b''])
+
+        raise _Unsupported('Output encoding {}'.format(outform))
+
+    def _toDER(self, data):
+        return _DER.fromCMS(data)
+
+    # Private keys loaded by _loadKey(), keyed by the digest of the PEM.
+    # Loading an RSA key checks it, which costs more than signing with it.
+    _keys = util.LRUCache(16)
+
+    @staticmethod
+    def _loadKey(inkey):
+        with open(inkey, 'rb') as f:
+            pem = f.read()
+        digest = hashlib.sha256(pem).digest()
+        key = _NativeCMS._keys.get(digest)
+        if key is None:
+            key = serialization.load_pem_private_key(pem, password=None)
+            _NativeCMS._keys.put(digest, key)
+
+        return key
+
+    # Recipient certificates loaded by _loadRecipient(), keyed by the digest
+    # of the file, so a certificate is parsed once however often it is used
+    _recipients = util.LRUCache(4096)
+
+    @staticmethod
+    def _loadRecipient(certfile):
+        with open(certfile, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).digest()
+        cert = _NativeCMS._recipients.get(digest)
+        if cert is None:
+            if b'-----BEGIN' in data:
+                cert = x509.load_pem_x509_certificates(data)[0]
+            else:
+                cert = x509.load_der_x509_certificate(data)
+            _NativeCMS._recipients.put(digest, cert)
+
+        return cert
+
+    @staticmethod
+    def _loadCerts(certfile):
+        if not certfile:
+            return []
+        with open(certfile, 'rb') as f:
+            data = f.read()
+        # openssl pkcs7 -print_certs writes subject= and issuer= lines
+        # before each certificate
+        if b'-----BEGIN' in data:
+            return x509.load_pem_x509_certificates(data)
+
+        return [x509.load_der_x509_certificate(data)]
+
+    def dataCreate(self, data, outform=_CMS._SMIME_ENCODING):
+        if data is None:
+            raise CryptoError(ErrorCode.INVALID_DATA)
+        data = self._bytes(data)
+        der = _DER.encode(
+            _DER.SEQUENCE,
+            _DER.encodeOID(self._OID_DATA) + _DER.encode(
+                _DER.CONTEXT_0, _DER.encode(_DER.OCTET_STRING, data)))
+        try:
+            return self._toForm(der, outform)
+        except _Unsupported:
+            return super().dataCreate(data, outform=outform)
+
+    def sign(self, data, inkey, signer, outform=_CMS._SMIME_ENCODING):
+        if data is None:
+            raise CryptoError(ErrorCode.INVALID_DATA)
+        if self._form(outform) not in 'DP':
+            return super().sign(data, inkey, signer, outform=outform)
+        # The PKCS7 builder only takes the content as a whole
+        data = self._bytes(data)
+
+        try:
+            key = self._loadKey(inkey)
+            cert = self._loadCerts(signer)[0]
+            # Same structure as 'openssl cms -sign -nodetach -binary':
+            # attached content, signer certificate and signed attributes
+            der = pkcs7.PKCS7SignatureBuilder().set_data(data).add_signer(
+                cert, key, hashes.SHA256()).sign(serialization.Encoding.DER,
+                                                 [pkcs7.PKCS7Options.Binary])
+        except (ValueError, TypeError, IndexError, OSError) as e:
+            raise CryptoError(ErrorCode.DATA_SIGNING_FAILED, e) from None
+
+        return self._toForm(der, outform)
+
+    def encrypt(self,
+                data,
+                cert,
+                inform=_CMS._DER_ENCODING,
+                outform=_CMS._DER_ENCODING):
+        if data is None:
+            raise CryptoError(ErrorCode.INVALID_DATA)
+        # The content encryption algorithm can be set from cryptography 45
+        if self._form(outform) not in 'DP' or not hasattr(
+                getattr(pkcs7, 'PKCS7EnvelopeBuilder', None),
+                'set_content_encryption_algorithm'):
+            return super().encrypt(data, cert, inform=inform, outform=outform)
+
+        try:
+            recipient = self._loadRecipient(cert)
+        except (ValueError, IndexError, OSError) as e:
+            raise CryptoError(ErrorCode.DATA_ENCRYPTION_FAILED, e) from None
+        if not isinstance(recipient.public_key(), rsa.RSAPublicKey):
+            # Key agreement recipients (EC keys) are left to openssl
+            return super().encrypt(data, cert, inform=inform, outform=outform)
+
+        try:
+            # Same structure as 'openssl cms -encrypt -binary -aes256'
+            der = pkcs7.PKCS7EnvelopeBuilder().set_data(
+                self._bytes(data)).add_recipient(
+                    recipient).set_content_encryption_algorithm(
+                        algorithms.AES256).encrypt(
+                            serialization.Encoding.DER,
+                            [pkcs7.PKCS7Options.Binary])
+        except (ValueError, TypeError) as e:
+            raise CryptoError(ErrorCode.DATA_ENCRYPTION_FAILED, e) from None
+
+        return self._toForm(der, outform)
+
+    def encode(self, data, encoding=_CMS._DER_ENCODING):
+        try:
+            return self._toForm(self._toDER(data), encoding)
+        except _Unsupported:
+            return super().encode(data, encoding=encoding)
+
+    def verify(self, data, cafile, certfile, inform=_CMS._SMIME_ENCODING):
+        try:
+            return self._verify(self._toDER(data), cafile, certfile)
+        except _Unsupported:
+            return super().verify(data, cafile, certfile, inform=inform)
+        except (ValueError, TypeError, OSError, DecodeError) as e:
+            raise CryptoError(ErrorCode.SIGNATURE_VERIFICATION_ON_DATA_FAILED,
+                              e) from None
+
+    def crl2pkcs7(self, cert, outform='DER'):
+        if self._form(outform) != 'D':
+            return super().crl2pkcs7(cert, outform=outform)
+        try:
+            certs = x509.load_pem_x509_certificates(cert.encode())
+        except ValueError as e:
+            raise CryptoError(ErrorCode.INVALID_DATA, e) from None
+
+        return pkcs7.serialize_certificates(certs, serialization.Encoding.DER)
+
+    def inspectCertificate(self, cert, privateKey=None):
+        try:
+            certificate = self._loadCerts(cert)[0]
+        except (ValueError, IndexError, OSError):
+            return 'Not a valid x509 PEM certificate', None, None
+        validity = (certificate.not_valid_before_utc,
+                    certificate.not_valid_after_utc)
+
+        try:
+            keyUsage = certificate.extensions.get_extension_for_class(
+                x509.KeyUsage).value
+            if not keyUsage.digital_signature:
+                return ('Certificate key usage does not allow digital signature',
+                        *validity)
+        except x509.ExtensionNotFound:
+            pass
+
+        if privateKey:
+            try:
+                key = self._loadKey(privateKey)
+            except (ValueError, TypeError, OSError):
+                return ('Not a valid PEM private key', *validity)
+            spki = (serialization.Encoding.DER,
+                    serialization.PublicFormat.SubjectPublicKeyInfo)
+            if key.public_key().public_bytes(*spki) != \
+                    certificate.public_key().public_bytes(*spki):
+                return ('Certificate does not match the private key',
+                        *validity)
+
+        return (None, *validity)
+
+    def _verify(self, der, cafile, certfile):
+        """
+        Verifies the signature of the SignedData in der and the chain of the
+        signer certificate up to a certificate in cafile, then returns the
+        signed content. Without cafile only the signature is verified.
+        """
+        contentInfo = list(_DER.children(der, _DER.read(der)))
+        if _DER.decodeOID(_DER.value(der, contentInfo[0])) != self._OID_SIGNED_DATA:
+            raise CryptoError(ErrorCode.SIGNATURE_VERIFICATION_ON_DATA_FAILED,
+                              'Not signed data')
+        signedData = next(_DER.children(der, contentInfo[1]))
+        fields = list(_DER.children(der, signedData))
+
+        encapContentInfo = list(_DER.children(der, fields[2]))
+        contentType = _DER.value(der, encapContentInfo[0])
+        if len(encapContentInfo) < 2:
+            raise _Unsupported('Detached content')
+        eContent = next(_DER.children(der, encapContentInfo[1]))
+        if eContent[0] != _DER.OCTET_STRING:
+            raise _Unsupported('Constructed content')
+        content = _DER.value(der, eContent)
+
+        certs = []
+        signerInfos = fields[-1]
+        for field in fields[3:-1]:
+            if field[0] == _DER.CONTEXT_0:
+                certs = [
+                    x509.load_der_x509_certificate(_DER.raw(der, c))
+                    for c in _DER.children(der, field) if c[0] == _DER.SEQUENCE
+                ]
+
+        if not cafile:
+            # Like openssl -noverify -nointern: the signer must be one of
+            # the certificates in certfile, its chain is not checked
+            certs = []
+        intermediates = certs + self._loadCerts(certfile)
+        trusted = self._loadCerts(cafile)
+        signers = list(_DER.children(der, signerInfos))
+        if not signers:
+            raise CryptoError(ErrorCode.SIGNATURE_VERIFICATION_ON_DATA_FAILED,
+                              'No signers')
+        for signerInfo in signers:
+            cert = self._verifySigner(der, signerInfo, content, contentType,
+                                      intermediates, checkValidity=bool(cafile))
+            if cafile and not self._chains(cert, trusted, intermediates):
+                raise CryptoError(
+                    ErrorCode.SIGNATURE_VERIFICATION_ON_DATA_FAILED,
+                    'Unable to get local issuer certificate')
+
+        return content
+
+    def _verifySigner(self, der, signerInfo, content, contentType, certs,
+                      checkValidity=True):
+        fields = list(_DER.children(der, signerInfo))
+        sid = fields[1]
+        cert = None
+        if sid[0] == _DER.SEQUENCE:
+            issuer, serial = list(_DER.children(der, sid))
+            serial = int.from_bytes(_DER.value(der, serial), 'big', signed=True)
+            issuer = _DER.raw(der, issuer)
+            cert = next((c for c in certs if c.serial_number == serial and
+                         c.issuer.public_bytes() == issuer), None)
+        else:
+            ski = _DER.value(der, sid)
+            for c in certs:
+                try:
+                    ext = c.extensions.get_extension_for_class(
+                        x509.SubjectKeyIdentifier)
+                except x509.ExtensionNotFound:
+                    continue
+                if ext.value.digest == ski:
+                    cert = c
+                    break
+        if cert is None:
+            raise CryptoError(ErrorCode.SIGNATURE_VERIFICATION_ON_DATA_FAILED,
+                              'Signer certificate not found')
+
+        digestOID = _DER.decodeOID(_DER.value(der, next(_DER.children(der, fields[2]))))
+        if digestOID not in self._DIGESTS:
+            raise _Unsupported('Digest {}'.format(digestOID))
+        digest = getattr(hashes, self._DIGESTS[digestOID])()
+
+        signed = content
+        index = 3
+        if fields[index][0] == _DER.CONTEXT_0:
+            attrs = fields[index]
+            # The signature covers the attributes DER encoded as a SET OF
+            signed = bytes([_DER.SET]) + _DER.raw(der, attrs)[1:]
+            self._checkSignedAttrs(der, attrs, content, contentType, digest)
+            index += 1
+
+        sigAlgOID = _DER.decodeOID(_DER.value(der, next(_DER.children(der, fields[index]))))
+        signature = _DER.value(der, fields[index + 1])
+
+        if checkValidity:
+            self._checkValidity(cert)
+        publicKey = cert.public_key()
+        try:
+            if isinstance(publicKey, rsa.RSAPublicKey):
+                if sigAlgOID == self._OID_RSASSA_PSS:
+                    raise _Unsupported('RSASSA-PSS signatures')
+                publicKey.verify(signature, signed, padding.PKCS1v15(), digest)
+            elif isinstance(publicKey, ec.EllipticCurvePublicKey):
+                publicKey.verify(signature, signed, ec.ECDSA(digest))
+            elif isinstance(publicKey, ed25519.Ed25519PublicKey):
+                publicKey.verify(signature, signed)
+            else:
+                raise _Unsupported('Key type {}'.format(type(publicKey)))
+        except InvalidSignature:
+            raise CryptoError(ErrorCode.SIGNATURE_VERIFICATION_ON_DATA_FAILED,
+                              'Signature failure') from None
+
+        return cert
+
+    def _checkSignedAttrs(self, der, attrs, content, contentType, digest):
+        values = dict()
+        for attr in _DER.children(der, attrs):
+            oid, attrValues = list(_DER.children(der, attr))
+            values[_DER.decodeOID(_DER.value(der, oid))] = _DER.value(
+                der, next(_DER.children(der, attrValues)))
+
+        h = hashes.Hash(digest)
+        h.update(content)
+        if values.get(self._OID_MESSAGE_DIGEST) != h.finalize():
+            raise CryptoError(ErrorCode.SIGNATURE_VERIFICATION_ON_DATA_FAILED,
+                              'Content digest mismatch')
+        if values.get(self._OID_CONTENT_TYPE) != contentType:
+            raise CryptoError(ErrorCode.SIGNATURE_VERIFICATION_ON_DATA_FAILED,
+                              'Content type mismatch')
+
+    @staticmethod
+    def _checkValidity(cert):
+        now = datetime.now(timezone.utc)
+        if not cert.not_valid_before_utc <= now <= cert.not_valid_after_utc:
+            raise CryptoError(ErrorCode.SIGNATURE_VERIFICATION_ON_DATA_FAILED,
+                              'Certificate {} is not valid at this time'.format(
+                                  cert.subject.rfc4514_string()))
+
+    @staticmethod
+    def _issuedBy(cert, issuer):
+        try:
+            cert.verify_directly_issued_by(issuer)
+        except (ValueError, TypeError, InvalidSignature):
+            return False
+
+        return True
+
+    def _chains(self, cert, trusted, intermediates, depth=8):
+        for ca in trusted:
+            # Like openssl, a trusted certificate is only a trust anchor when
+            # it is self-signed
+            if self._issuedBy(cert, ca) and self._issuedBy(ca, ca):
+                return True
+        if depth == 0:
+            return False
+        for issuer in intermediates:
+            if issuer != cert and self._issuedBy(cert, issuer):
+                self._checkValidity(issuer)
+                if self._chains(issuer, trusted, intermediates, depth - 1):
+                    return True
+
+        return False
+
+
+_BACKENDS = {'openssl': _CMS, 'native': _NativeCMS}
+
+
+def _nativeSupported():
+    """
+    : return : whether the installed cryptography package has what the
+               native backend uses, 42 or later
+    """
+    if x509 is None:
+        return False
+
+    return (hasattr(x509, 'load_pem_x509_certificates')
+            and hasattr(x509.Certificate, 'verify_directly_issued_by')
+            and hasattr(x509.Certificate, 'not_valid_before_utc')
+            and hasattr(x509.Certificate, 'not_valid_after_utc'))
+
+
+def getCMSBackend(name=None):
+    """
+    Returns an instance of the CMS backend
+    : param name : 'native' for the in-process cryptography based backend,
+                   'openssl' for the openssl CLI or None for the best
+                   available one
+    """
+    if name is None:
+        name = 'native' if _nativeSupported() else 'openssl'
+
+    if name not in _BACKENDS:
+        raise CryptoError(ErrorCode.INVALID_DATA,
+                          'Unknown CMS backend {}'.format(name))
+    if name == 'native' and not _nativeSupported():
+        raise CryptoError(ErrorCode.INVALID_DATA,
+                          'The native CMS backend requires the cryptography package, version 42 or later')
+
+    return _BACKENDS[name]()
@@ -0,0 +1,132 @@
+import os
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from . import util
+from .exceptions import *
+
+_BUF_SIZE = 8 * 1024 * 1024
+
+
+class _Progress:
+    """
+    Thread safe count of extracted bytes, printed every 10 percent
+    """
+    def __init__(self, name, total):
+        self.name = name
+        self.total = total
+        self.done = 0
+        self._reported = -1
+        self._lock = threading.Lock()
+
+    def update(self, size):
+        with self._lock:
+            self.done += size
+            percent = 100 * self.done // self.total if self.total else 100
+            if percent // 10 > self._reported:
+                self._reported = percent // 10
+                print('Extracting {}: {}%'.format(self.name, percent))
+
+
+class _Handles:
+    """
+    One handle on the archive per thread, opened for the first member the
+    thread extracts and reused for the next ones
+    """
+    def __init__(self, archive):
+        self.archive = archive
+        self._local = threading.local()
+        self._opened = list()
+        self._lock = threading.Lock()
+
+    def get(self):
+        zf = getattr(self._local, 'zf', None)
+        if zf is None:
+            zf = self._local.zf = zipfile.ZipFile(self.archive)
+            with self._lock:
+                self._opened.append(zf)
+
+        return zf
+
+    def close(self):
+        for zf in self._opened:
+            zf.close()
+
+
+def _target(outDir, name):
+    """
+    Path of member name under outDir, refusing names escaping outDir
+    """
+    parts = [p for p in name.replace('\\', '/').split('/') if p not in ('', '.')]
+    if os.path.isabs(name) or '..' in parts:
+        raise Error(ErrorCode.INVALID_DATA,
+                    'Unsafe path {} in archive'.format(name))
+
+    return os.path.join(outDir, *parts)
+
+
+def _extractMember(handles, info, outDir, hashAlgs, progress):
+    path = _target(outDir, info.filename)
+    if info.is_dir():
+        util.createDir(path)
+        return info.filename, None
+
+    util.createDir(os.path.dirname(path))
+    hashes = [hashAlg() for hashAlg in hashAlgs]
+    # Every thread reads through its own handle on the archive
+    with handles.get().open(info) as src, open(path, 'wb') as dst:
+        while True:
+            # The CRC-32 of the member is checked when the end is read
+            chunk = src.read(_BUF_SIZE)
+            if not chunk:
+                break
+            for sha in hashes:
+                sha.update(chunk)
+            dst.write(chunk)
+            progress.update(len(chunk))
+
+    return info.filename, [util.toHexString(sha.hexdigest()) for sha in hashes]
+
+
+def extract(archive, outDir, hashes=None, jobs=None):
+    """
+    Extracts the zip archive to outDir, decompressing the members in
+    parallel and checking their CRC-32.
+
+    : param hashes : {member name: [hashlib constructors]}, these members
+                     are hashed while they are extracted
+    : param jobs : number of extraction threads, defaults to the number of
+                   CPUs up to 8
+    : return : {member name: [hash values in RFC 8572 format]} for the
+               members in hashes
+    """
+    hashes = hashes or dict()
+    if not zipfile.is_zipfile(archive):
+        raise Error(ErrorCode.INVALID_DATA,
+                    '{} is not a zip file'.format(archive))
+    if jobs is None:
+        jobs = min(os.cpu_count() or 1, 8)
+
+    with zipfile.ZipFile(archive) as zf:
+        members = zf.infolist()
+    # Largest members first so that the biggest one does not start last
+    members.sort(key=lambda info: info.file_size, reverse=True)
+    progress = _Progress(os.path.basename(archive),
+                         sum(info.file_size for info in members))
+
+    handles = _Handles(archive)
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            results = list(
+                executor.map(
+                    lambda info: _extractMember(handles, info, outDir,
+                                                hashes.get(info.filename, []),
+                                                progress), members))
+    except zipfile.BadZipFile as e:
+        raise Error(ErrorCode.INVALID_DATA,
+                    'Corrupted archive {}: {}'.format(archive, e)) from None
+    finally:
+        handles.close()
+
+    return {name: digests for name, digests in results if name in hashes}
@@ -0,0 +1,275 @@
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from . import util
+from .crypto import PKCS7
+
+
+class DigestCache:
+    """
+    On-disk cache of image digests shared by all the runs on a host.
+
+    Entries are keyed by (path, size, mtime_ns, inode, algorithm), so any
+    change to the file invalidates its digest. The cache holds at most
+    maxEntries digests, the least recently used ones are evicted first.
+    In strict mode every image is hashed again and a stale cached digest
+    is replaced. The maxEntries most recently used digests are also kept
+    in memory, for processes hashing many times like the build daemon;
+    without a path they are only kept in memory. Cache hits only update
+    the least recently used order in memory, it is written by the next
+    put() or by flush().
+    """
+    DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.cache',
+                                'sztp-usb-loader', 'digests.json')
+    _DEFAULT_MAX_ENTRIES = 256
+
+    def __init__(self, path=DEFAULT_PATH, maxEntries=_DEFAULT_MAX_ENTRIES,
+                 strict=False):
+        self.path = path
+        self.maxEntries = maxEntries
+        self.strict = strict
+        self._memory = util.LRUCache(maxEntries)
+        # Time of the last use of the entries read since the last write
+        self._hits = dict()
+        if self.path:
+            util.createDir(os.path.dirname(os.path.abspath(self.path)))
+
+    @staticmethod
+    def _key(fileName, alg):
+        st = os.stat(fileName)
+        return '|'.join([
+            os.path.realpath(fileName),
+            str(st.st_size),
+            str(st.st_mtime_ns),
+            str(st.st_ino), alg
+        ])
+
+    @contextmanager
+    def _locked(self):
+        """
+        Serializes the read-modify-write of the cache file between threads
+        and processes, yields the entries and saves them back on exit
+        """
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                entries = self._load()
+                yield entries
+                self._save(entries)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+        return entries if isinstance(entries, dict) else dict()
+
+    def _save(self, entries):
+        if len(entries) > self.maxEntries:
+            lru = sorted(entries, key=lambda k: entries[k]['used'])
+            for key in lru[:len(entries) - self.maxEntries]:
+                del entries[key]
+
+        # Write a new file and rename it, readers never see a partial file
+        fd, tmpPath = tempfile.mkstemp(prefix='.digests-',
+                                       dir=os.path.dirname(
+                                           os.path.abspath(self.path)))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmpPath, self.path)
+        except OSError:
+            util.removeFiles([tmpPath])
+            raise
+
+    def get(self, fileName, alg):
+        key = self._key(fileName, alg)
+        hashValue = self._memory.get(key)
+        if hashValue is None and self.path:
+            # The file is replaced as a whole, it is read without the lock
+            entry = self._load().get(key)
+            hashValue = entry['hash'] if entry else None
+            if hashValue is not None:
+                self._memory.put(key, hashValue)
+        if hashValue is not None and self.path:
+            self._hits[key] = time.time()
+
+        return hashValue
+
+    def put(self, fileName, alg, hashValue):
+        key = self._key(fileName, alg)
+        self._memory.put(key, hashValue)
+        if not self.path:
+            return
+        with self._locked() as entries:
+            self._touch(entries)
+            entries[key] = {'hash': hashValue, 'used': time.time()}
+
+    def flush(self):
+        """
+        Writes the use of the entries read since the last write, once per
+        run rather than once per cache hit
+        """
+        if not self._hits:
+            return
+        with self._locked() as entries:
+            self._touch(entries)
+
+    def _touch(self, entries):
+        hits, self._hits = self._hits, dict()
+        for key, used in hits.items():
+            if key in entries:
+                entries[key]['used'] = max(entries[key]['used'], used)
+
+    def genHashes(self, fileName, algs, hashMethods):
+        """
+        Returns the digests of fileName from the cache, hashing the file
+        only when one of them is missing or in strict mode
+        : param algs : names of the algorithms, e.g. ['sha-256']
+        : param hashMethods : hashlib constructors of algs
+        """
+        if not self.strict:
+            cached = [self.get(fileName, alg) for alg in algs]
+            if None not in cached:
+                return cached
+
+        hashValues = util.genHashes(fileName, hashMethods)
+        for alg, hashValue in zip(algs, hashValues):
+            self.put(fileName, alg, hashValue)
+
+        return hashValues
+
+
+class _HashWriter:
+    """
+    Binary file-like sink feeding everything written to it to a hash
+    """
+    def __init__(self, sha):
+        self.sha = sha
+
+    def write(self, data):
+        self.sha.update(data)
+        return len(data)
+
+
+class SignedCache:
+    """
+    Cache of signed CMS artifacts, so identical content signed by the same
+    owner certificate and key is signed only once. It also holds the owner
+    certificate PKCS#7 degenerate forms, keyed by their certificate chain.
+
+    Entries are keyed by the SHA-256 of the content together with the
+    digests of the signer certificate and private key files. They are
+    kept in memory for the process, the most recently used maxEntries
+    ones, and written to directory when one is given.
+    """
+    DEFAULT_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                               'sztp-usb-loader', 'signed')
+    _DEFAULT_MAX_ENTRIES = 64
+    _EXT = '.cms'
+
+    def __init__(self, directory=None, maxEntries=_DEFAULT_MAX_ENTRIES):
+        self.directory = directory
+        self.maxEntries = maxEntries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if self.directory:
+            util.createDir(self.directory)
+
+    @staticmethod
+    def key(data, certificates):
+        """
+        : param data : str, bytes or a callable writing the content to the
+                       binary file it is given
+        : param certificates : ownerCert and ownerPrivateKey paths
+        """
+        content = hashlib.sha256()
+        if callable(data):
+            data(_HashWriter(content))
+        else:
+            content.update(data.encode() if isinstance(data, str) else data)
+
+        sha = hashlib.sha256(content.digest())
+        for f in (certificates.ownerCert, certificates.ownerPrivateKey):
+            sha.update(hashlib.sha256(util.readFromFile(f)).digest())
+
+        return sha.hexdigest()
+
+    @staticmethod
+    def degenerateKey(certChain):
+        """
+        Key of the owner certificate PKCS#7 degenerate form of certChain,
+        which depends on the certificates only
+        """
+        return hashlib.sha256(b'degenerate:' + PKCS7.chainKey(
+            certChain).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self._EXT)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        if not self.directory:
+            return None
+        try:
+            data = util.readFromFile(self._path(key))
+        except OSError:
+            return None
+        self._remember(key, data)
+
+        return data
+
+    def put(self, key, data):
+        self._remember(key, data)
+        if not self.directory:
+            return
+
+        fd, tmpPath = tempfile.mkstemp(prefix='.signed-', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmpPath, self._path(key))
+        except OSError:
+            util.removeFiles([tmpPath])
+            raise
+        self._prune()
+
+    def _remember(self, key, data):
+        with self._lock:
+            self._entries[key] = data
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxEntries:
+                self._entries.popitem(last=False)
+
+    def _prune(self):
+        # Keep the maxEntries most recently written files
+        files = [
+            os.path.join(self.directory, f) for f in os.listdir(self.directory)
+            if f.endswith(self._EXT)
+        ]
+        if len(files) <= self.maxEntries:
+            return
+        mtimes = dict()
+        for f in files:
+            try:
+                mtimes[f] = os.stat(f).st_mtime_ns
+            except FileNotFoundError:
+                # Pruned by another run in the meantime
+                continue
+        files = sorted(mtimes, key=mtimes.get)
+        util.removeFiles(files[:max(len(files) - self.maxEntries, 0)])
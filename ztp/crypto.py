@@ -1,8 +1,9 @@
+import hashlib
 import json
 import os
 
 from . import util
-from ._cms import _CMS, _CRL2PKCS7, _PKCS7, CMSType, _ContentType
+from ._cms import _PKCS7, CMSType, _ContentType, checkValidity, getCMSBackend
 from .exceptions import *
 
 
@@ -10,21 +11,32 @@ class CMS:
     DER_ENCODING = 'DER'
     SMIME_ENCODING = 'S/MIME'
 
+    # CMS backend, 'native', 'openssl' or None for the best available one
+    backend = None
+
     def __init__(self, data, certificates, encoding=SMIME_ENCODING):
         self.data = data
         self.encoding = encoding
         self.certificates = certificates
 
-        self._cms = _CMS()
+        self._cms = getCMSBackend(CMS.backend)
         self._oid = _ContentType()
 
         self.contentType = None
 
+    def _input(self):
+        # self.data is str, bytes or a callable writing the data to the
+        # binary file it is given
+        if isinstance(self.data, str):
+            return self.data.encode()
+
+        return self.data
+
     def _updateContentType(self):
-        self.contentType = self._oid.getContentType(cmsData=self.cmsout())
+        self.contentType = self._oid.getContentType(cmsData=self.data)
 
     def create(self, outform=SMIME_ENCODING):
-        self.data = self._cms.dataCreate(data=self.data.encode(),
+        self.data = self._cms.dataCreate(data=self._input(),
                                          outform=outform)
         return self
 
@@ -37,7 +49,7 @@ class CMS:
             privateKey = self.certificates.ownerPrivateKey
         if cert is None:
             cert = self.certificates.ownerCert
-        self.data = self._cms.sign(data=self.data.encode(),
+        self.data = self._cms.sign(data=self._input(),
                                    inkey=privateKey,
                                    signer=cert,
                                    outform=outform)
@@ -49,15 +61,21 @@ class CMS:
                                      outform=outform)
         return self
 
-    def verify(self, cafile=None, certfile=None):
+    def verify(self, cafile=None, certfile=None, inform=SMIME_ENCODING):
+        """
+        Verifies the signature and replaces the data with the signed
+        content. Without a cafile, nor an ownerRootCert, only the signature
+        by a certificate of certfile is checked, not its chain.
+        """
         if not cafile:
-            cafile = self.certificates.ownerRootCert
+            cafile = self.certificates.get('ownerRootCert')
         if not certfile:
             certfile = self.certificates.ownerCert
 
         self.data = self._cms.verify(data=self.data,
                                      cafile=cafile,
-                                     certfile=certfile)
+                                     certfile=certfile,
+                                     inform=inform)
         return self
 
     def encrypt(self, cert=None, inform=SMIME_ENCODING, outform=SMIME_ENCODING):
@@ -95,7 +113,14 @@ class CMS:
         return self._cms.cmsout(self.data)
 
     def getContentType(self):
-        return self._oid.getContentType(self.cmsout())
+        return self._oid.getContentType(self.data)
+
+    def getInnerContentType(self):
+        """
+        : return : OID of the content type of the signed or enveloped data,
+                   None for the other CMS types
+        """
+        return self._oid.getInnerContentTypeOID(self.data)
 
     def isSigned(self):
         return self.getContentType() == CMSType.SIGNED
@@ -139,14 +164,36 @@ def getCertificates():
 
 
 class PKCS7:
+    # Results of createDegenerateForm(), keyed by the digest of the chain,
+    # for the most recently used chains
+    _degenerate = util.LRUCache(16)
+
     @staticmethod
     def createDegenerateForm(certChain):
         """
-        Creates PKCS7 degenerate form
-        :param certChain: X509 certificate chain in PEM encoding
+        Creates PKCS7 degenerate form. It only depends on the certificates,
+        so it is built once per chain and process.
+        :param certChain: X509 certificate chain in PEM encoding, the owner
+                          certificate followed by its intermediates
         :return: Degenerate form CMS data in DER encoding
         """
-        return _CRL2PKCS7.pkcs7(certChain)
+        key = PKCS7.chainKey(certChain)
+        degenerate = PKCS7._degenerate.get(key)
+        if degenerate is None:
+            degenerate = getCMSBackend(CMS.backend).crl2pkcs7(certChain)
+            PKCS7._degenerate.put(key, degenerate)
+
+        return degenerate
+
+    @staticmethod
+    def chainKey(certChain):
+        """
+        : return : the SHA-256 of a PEM certificate chain
+        """
+        if isinstance(certChain, str):
+            certChain = certChain.encode()
+
+        return hashlib.sha256(certChain).hexdigest()
 
     @staticmethod
     def extractX509Certs(data):
@@ -159,6 +206,35 @@ class PKCS7:
 
 
 class X509:
+    # Results of inspectCertificate(), keyed by the digest of the
+    # certificate and key, for the most recently checked ones
+    _checked = util.LRUCache(64)
+
+    @staticmethod
+    def check(cert, privateKey=None):
+        """
+        Checks that cert is a PEM X.509 certificate within its validity
+        period, whose key usage allows signing and that matches privateKey.
+        The certificate is parsed once per process and content, its
+        validity period is checked against the time of every call.
+        : return : None when the certificate is fine, the reason otherwise
+        """
+        sha = hashlib.sha256(util.readFromFile(cert))
+        if privateKey:
+            sha.update(hashlib.sha256(util.readFromFile(privateKey)).digest())
+        key = sha.hexdigest()
+
+        checked = X509._checked.get(key)
+        if checked is None:
+            checked = getCMSBackend(CMS.backend).inspectCertificate(
+                cert, privateKey)
+            X509._checked.put(key, checked)
+        problem, notBefore, notAfter = checked
+        if notBefore is None:
+            return problem
+
+        return checkValidity(notBefore, notAfter) or problem
+
     @staticmethod
     def isValid(cert, encoding):
         cmd = ['openssl', 'x509', '-in', cert, '-inform', encoding, '-noout']
@@ -0,0 +1,107 @@
+import json
+import os
+import socket
+import socketserver
+import time
+
+from .exceptions import *
+
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves jobs on a Unix domain socket.
+
+    A job is one line of JSON, answered by one line of JSON, and a
+    connection may send any number of them. The jobs of the connections
+    run on their own threads; runJob is called with the decoded job and
+    returns the JSON serializable answer. An Error it raises is answered
+    with "ok": false, it does not stop the server.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, runJob):
+        self.path = path
+        self.runJob = runJob
+        if os.path.exists(path):
+            self._removeStaleSocket(path)
+        # Jobs name files to read and sign with, only the owner submits
+        # them. The socket is created with these permissions, so no other
+        # user can connect before a chmod.
+        umask = os.umask(0o077)
+        try:
+            super().__init__(path, _JobHandler)
+        finally:
+            os.umask(umask)
+
+    @staticmethod
+    def _removeStaleSocket(path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(path)
+            except OSError:
+                # Left over by a daemon which did not exit cleanly
+                os.unlink(path)
+                return
+
+        raise Error(errorCode=ErrorCode.INVALID_DATA,
+                    error='A daemon is already serving on {}'.format(path))
+
+    def answer(self, job):
+        start = time.perf_counter()
+        try:
+            if not isinstance(job, dict):
+                raise Error(errorCode=ErrorCode.INVALID_DATA,
+                            error='A job is a JSON object')
+            answer = self.runJob(job)
+        except Error as e:
+            answer = {'ok': False, 'error': str(e)}
+        except Exception as e:
+            # A bad job must not take the daemon down
+            answer = {'ok': False, 'error': '{}: {}'.format(
+                type(e).__name__, e)}
+        answer.setdefault('timings', dict())['total'] = \
+            time.perf_counter() - start
+        if isinstance(job, dict) and 'id' in job:
+            answer['id'] = job['id']
+
+        return answer
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError as e:
+                answer = {'ok': False, 'error': 'Invalid job. {}'.format(e)}
+            else:
+                answer = self.server.answer(job)
+            self.wfile.write(json.dumps(answer).encode() + b'\n')
+
+
+def submit(path, job, timeout=None):
+    """
+    Runs job on the daemon serving on path
+    : return : the answer of the daemon
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        with sock.makefile('rwb') as f:
+            f.write(json.dumps(job).encode() + b'\n')
+            f.flush()
+            line = f.readline()
+    if not line:
+        raise Error(errorCode=ErrorCode.INVALID_DATA,
+                    error='The daemon closed the connection')
+
+    return json.loads(line)
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import tempfile
+
+from . import util
+
+
+class BuildManifest:
+    """
+    Build manifest of an output directory, kept in the user cache
+    directory of the host rather than on the USB media shipped to the
+    device, one file per output directory.
+
+    It records the fingerprint of the inputs every output was generated
+    from together with the size and mtime of the output, and the identity
+    (path, size, mtime_ns, inode) and digests of the images, so a later
+    run regenerates only the outputs whose inputs changed and neither
+    re-hashes nor re-copies unchanged images. An output changed or
+    replaced since, e.g. by another drive mounted on the same path, is
+    generated again.
+    """
+    DEFAULT_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                               'sztp-usb-loader', 'builds')
+    # Written in the output directory by the previous versions
+    _LEGACY_FILE = '.sztp-build.json'
+    _VERSION = 2
+
+    def __init__(self, outDir, directory=DEFAULT_DIR):
+        self.outDir = outDir
+        self.directory = directory
+        key = hashlib.sha256(os.path.realpath(outDir).encode()).hexdigest()
+        self.path = os.path.join(directory, key + '.json')
+        self._data = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = None
+
+        if not isinstance(data, dict) or data.get('version') != self._VERSION:
+            data = {'version': self._VERSION, 'outputs': {}, 'files': {}}
+        data['outDir'] = os.path.realpath(self.outDir)
+
+        return data
+
+    def reset(self):
+        self._data['outputs'] = dict()
+        self._data['files'] = dict()
+
+    def save(self):
+        util.createDir(self.directory)
+        fd, tmpPath = tempfile.mkstemp(prefix='.build-', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._data, f, indent=1, sort_keys=True)
+            os.replace(tmpPath, self.path)
+        except OSError:
+            util.removeFiles([tmpPath])
+            raise
+        util.removeFiles([os.path.join(self.outDir, self._LEGACY_FILE)])
+
+    @staticmethod
+    def identity(path):
+        """
+        : return : identity of the file at path, None if it does not exist
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        return [os.path.realpath(path), st.st_size, st.st_mtime_ns, st.st_ino]
+
+    @staticmethod
+    def fingerprint(*inputs):
+        """
+        : param inputs : JSON serializable description of the inputs
+        """
+        return hashlib.sha256(json.dumps(inputs).encode()).hexdigest()
+
+    def _relPath(self, path):
+        return os.path.relpath(path, self.outDir)
+
+    @staticmethod
+    def _outputIdentity(output):
+        try:
+            st = os.stat(output)
+        except OSError:
+            return None
+
+        return [st.st_size, st.st_mtime_ns]
+
+    def isCurrent(self, output, fingerprint):
+        """
+        True when output was built from inputs with fingerprint and was not
+        changed since
+        """
+        identity = self._outputIdentity(output)
+        return identity is not None and self._data['outputs'].get(
+            self._relPath(output)) == {'fingerprint': fingerprint,
+                                       'identity': identity}
+
+    def recordOutput(self, output, fingerprint):
+        self._data['outputs'][self._relPath(output)] = {
+            'fingerprint': fingerprint,
+            'identity': self._outputIdentity(output),
+        }
+
+    def recordFile(self, path, digests, source=None):
+        """
+        Records the digests of the file at path. source is the file path was
+        copied or extracted from.
+        : param digests : {algorithm: hash value}
+        """
+        self._data['files'][os.path.realpath(path)] = {
+            'identity': self.identity(path),
+            'source': self.identity(source) if source else None,
+            'digests': dict(digests),
+        }
+
+    def fileDigests(self, path, algs, source=None):
+        """
+        : return : the recorded digests of path for algs if neither path nor
+                   its source changed since they were recorded, otherwise
+                   None
+        """
+        entry = self._data['files'].get(os.path.realpath(path))
+        if entry is None or entry['identity'] != self.identity(path):
+            return None
+        if source and entry['source'] != self.identity(source):
+            return None
+        if any(alg not in entry['digests'] for alg in algs):
+            return None
+
+        return [entry['digests'][alg] for alg in algs]
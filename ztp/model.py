@@ -1,13 +1,19 @@
 import base64
+import copy
 import hashlib
 import json
 import os
+import re
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlunparse
 
 from . import util
 #Internal
 from .crypto import CMS, PKCS7, getCertificates
 from .exceptions import *
+from .profiling import Profile
 
 CONFIG_FILE = 'configuration-file'
 PRE_CONFIG = 'pre-configuration-script-file'
@@ -60,14 +66,20 @@ class ProvisioningData:
                  osVersion=None,
                  imagePath=None,
                  hashAlg='sha-256',
-                 usbRootDirs=None):
+                 usbRootDirs=None,
+                 imageCopyDir=None,
+                 digestCache=None,
+                 imageDigests=None):
         self.bootImage = None
         if imagePath:
             self.bootImage = Image(osName=osName,
                                    osVersion=osVersion,
                                    paths=imagePath,
                                    hashAlg=hashAlg,
-                                   rootPath=usbRootDirs)
+                                   rootPath=usbRootDirs,
+                                   copyDir=imageCopyDir,
+                                   digestCache=digestCache,
+                                   digests=imageDigests)
 
         self.configHandle = configHandle
         self.preConfigScript = preConfigScript
@@ -76,10 +88,12 @@ class ProvisioningData:
 
 
 class BootstrapData:
-    def __init__(self, pd=None, oc=None, ov=None, certificates=None, bootable=False, genActions=False):
+    @Profile.timed('BootstrapData')
+    def __init__(self, pd=None, oc=None, ov=None, certificates=None, bootable=False, genActions=False, signedCache=None, ocChain=None):
         self.ci = None
         self.pd = pd
         self.certificates = certificates
+        self.signedCache = signedCache
         self.bootable = bootable
         self.genActions = genActions
         self.oi = OnboardingInformation(
@@ -89,32 +103,60 @@ class BootstrapData:
             configFile=self.pd.configuration,
             postConfigScript=self.pd.postConfigScript,
             config=self.pd.configuration)
-        self.ci = self._prepareOI()
-        self.actions = self._prepareActions()
-
-        self.ownerCertificate = OwnerCertificate(cert=oc)
-        self.oc = self._prepareOC()
+        self.ownerCertificate = OwnerCertificate(cert=oc, chain=ocChain)
+        # The artifacts are independent. With the openssl backend each of
+        # them is an openssl run, so they are made at the same time.
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            ci = executor.submit(self._prepareOI)
+            actions = executor.submit(self._prepareActions)
+            oc = executor.submit(self._prepareOC)
+            self.ci = ci.result()
+            self.actions = actions.result()
+            self.oc = oc.result()
         self.ownershipVoucher = OwnershipVoucher(voucher=ov)
         self.ov = self._prepareOV()
 
+    def withVoucher(self, ov):
+        """
+        Returns a copy of this bootstrapping data using ov as the ownership
+        voucher. The signed conveyed-information, actions and owner
+        certificate are shared with the copy, so nothing is signed again.
+        """
+        bsd = copy.copy(self)
+        bsd.ownershipVoucher = OwnershipVoucher(voucher=ov)
+        bsd.ov = bsd._prepareOV()
+
+        return bsd
+
     def _prepareActions(self):
         if self.bootable or self.genActions:
             actionDict = {'actions':{}}
             actionDict['actions']['reload-bootmedia-usb'] = True
             actionData = json.dumps(actionDict)
-            actionData = self._cmsEncode(actionData, sign=True)
+            actionData = self._sign(actionData)
         else:
             actionData = None
         return actionData
 
     def _prepareOI(self):
-        data = json.dumps(self.oi.serialize())
-        data = self._cmsEncode(data, sign=True)
+        # The onboarding information is streamed into the CMS input
+        data = self._sign(self.oi.write)
 
         return data
 
+    @Profile.timed('prepareOC')
     def _prepareOC(self):
-        degenerateData = PKCS7.createDegenerateForm(self.ownerCertificate.cert)
+        if self.ownerCertificate.cert is None:
+            return None
+        if self.signedCache is None:
+            return PKCS7.createDegenerateForm(self.ownerCertificate.cert)
+
+        key = self.signedCache.degenerateKey(self.ownerCertificate.cert)
+        degenerateData = self.signedCache.get(key)
+        if degenerateData is None:
+            degenerateData = PKCS7.createDegenerateForm(
+                self.ownerCertificate.cert)
+            self.signedCache.put(key, degenerateData)
 
         return degenerateData
 
@@ -124,7 +166,29 @@ class BootstrapData:
 
         return self.ownershipVoucher.voucher
 
-    def _cmsEncode(self, data, sign=True, encrypt=False):
+    def _sign(self, data):
+        """
+        Signs data, reusing the signed artifact from the signed cache when
+        the same content was already signed with the same certificate
+        """
+        if self.signedCache is None:
+            return self._cmsEncode(data, sign=True)
+
+        key = self.signedCache.key(data, self.certificates)
+        signed = self.signedCache.get(key)
+        if signed is None:
+            signed = self._cmsEncode(data, sign=True)
+            self.signedCache.put(key, signed)
+
+        return signed
+
+    @Profile.timed('cmsEncode')
+    def _cmsEncode(self, data, sign=True, encryptCert=None):
+        """
+        : param encryptCert : device certificate to encrypt the CMS for, the
+                              signed data is then the content of the
+                              enveloped data
+        """
         try:
             cmsData = CMS(data, self.certificates)
         except CryptoError as e:
@@ -138,13 +202,26 @@ class BootstrapData:
         else:
             cmsData.create(outform=CMS.DER_ENCODING)
 
-        if encrypt:
-            cmsData.encrypt(cert=self.configIni.encryptCert,
+        if encryptCert:
+            cmsData.encrypt(cert=encryptCert,
                             inform=CMS.DER_ENCODING,
                             outform=CMS.DER_ENCODING)
 
         return cmsData.data
 
+    def encryptCI(self, cert):
+        """
+        Encrypts the conveyed information for one device. It is signed once
+        for all the devices, only the encryption is per device.
+        : param cert : path to the device (IDevID) certificate
+        : return : the enveloped signed conveyed information
+        """
+        with Profile.span('encryptCI', len(self.ci)):
+            return CMS(self.ci, self.certificates).encrypt(
+                cert=cert,
+                inform=CMS.DER_ENCODING,
+                outform=CMS.DER_ENCODING).data
+
     def serialize(self):
         d = {"{}".format(CONVEYED_INFO): self.ci}
 
@@ -161,8 +238,14 @@ class BootstrapData:
 
 
 class OwnerCertificate:
-    def __init__(self, cert=None):
+    def __init__(self, cert=None, chain=None):
+        """
+        : param chain : paths of PEM files with the intermediate
+                        certificates, appended to cert in the owner
+                        certificate artifact
+        """
         self._certPath = cert
+        self._chainPaths = chain or list()
         self.cert = self._getCert()
 
     def _getCert(self):
@@ -170,7 +253,13 @@ class OwnerCertificate:
             return None
 
         with open(self._certPath, 'r') as cert:
-            return cert.read()
+            pem = cert.read()
+        # The owner certificate comes first, then its intermediates
+        for path in self._chainPaths:
+            with open(path, 'r') as chain:
+                pem = pem.rstrip('\n') + '\n' + chain.read()
+
+        return pem
 
 
 class OwnershipVoucher:
@@ -187,20 +276,86 @@ class OwnershipVoucher:
 
 
 class Image:
+    _DEFAULT_HASH_ALG = 'sha-256'
+    _HASH_ALG_PREFIX = 'ietf-sztp-conveyed-info:'
+
     def __init__(self,
                  osName=None,
                  osVersion=None,
                  paths=None,
                  hashAlg=None,
-                 rootPath=None):
+                 rootPath=None,
+                 copyDir=None,
+                 digestCache=None,
+                 digests=None,
+                 jobs=None):
+        """
+        : param hashAlg : hash algorithm or list of hash algorithms, one
+                          image-verification entry is generated per
+                          algorithm
+        : param digests : known digests of source images, by path, in the
+                          order of the algorithms. These images are neither
+                          hashed nor copied again.
+        : param jobs : maximum number of images hashed (and copied) at the
+                       same time, the number of CPUs by default
+        """
         self.OSName = osName
         self.OSVersion = osVersion
         self._paths = paths
         self._rootPaths = rootPath
         self.imageUrls = self._createFileURI()
-        self.hashAlg = hashAlg
-        _hashMethod = self._gethashAlg(self.hashAlg)
-        self.imgHash = [util.genHash(i, _hashMethod) for i in self._paths['src']]
+        self.hashAlgs = self.normalizeHashAlgs(hashAlg)
+        self.hashAlg = self.hashAlgs[0]
+        self._digestCache = digestCache
+        _hashMethods = [self._gethashAlg(alg) for alg in self.hashAlgs]
+        if None in _hashMethods:
+            raise Error(errorCode=ErrorCode.INVALID_DATA,
+                        error='Unsupported image hash algorithm {}'.format(
+                            hashAlg))
+        # Each image is read at most once, all its digests are computed in
+        # that pass and reused for all the download-uri entries of the image
+        digests = digests or dict()
+
+        def digest(paths):
+            src, dest = paths
+            if src in digests:
+                return digests[src]
+            if copyDir:
+                return self._copy(src, os.path.join(copyDir, dest),
+                                  _hashMethods)
+            return self._hash(src, _hashMethods)
+
+        # The images are processed concurrently, so the wall time is about
+        # that of the largest image rather than the sum
+        images = list(zip(self._paths['src'], self._paths['dest']))
+        workers = min(jobs or os.cpu_count() or 1,
+                      len([src for src, _ in images if src not in digests]))
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                self.imgHash = list(executor.map(digest, images))
+        else:
+            self.imgHash = [digest(paths) for paths in images]
+
+    def _hash(self, src, hashMethods):
+        if self._digestCache is None:
+            return util.genHashes(src, hashMethods)
+
+        return self._digestCache.genHashes(src, self.hashAlgs, hashMethods)
+
+    def _copy(self, src, dest, hashMethods):
+        """
+        Copies the image to dest, hashing it while it is being copied
+        """
+        util.createDir(os.path.dirname(dest))
+        imgHash = util.copyAndHash(src, dest, hashMethods)
+        print('Copied image to {}'.format(dest))
+        if self._digestCache is not None:
+            # Later runs pointing --image-url at the copy skip hashing it
+            for alg, hashValue in zip(self.hashAlgs, imgHash):
+                self._digestCache.put(src, alg, hashValue)
+                self._digestCache.put(dest, alg, hashValue)
+
+        return imgHash
 
     def _createFileURI(self):
         if not self._rootPaths:
@@ -215,7 +370,47 @@ class Image:
 
         return imgPaths
 
-    def _gethashAlg(self, alg):
+    @classmethod
+    def normalizeHashAlg(cls, alg):
+        """
+        Returns the hash algorithm identity without the module prefix,
+        e.g. 'ietf-sztp-conveyed-info:sha-256' -> 'sha-256'
+        """
+        if not alg:
+            return cls._DEFAULT_HASH_ALG
+
+        return alg.split(':')[-1].strip().lower()
+
+    @classmethod
+    def normalizeHashAlgs(cls, algs):
+        """
+        Normalizes a hash algorithm, a comma separated list or a list of
+        them, dropping duplicates
+        : return : list of hash algorithm identities
+        """
+        if not algs:
+            return [cls._DEFAULT_HASH_ALG]
+        if isinstance(algs, str):
+            algs = [algs]
+
+        normalized = list()
+        for alg in (a for entry in algs for a in entry.split(',')):
+            alg = cls.normalizeHashAlg(alg)
+            if alg not in normalized:
+                normalized.append(alg)
+
+        return normalized
+
+    @classmethod
+    def hashMethod(cls, alg):
+        """
+        : return : hashlib constructor of the hash algorithm alg, None when
+                   it is not supported
+        """
+        return cls._gethashAlg(cls.normalizeHashAlg(alg))
+
+    @staticmethod
+    def _gethashAlg(alg):
         """
         Creates hashlib object based on algorithm mentioned
 
@@ -236,14 +431,17 @@ class Image:
             return None
 
     def serialize(self):
-        # Compute hashes of the images in self._paths and repeat each of them same times
-        # as the number of root directories
-        # eg: if there are two images(image1.iso and image2.iso), self._rootPaths = ['/disk2:', '/disk3:]
-        #     imageVerification = [hash1, hash1, hash2, hash2]
+        # image-verification is a list keyed by hash-algorithm: each image
+        # has one entry per algorithm, whichever root directory its
+        # download-uri entries are in
+        # eg: with two images(image1.iso and image2.iso), self._rootPaths = ['/disk2:', '/disk3:]
+        #     and sha-256 and sha-384:
+        #     imageVerification = [hash1-sha256, hash1-sha384, hash2-sha256, hash2-sha384]
         imageVerification = [{
-            'hash-algorithm': 'ietf-sztp-conveyed-info:{}'.format(self.hashAlg),
-            'hash-value': util.genHash(i)
-        } for i in self._paths['src'] for _ in self._rootPaths]
+            'hash-algorithm': '{}{}'.format(self._HASH_ALG_PREFIX, alg),
+            'hash-value': hashValue
+        } for imgHash in self.imgHash
+          for alg, hashValue in zip(self.hashAlgs, imgHash)]
 
         bi = {
             "os-name": self.OSName,
@@ -256,6 +454,10 @@ class Image:
 
 
 class OnboardingInformation:
+    # Stands for a file in the JSON written by write(). The token is drawn
+    # for each call, so no other value can contain the placeholder.
+    _FILE_PLACEHOLDER = 'ztp-b64-{}:{}'
+
     def __init__(self,
                  bootImage=None,
                  configHandle=CONFIG_MERGE,
@@ -265,23 +467,80 @@ class OnboardingInformation:
                  config=None):
         self.bootImage = bootImage
         self.configHandle = configHandle
-        self.preConfigScript = _Base64.encodeFile(preConfigScript)
-        self.config = _Base64.encodeFile(configFile)
-        self.postConfigScript = _Base64.encodeFile(postConfigScript)
+        self._preConfigScript = preConfigScript
+        self._configFile = configFile
+        self._postConfigScript = postConfigScript
         self._config = config
+        # Base64 encoding of the files, by name
+        self._encoded = dict()
+        self._lock = threading.Lock()
 
-    def serialize(self):
+    def _encodeFile(self, fileName):
+        """
+        Reads and base64 encodes fileName once, however many times the
+        onboarding information is serialized or written, e.g. to key the
+        signed cache and then to sign it
+        """
+        if not fileName:
+            return None
+        with self._lock:
+            if fileName not in self._encoded:
+                self._encoded[fileName] = _Base64.encodeFile(fileName)
+
+            return self._encoded[fileName]
+
+    @property
+    def preConfigScript(self):
+        return self._encodeFile(self._preConfigScript)
+
+    @property
+    def config(self):
+        return self._encodeFile(self._configFile)
+
+    @property
+    def postConfigScript(self):
+        return self._encodeFile(self._postConfigScript)
+
+    def _serialize(self, fileValue):
         oi = dict()
         if self.bootImage is not None:
             oi['boot-image'] = self.bootImage.serialize()
         oi.update({
             "configuration-handling": self.configHandle,
-            "pre-configuration-script": self.preConfigScript,
-            "configuration": self.config,
-            "post-configuration-script": self.postConfigScript,
+            "pre-configuration-script": fileValue(self._preConfigScript),
+            "configuration": fileValue(self._configFile),
+            "post-configuration-script": fileValue(self._postConfigScript),
         })
 
         return {"ietf-sztp-conveyed-info:onboarding-information": oi}
 
+    def serialize(self):
+        return self._serialize(self._encodeFile)
+
+    def write(self, fp):
+        """
+        Writes json.dumps(self.serialize()) to the binary file fp. The
+        encoded scripts and configuration are written as they are, rather
+        than copied into the JSON text.
+        """
+        files = list()
+        token = secrets.token_hex(16)
+
+        def placeholder(fileName):
+            if not fileName:
+                return None
+            files.append(fileName)
+            return self._FILE_PLACEHOLDER.format(token, len(files) - 1)
+
+        text = json.dumps(self._serialize(placeholder))
+        pattern = re.compile(re.escape(self._FILE_PLACEHOLDER.format(
+            token, '')) + r'(\d+)')
+        # Text and file indexes alternate, the text parts are plain ASCII
+        for i, part in enumerate(pattern.split(text)):
+            if i % 2:
+                fp.write(self._encodeFile(files[int(part)]).encode())
+            else:
+                fp.write(part.encode())
+
     def __str__(self):
         return json.dumps(self.serialize())
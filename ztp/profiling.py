@@ -0,0 +1,190 @@
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+class _Span:
+    """
+    A timed section of the code, size is the number of bytes it processed
+    """
+    __slots__ = ('name', 'start', 'end', 'size', 'pid', 'tid')
+
+    def __init__(self, name, size=None):
+        self.name = name
+        self.size = size
+        self.start = time.perf_counter_ns()
+        self.end = None
+        self.pid = os.getpid()
+        self.tid = threading.get_ident()
+
+    def addBytes(self, size):
+        self.size = (self.size or 0) + size
+
+
+class _NoSpan:
+    """
+    Stands for a span while profiling is disabled
+    """
+    __slots__ = ()
+
+    def addBytes(self, size):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Profile:
+    """
+    Lightweight instrumentation of the pipeline, enabled by --profile.
+
+    The code wraps its stages in Profile.span(), which records the wall
+    time and the bytes processed by the stage while profiling is enabled
+    and does nothing otherwise. Every subprocess started through
+    util.execShellCmd() is a span too, so the number of openssl runs is
+    the number of 'exec' spans.
+    """
+    enabled = False
+    _spans = list()
+    _lock = threading.Lock()
+    _start = None
+
+    @classmethod
+    def enable(cls):
+        cls.enabled = True
+        cls._start = time.perf_counter_ns()
+        cls._spans = list()
+
+    @classmethod
+    @contextmanager
+    def span(cls, name, size=None):
+        if not cls.enabled:
+            yield _NO_SPAN
+            return
+
+        span = _Span(name, size)
+        try:
+            yield span
+        finally:
+            span.end = time.perf_counter_ns()
+            with cls._lock:
+                cls._spans.append(span)
+
+    @classmethod
+    def timed(cls, name):
+        """
+        Decorator recording each call of the function as a span
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with cls.span(name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    @staticmethod
+    def peakRSS():
+        """
+        : return : peak resident set size in bytes of this process and of
+                   its largest terminated child (openssl)
+        """
+        # ru_maxrss is in KiB on Linux and in bytes on macOS
+        unit = 1 if sys.platform == 'darwin' else 1024
+        return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit)
+
+    @classmethod
+    def _stages(cls):
+        stages = dict()
+        for span in cls._spans:
+            stage = stages.setdefault(span.name, {
+                'calls': 0,
+                'seconds': 0.0,
+                'max_seconds': 0.0,
+                'bytes': None
+            })
+            seconds = (span.end - span.start) / 1e9
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+            stage['max_seconds'] = max(stage['max_seconds'], seconds)
+            if span.size is not None:
+                stage['bytes'] = (stage['bytes'] or 0) + span.size
+
+        return stages
+
+    @classmethod
+    def summary(cls):
+        stages = cls._stages()
+        rssSelf, rssChildren = cls.peakRSS()
+
+        return {
+            'wall_seconds': (time.perf_counter_ns() - cls._start) / 1e9,
+            'subprocesses': sum(s['calls'] for name, s in stages.items()
+                                if name.startswith('exec ')),
+            'peak_rss_bytes': rssSelf,
+            'peak_rss_children_bytes': rssChildren,
+            'stages': stages,
+        }
+
+    @classmethod
+    def table(cls):
+        """
+        : return : the summary as a text table, the slowest stages first
+        """
+        summary = cls.summary()
+        lines = [
+            '{:<28} {:>6} {:>10} {:>10} {:>12} {:>10}'.format(
+                'stage', 'calls', 'total s', 'max ms', 'bytes', 'MB/s')
+        ]
+        for name, stage in sorted(summary['stages'].items(),
+                                  key=lambda s: -s[1]['seconds']):
+            rate = ''
+            if stage['bytes'] and stage['seconds']:
+                rate = '{:.1f}'.format(stage['bytes'] / stage['seconds'] / 1e6)
+            lines.append('{:<28} {:>6} {:>10.3f} {:>10.1f} {:>12} {:>10}'.format(
+                name[:28], stage['calls'], stage['seconds'],
+                stage['max_seconds'] * 1e3,
+                '' if stage['bytes'] is None else stage['bytes'], rate))
+        lines.append('wall time {:.3f} s, {} subprocesses, peak RSS {:.1f} MiB '
+                     '(children {:.1f} MiB)'.format(
+                         summary['wall_seconds'], summary['subprocesses'],
+                         summary['peak_rss_bytes'] / 2**20,
+                         summary['peak_rss_children_bytes'] / 2**20))
+
+        return '\n'.join(lines)
+
+    @classmethod
+    def writeJSON(cls, fileName):
+        with open(fileName, 'w') as f:
+            json.dump(cls.summary(), f, indent=2)
+
+    @classmethod
+    def writeTrace(cls, fileName):
+        """
+        Writes the spans in the Chrome trace event format, for
+        chrome://tracing or https://ui.perfetto.dev
+        """
+        events = list()
+        for span in cls._spans:
+            event = {
+                'name': span.name,
+                'ph': 'X',
+                'ts': (span.start - cls._start) / 1e3,
+                'dur': (span.end - span.start) / 1e3,
+                'pid': span.pid,
+                'tid': span.tid,
+            }
+            if span.size is not None:
+                event['args'] = {'bytes': span.size}
+            events.append(event)
+
+        with open(fileName, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -0,0 +1,282 @@
+import asyncio
+import base64
+import json
+import os
+import resource
+
+from .const import Constants
+from .exceptions import *
+
+_MODULE = 'ietf-sztp-bootstrap-server'
+_GET_BOOTSTRAPPING_DATA = '/restconf/operations/{}:get-bootstrapping-data'.format(_MODULE)
+_REPORT_PROGRESS = '/restconf/operations/{}:report-progress'.format(_MODULE)
+_HOST_META = '/.well-known/host-meta'
+
+_YANG_JSON = 'application/yang-data+json'
+_HOST_META_XRD = (b"<XRD xmlns='http://docs.oasis-open.org/ns/xri/xrd-1.0'>"
+                  b"<Link rel='restconf' href='/restconf'/></XRD>")
+
+_STATUS = {
+    200: 'OK',
+    204: 'No Content',
+    400: 'Bad Request',
+    401: 'Unauthorized',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    501: 'Not Implemented',
+}
+
+
+class ArtifactIndex:
+    """
+    The get-bootstrapping-data responses of the devices of a USB kit, by
+    serial number.
+
+    Responses are encoded once, when the kit is loaded. A response body is
+    a list of chunks written as they are, and the chunks of the artifacts
+    the devices share (conveyed information, owner certificate) are the
+    same objects for all of them.
+    """
+    _ARTIFACTS = (('conveyed-information', Constants.CI_FILE),
+                  ('owner-certificate', Constants.OC_FILE),
+                  ('ownership-voucher', Constants.OV_FILE))
+
+    def __init__(self, outDir):
+        self.outDir = outDir
+        self.responses = dict()
+        self.load()
+
+    def load(self):
+        """
+        (Re)reads the kit, the previous responses are served until it is
+        read
+        : return : number of devices
+        """
+        enDir = os.path.join(self.outDir, Constants.EN_DIR)
+        try:
+            serials = sorted(os.listdir(enDir))
+        except OSError as e:
+            raise Error(errorCode=ErrorCode.FILE_NOT_FOUND,
+                        error='No {} directory in {}. {}'.format(
+                            Constants.EN_DIR, self.outDir, e)) from None
+
+        chunks = dict()
+        responses = dict()
+        for serialNum in serials:
+            bsdDir = os.path.join(enDir, serialNum, Constants.BSD_DIR)
+            fields = list()
+            for name, fileName in self._ARTIFACTS:
+                try:
+                    with open(os.path.join(bsdDir, fileName), 'rb') as f:
+                        data = f.read()
+                except OSError:
+                    continue
+                if data not in chunks:
+                    chunks[data] = '"{}": "{}"'.format(
+                        name, base64.b64encode(data).decode()).encode()
+                fields.append(chunks[data])
+            # The conveyed information is mandatory in the response
+            if not fields or not os.path.isfile(
+                    os.path.join(bsdDir, Constants.CI_FILE)):
+                continue
+
+            body = [b'{"%s:output": {' % _MODULE.encode()]
+            for i, field in enumerate(fields):
+                body.extend([b', ', field] if i else [field])
+            body.append(b'}}')
+            responses[serialNum] = body
+
+        self.responses = responses
+
+        return len(responses)
+
+
+class BootstrapServer:
+    """
+    Stand-in for an RFC 8572 bootstrap server, serving the bootstrapping
+    data of a USB kit over RESTCONF (HTTP/1.1, JSON encoding).
+
+    A device is identified by the username of its HTTP basic
+    authentication, its serial number per RFC 8572. Passwords are not
+    checked, this is meant for the lab. Progress reports are printed.
+    """
+    # Large enough for a report-progress with an ssh-host-keys list
+    _MAX_BODY = 1024 * 1024
+    _BACKLOG = 4096
+
+    def __init__(self, index, host=None, port=None, sslContext=None):
+        self.index = index
+        self.host = host
+        self.port = port
+        self.sslContext = sslContext
+        self.stats = {'connections': 0, 'requests': 0, 'served': 0,
+                      'unknown': 0, 'reports': 0, 'errors': 0}
+        self._server = None
+
+    async def start(self):
+        """
+        : return : the addresses the server listens on
+        """
+        self._server = await asyncio.start_server(self._serve, self.host,
+                                                  self.port,
+                                                  ssl=self.sslContext,
+                                                  backlog=self._BACKLOG)
+
+        return [s.getsockname() for s in self._server.sockets]
+
+    async def serveForever(self):
+        """
+        Serves until close() is called
+        """
+        async with self._server:
+            try:
+                await self._server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+
+    def close(self):
+        self._server.close()
+
+    async def _serve(self, reader, writer):
+        self.stats['connections'] += 1
+        try:
+            while True:
+                request = await self._readRequest(reader)
+                if request is None:
+                    break
+                self.stats['requests'] += 1
+                method, target, headers, body = request
+                status, contentType, chunks = self._handle(method, target,
+                                                           headers, body)
+                keepAlive = headers.get('connection', '').lower() != 'close'
+                self._write(writer, status, contentType, chunks, keepAlive)
+                await writer.drain()
+                if not keepAlive:
+                    break
+        except _BadRequest as e:
+            self.stats['errors'] += 1
+            self._write(writer, e.status, None, [], False)
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+    async def _readRequest(self, reader):
+        """
+        : return : (method, target, {header: value}, body), None when the
+                   client closed the connection
+        """
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.IncompleteReadError as e:
+            if not e.partial.strip():
+                return None
+            raise
+
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, _ = lines[0].split(' ', 2)
+            headers = dict()
+            for line in lines[1:]:
+                if line:
+                    name, value = line.split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise _BadRequest(400) from None
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            raise _BadRequest(501)
+        if length > self._MAX_BODY:
+            raise _BadRequest(413)
+
+        body = await reader.readexactly(length) if length else b''
+
+        return method, target.split('?', 1)[0], headers, body
+
+    def _handle(self, method, target, headers, body):
+        """
+        : return : (status, content type, body chunks)
+        """
+        if target == _HOST_META:
+            if method != 'GET':
+                return 405, None, []
+            return 200, 'application/xrd+xml', [_HOST_META_XRD]
+        if target not in (_GET_BOOTSTRAPPING_DATA, _REPORT_PROGRESS):
+            return 404, None, []
+        if method != 'POST':
+            return 405, None, []
+
+        serialNum = self._serialNum(headers)
+        if serialNum is None:
+            return 401, None, []
+        if target == _REPORT_PROGRESS:
+            self._report(serialNum, body)
+            return 204, None, []
+
+        response = self.index.responses.get(serialNum)
+        if response is None:
+            self.stats['unknown'] += 1
+            return 404, None, []
+        self.stats['served'] += 1
+
+        return 200, _YANG_JSON, response
+
+    @staticmethod
+    def _serialNum(headers):
+        scheme, _, credentials = headers.get('authorization', '').partition(' ')
+        if scheme.lower() != 'basic':
+            return None
+        try:
+            username = base64.b64decode(credentials).decode().split(':', 1)[0]
+        except (ValueError, UnicodeDecodeError):
+            return None
+
+        return username or None
+
+    def _report(self, serialNum, body):
+        self.stats['reports'] += 1
+        try:
+            report = json.loads(body)['{}:input'.format(_MODULE)]
+            progress = report['progress-type']
+            message = report.get('message')
+        except (ValueError, KeyError, TypeError):
+            progress = 'unparsed report'
+            message = body.decode('utf-8', 'replace')
+
+        print('{}: {}{}'.format(serialNum, progress,
+                                '. {}'.format(message) if message else ''),
+              flush=True)
+
+    @staticmethod
+    def _write(writer, status, contentType, chunks, keepAlive):
+        head = ['HTTP/1.1 {} {}'.format(status, _STATUS[status]),
+                'Content-Length: {}'.format(sum(len(c) for c in chunks))]
+        if contentType:
+            head.append('Content-Type: {}'.format(contentType))
+        if status == 401:
+            head.append('WWW-Authenticate: Basic realm="sztp"')
+        if not keepAlive:
+            head.append('Connection: close')
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode())
+        writer.writelines(chunks)
+
+
+class _BadRequest(Exception):
+    def __init__(self, status):
+        self.status = status
+        super().__init__(_STATUS[status])
+
+
+def raiseFileLimit():
+    """
+    Raises the limit of open files to its maximum, each connected device
+    takes one
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
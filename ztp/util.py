@@ -1,32 +1,145 @@
 import base64
 import hashlib
+import itertools
+import mmap
 import os
 import subprocess
-from contextlib import suppress
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext, suppress
 
 from .exceptions import *
+from .profiling import Profile
 
 
-def genHash(fileName, hashAlg=None):
-    BUF_SIZE = 65536  # lets read stuff in 64kb chunks!
+# Size of the reads when hashing or copying images. Reads much larger than
+# the CPU caches make hashlib read the data back from memory
+HASH_BUF_SIZE = 1024 * 1024
 
+
+def openSequential(fileName):
+    """
+    Opens fileName for reading, hinting the kernel that it will be read
+    sequentially so it reads ahead more aggressively
+    """
+    f = open(fileName, 'rb')
+    if hasattr(os, 'posix_fadvise'):
+        with suppress(OSError):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    return f
+
+
+def genHash(fileName, hashAlg=None, bufSize=None):
+    """
+    : param hashAlg : hashlib constructor, sha256 by default
+    : param bufSize : size of the chunks hashed at once, HASH_BUF_SIZE by
+                      default
+    """
     if hashAlg is not None:
         sha = hashAlg()
     else:
         sha = hashlib.sha256()
+    bufSize = bufSize or HASH_BUF_SIZE
 
-    with open(fileName, 'rb') as f:
-        while True:
-            data = f.read(BUF_SIZE)
-            if not data:
-                break
-
-            sha.update(data)
-    hashValue = sha.hexdigest()
+    with Profile.span('genHash') as span, openSequential(fileName) as f:
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Empty files and files which cannot be mapped
+            m = None
+
+        if m is not None:
+            # Hash the page cache in place, without copying it to a buffer
+            with m:
+                span.addBytes(len(m))
+                if hasattr(m, 'madvise'):
+                    m.madvise(mmap.MADV_SEQUENTIAL)
+                for offset in range(0, len(m), bufSize):
+                    with memoryview(m)[offset:offset + bufSize] as chunk:
+                        sha.update(chunk)
+        else:
+            # Read into the same buffer over and over instead of allocating
+            # a new bytes object per chunk
+            buf = bytearray(bufSize)
+            view = memoryview(buf)
+            while True:
+                size = f.readinto(buf)
+                if not size:
+                    break
+
+                sha.update(view[:size])
+                span.addBytes(size)
+    return toHexString(sha.hexdigest())
+
+
+def toHexString(hashValue):
     # Convert hash value to RFC 8572 (Section 6.3) compliant format
     # References: hex-string - RFC 6991 (Section 3)
-    hashValue = ':'.join([ hashValue[i:i+2] for i in range(0, len(hashValue), 2)])
-    return hashValue
+    return ':'.join([hashValue[i:i + 2] for i in range(0, len(hashValue), 2)])
+
+
+def genHashes(fileName, hashAlgs, bufSize=None):
+    """
+    Computes several digests of fileName in a single read pass
+
+    : param hashAlgs : hashlib constructors, one digest is computed per entry
+    : return : hash values in RFC 8572 format, in the order of hashAlgs
+    """
+    if len(hashAlgs) == 1:
+        return [genHash(fileName, hashAlgs[0], bufSize=bufSize)]
+
+    return copyAndHash(fileName, None, hashAlgs, bufSize=bufSize)
+
+
+def copyAndHash(src, dst, hashAlgs, bufSize=None):
+    """
+    Copies src to dst and hashes the data in the same pass, so the source is
+    read only once. With several hash algorithms each digest is updated on
+    its own thread (hashlib releases the GIL), while the next chunk is read.
+
+    : param dst : destination path, None to only hash src
+    : param hashAlgs : hashlib constructors, one digest is computed per entry
+    : return : hash values in RFC 8572 format, in the order of hashAlgs
+    """
+    hashes = [hashAlg() for hashAlg in hashAlgs]
+
+    if dst and os.path.exists(dst) and os.path.samefile(src, dst):
+        # Nothing to copy, opening dst for writing would truncate src
+        dst = None
+
+    # With several digests, two buffers: one is hashed while the next chunk
+    # is read into the other. A single digest is updated in line, so one
+    # buffer is enough.
+    pipelined = len(hashes) > 1
+    bufSize = bufSize or HASH_BUF_SIZE
+    bufs = [bytearray(bufSize) for _ in range(2 if pipelined else 1)]
+    pending = list()
+    with Profile.span('copyAndHash' if dst else 'genHashes') as span, \
+            openSequential(src) as fin, \
+            open(dst, 'wb') if dst else nullcontext() as fout, \
+            ThreadPoolExecutor(len(hashes)) if pipelined \
+            else nullcontext() as executor:
+        for i in itertools.count():
+            buf = bufs[i % len(bufs)]
+            size = fin.readinto(buf)
+            for future in pending:
+                future.result()
+            if not size:
+                break
+
+            chunk = memoryview(buf)[:size]
+            if executor:
+                pending = [executor.submit(sha.update, chunk) for sha in hashes]
+            else:
+                for sha in hashes:
+                    sha.update(chunk)
+            if fout:
+                fout.write(chunk)
+            span.addBytes(size)
+
+    return [toHexString(sha.hexdigest()) for sha in hashes]
 
 
 def writeToFile(data, f):
@@ -54,20 +167,26 @@ def execShellCmd(cmd,
                  stdout=subprocess.PIPE,
                  stderr=subprocess.PIPE):
     error = None
+    # Spans are named after the program and its subcommand, e.g.
+    # 'exec openssl cms'
+    name = ' '.join((cmd.split() if isinstance(cmd, str) else cmd)[:2])
     try:
-        p = subprocess.run(cmd,
-                           shell=shell,
-                           env=env,
-                           executable=executable,
-                           stdout=stdout,
-                           stderr=stderr,
-                           timeout=timeout,
-                           input=inp,
-                           check=False)
-    except subprocess.TimeoutExpired as e:
-        return Exception(e)
-    except subprocess.SubprocessError as e:
-        return Exception(e)
+        with Profile.span('exec ' + name, len(inp) if inp else None):
+            p = subprocess.run(cmd,
+                               shell=shell,
+                               env=env,
+                               executable=executable,
+                               stdout=stdout,
+                               stderr=stderr,
+                               timeout=timeout,
+                               input=inp,
+                               check=False)
+    except subprocess.TimeoutExpired:
+        return Exception('Timed out after {}s executing command {}'.format(
+            timeout, str(cmd))), ''
+    except (subprocess.SubprocessError, OSError) as e:
+        return Exception('{} occured while executing command {}'.format(
+            e, str(cmd))), ''
 
     o = p.stdout
     e = p.stderr
@@ -82,6 +201,22 @@ def execShellCmd(cmd,
     return error, o
 
 
+def execShellCmds(cmds, timeout=None, jobs=None):
+    """
+    Runs independent commands concurrently, at most jobs at a time (all of
+    them by default). Each command has its own timeout and result, a
+    failing command does not stop the others.
+    : return : [(error, output)] in the order of cmds
+    """
+    if len(cmds) < 2:
+        return [execShellCmd(cmd, timeout=timeout) for cmd in cmds]
+
+    with ThreadPoolExecutor(max_workers=jobs or len(cmds)) as executor:
+        return list(
+            executor.map(lambda cmd: execShellCmd(cmd, timeout=timeout),
+                         cmds))
+
+
 def removeFiles(directory=None, files=None):
     if directory and os.path.exists(directory):
         _files = (os.path.join(directory, fileName)
@@ -99,8 +234,8 @@ def removeFiles(directory=None, files=None):
 
 
 def createDir(dirname):
-    if not os.path.isdir(dirname):
-        os.makedirs(dirname)
+    # Threads extracting members of the same directory may race to create it
+    os.makedirs(dirname, exist_ok=True)
 
 
 def fileExists(path):
@@ -140,3 +275,38 @@ class AttrDict(dict):
 
     def __dir__(self):
         return list(self) + dir(dict) + self.keys()
+
+
+class LRUCache:
+    """
+    Thread safe in-memory cache of the maxEntries most recently used
+    values, for the caches of long-lived processes like the build daemon
+    """
+    def __init__(self, maxEntries):
+        self.maxEntries = maxEntries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        : return : the value of key, None when it is not cached
+        """
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxEntries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,371 @@
+import base64
+import binascii
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from . import util
+from .const import Constants
+from .crypto import CMS, PKCS7, CMSType
+from .exceptions import *
+from .model import BOOT_IMAGE, DOWNLOAD_URI, IMG_VERIFICATION, Image
+from .profiling import Profile
+
+_ONBOARDING_INFO = 'ietf-sztp-conveyed-info:onboarding-information'
+_ENCODED_FILES = ('pre-configuration-script', 'configuration',
+                  'post-configuration-script')
+
+
+class KitVerifier:
+    """
+    Checks the bootstrapping data of a USB kit written by usb.py.
+
+    For every EN9/<serial>/bootstrapping-data directory, the conveyed
+    information and actions signatures are verified against the owner
+    certificate artifact, the onboarding information is decoded and every
+    image it references is hashed and compared to its image-verification.
+
+    Devices of a kit normally share their artifacts, so every distinct
+    signed artifact is verified once and every distinct image is hashed
+    once, whatever the number of serials referencing them. Conveyed
+    information encrypted for the device cannot be checked without the
+    device key, the devices with one are listed in self.encrypted and
+    their owner certificate and actions are still verified.
+    """
+
+    def __init__(self, outDir, ownerCert=None, trustAnchor=None, jobs=None):
+        """
+        : param ownerCert : PEM owner certificate the owner certificate
+                            artifacts must start with
+        : param trustAnchor : PEM certificates the owner certificate must
+                              chain up to. Without it only the signatures
+                              are verified.
+        : param jobs : number of signatures verified, and images hashed, at
+                       the same time. The number of CPUs by default.
+        """
+        self.outDir = outDir
+        self.ownerCert = ownerCert
+        self.trustAnchor = trustAnchor
+        self.jobs = jobs or os.cpu_count() or 1
+        self.stats = {'signatures': 0, 'images': 0, 'bytes': 0,
+                      'encrypted': 0}
+        self.encrypted = set()
+
+    def devices(self):
+        """
+        : return : serial numbers of the devices in the kit
+        """
+        enDir = os.path.join(self.outDir, Constants.EN_DIR)
+        try:
+            entries = sorted(os.listdir(enDir))
+        except OSError as e:
+            raise Error(errorCode=ErrorCode.FILE_NOT_FOUND,
+                        error='No {} directory in {}. {}'.format(
+                            Constants.EN_DIR, self.outDir, e)) from None
+
+        return [s for s in entries
+                if os.path.isdir(os.path.join(enDir, s, Constants.BSD_DIR))]
+
+    def _bsdPath(self, serialNum, fileName):
+        return os.path.join(self.outDir, Constants.EN_DIR, serialNum,
+                            Constants.BSD_DIR, fileName)
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def verify(self):
+        """
+        : return : [(serial number, [problems])] in the order of the serial
+                   numbers, no problems means the bootstrapping data of the
+                   device is fine
+        """
+        serials = self.devices()
+        problems = {s: list() for s in serials}
+        kit = dict()
+        for serialNum in serials:
+            kit[serialNum] = util.AttrDict(
+                ci=self._read(self._bsdPath(serialNum, Constants.CI_FILE)),
+                oc=self._read(self._bsdPath(serialNum, Constants.OC_FILE)),
+                actions=self._read(
+                    self._bsdPath(serialNum, Constants.ACTIONS_FILE)))
+            if kit[serialNum].ci is None:
+                problems[serialNum].append('{} is missing'.format(
+                    Constants.CI_FILE))
+            elif _isEncrypted(kit[serialNum].ci):
+                kit[serialNum].ci = None
+                self.encrypted.add(serialNum)
+                self.stats['encrypted'] += 1
+            if not os.path.isfile(self._bsdPath(serialNum, Constants.OV_FILE)):
+                problems[serialNum].append('{} is missing'.format(
+                    Constants.OV_FILE))
+
+        with tempfile.TemporaryDirectory(prefix='sztp-verify-') as tmpDir:
+            signers = self._signers(kit, problems, tmpDir)
+            contents = self._verifySignatures(kit, signers, problems)
+        images = self._images(kit, contents, problems)
+        self._verifyImages(images, problems)
+
+        return [(s, problems[s]) for s in serials]
+
+    def _signers(self, kit, problems, tmpDir):
+        """
+        Extracts the certificates of each distinct owner certificate
+        artifact to a file of tmpDir
+        : return : {owner certificate artifact: certificate file}
+        """
+        pinned = None
+        if self.ownerCert:
+            with open(self.ownerCert, 'r') as f:
+                pinned = _pemBodies(f.read())[:1]
+            if not pinned:
+                raise Error(errorCode=ErrorCode.INVALID_CERTIFICATE,
+                            error='No certificate in {}'.format(
+                                self.ownerCert))
+
+        signers = dict()
+        for serialNum, bsd in kit.items():
+            if bsd.oc is None:
+                problems[serialNum].append('{} is missing'.format(
+                    Constants.OC_FILE))
+                continue
+            if bsd.oc in signers:
+                continue
+
+            try:
+                certs = PKCS7.extractX509Certs(bsd.oc)
+            except Error as e:
+                signers[bsd.oc] = e
+                continue
+            if pinned and _pemBodies(certs)[:1] != pinned:
+                signers[bsd.oc] = Error(
+                    errorCode=ErrorCode.INVALID_CERTIFICATE,
+                    error='The owner certificate is not {}'.format(
+                        self.ownerCert))
+                continue
+
+            certFile = os.path.join(tmpDir, 'oc{}.pem'.format(len(signers)))
+            with open(certFile, 'w') as f:
+                f.write(certs)
+            signers[bsd.oc] = certFile
+
+        for serialNum, bsd in kit.items():
+            if isinstance(signers.get(bsd.oc), Error):
+                problems[serialNum].append('{}: {}'.format(
+                    Constants.OC_FILE, signers[bsd.oc]))
+
+        return {oc: s for oc, s in signers.items() if not isinstance(s, Error)}
+
+    def _verifySignatures(self, kit, signers, problems):
+        """
+        Verifies each distinct signed artifact once, on self.jobs threads
+        : return : {(signed artifact, owner certificate artifact): signed
+                   content}
+        """
+        pending = {(data, bsd.oc)
+                   for bsd in kit.values() if bsd.oc in signers
+                   for data in (bsd.ci, bsd.actions) if data is not None}
+
+        def verify(key):
+            data, oc = key
+            certs = util.AttrDict(ownerCert=signers[oc])
+            try:
+                with Profile.span('verifySignature', len(data)):
+                    return CMS(data, certs).verify(
+                        cafile=self.trustAnchor,
+                        inform=CMS.DER_ENCODING).data
+            except Error as e:
+                return e
+
+        pending = list(pending)
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            contents = dict(zip(pending, executor.map(verify, pending)))
+        self.stats['signatures'] += len(pending)
+
+        for serialNum, bsd in kit.items():
+            for fileName, data in ((Constants.CI_FILE, bsd.ci),
+                                   (Constants.ACTIONS_FILE, bsd.actions)):
+                content = contents.get((data, bsd.oc))
+                if isinstance(content, Error):
+                    problems[serialNum].append('{}: {}'.format(
+                        fileName, content))
+
+        return {k: c for k, c in contents.items() if not isinstance(c, Error)}
+
+    def _images(self, kit, contents, problems):
+        """
+        Decodes the onboarding information of the devices
+        : return : {image path: {hash algorithm: {hash value: [(serial
+                   number, download-uri)]}}}
+        """
+        decoded = dict()
+        images = dict()
+        for serialNum, bsd in kit.items():
+            actions = contents.get((bsd.actions, bsd.oc))
+            if actions is not None:
+                try:
+                    json.loads(actions)
+                except ValueError as e:
+                    problems[serialNum].append('{}: {}'.format(
+                        Constants.ACTIONS_FILE, e))
+
+            content = contents.get((bsd.ci, bsd.oc))
+            if content is None:
+                continue
+            if content not in decoded:
+                decoded[content] = _decodeOnboardingInfo(content)
+            references, errors = decoded[content]
+            problems[serialNum].extend(
+                '{}: {}'.format(Constants.CI_FILE, e) for e in errors)
+
+            for uri, alg, hashValue in references:
+                path = self._imagePath(uri)
+                if path is None:
+                    problems[serialNum].append(
+                        '{} is not on the USB drive'.format(uri))
+                    continue
+                images.setdefault(path, dict()).setdefault(
+                    alg, dict()).setdefault(hashValue, list()).append(
+                        (serialNum, uri))
+
+        return images
+
+    def _imagePath(self, uri):
+        """
+        : return : path in the kit of the image at uri on the device, None
+                   when it is not on the USB drive
+        """
+        url = urlparse(uri)
+        if url.scheme != 'file':
+            return None
+        for root in Constants.ROOT_DIRS:
+            if url.path.startswith(root + '/'):
+                return os.path.realpath(
+                    os.path.join(self.outDir, url.path[len(root) + 1:]))
+
+        return None
+
+    def _verifyImages(self, images, problems):
+        """
+        Hashes each distinct image once, with all the algorithms it is
+        verified with, on self.jobs threads
+        """
+        def digests(path):
+            algs = list(images[path])
+            methods = [Image.hashMethod(alg) for alg in algs]
+            if None in methods:
+                unsupported = algs[methods.index(None)]
+                return Error(errorCode=ErrorCode.INVALID_DATA,
+                             error='Unsupported hash algorithm {}'.format(
+                                 unsupported))
+            try:
+                return dict(zip(algs, util.genHashes(path, methods)))
+            except OSError as e:
+                return Error(errorCode=ErrorCode.FILE_NOT_FOUND, error=e)
+
+        paths = sorted(images)
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            results = dict(zip(paths, executor.map(digests, paths)))
+
+        for path, result in results.items():
+            if not isinstance(result, Error):
+                self.stats['images'] += 1
+                self.stats['bytes'] += os.path.getsize(path)
+            for alg, values in images[path].items():
+                for hashValue, references in values.items():
+                    if isinstance(result, Error):
+                        error = str(result)
+                    elif _hexDigest(result[alg]) != _hexDigest(hashValue):
+                        error = '{} digest mismatch'.format(alg)
+                    else:
+                        continue
+                    for serialNum, uri in references:
+                        message = '{}: {}'.format(uri, error)
+                        if message not in problems[serialNum]:
+                            problems[serialNum].append(message)
+
+
+def _pemBodies(pem):
+    """
+    : return : the base64 bodies of the PEM certificates in pem, without
+               whitespace, so certificates can be compared
+    """
+    bodies = list()
+    body = None
+    for line in pem.splitlines():
+        line = line.strip()
+        if line == '-----BEGIN CERTIFICATE-----':
+            body = list()
+        elif line == '-----END CERTIFICATE-----' and body is not None:
+            bodies.append(''.join(body))
+            body = None
+        elif body is not None:
+            body.append(line)
+
+    return bodies
+
+
+def _isEncrypted(data):
+    try:
+        return CMS(data, None).getContentType() == CMSType.ENCRYPTED
+    except Error:
+        # Reported when its signature is verified
+        return False
+
+
+def _hexDigest(hashValue):
+    return hashValue.replace(':', '').lower()
+
+
+def _decodeOnboardingInfo(content):
+    """
+    : return : ([(download-uri, hash algorithm, hash value)], [problems])
+    """
+    try:
+        oi = json.loads(content)[_ONBOARDING_INFO]
+    except (ValueError, KeyError, TypeError) as e:
+        return [], ['Invalid onboarding information. {}'.format(e)]
+
+    errors = list()
+    for name in _ENCODED_FILES:
+        if oi.get(name) is None:
+            continue
+        try:
+            base64.b64decode(oi[name], validate=True)
+        except (binascii.Error, TypeError) as e:
+            errors.append('Invalid {}. {}'.format(name, e))
+
+    bootImage = oi.get(BOOT_IMAGE)
+    if not bootImage:
+        return [], errors
+
+    uris = bootImage.get(DOWNLOAD_URI) or list()
+    verification = [(Image.normalizeHashAlg(v.get('hash-algorithm')),
+                     v.get('hash-value', ''))
+                    for v in bootImage.get(IMG_VERIFICATION) or list()]
+    if uris and not verification:
+        errors.append('No {} of the boot image'.format(IMG_VERIFICATION))
+
+    # usb.py lists the entries of each image in turn, one per algorithm,
+    # and the download-uri entries of each image in turn. Otherwise all the
+    # entries are taken to be digests of every download-uri.
+    images = list()
+    for alg, hashValue in verification:
+        if not images or alg in (a for a, _ in images[-1]):
+            images.append(list())
+        images[-1].append((alg, hashValue))
+    if images and len(uris) % len(images) == 0:
+        step = len(uris) // len(images)
+        perURI = [images[i // step] for i in range(len(uris))]
+    else:
+        perURI = [verification] * len(uris)
+
+    return [(uri, alg, hashValue)
+            for uri, entries in zip(uris, perURI)
+            for alg, hashValue in entries], errors
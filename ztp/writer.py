@@ -0,0 +1,147 @@
+import os
+import queue
+import threading
+import time
+
+from .profiling import Profile
+
+
+class ArtifactWriter:
+    """
+    Writes files on background threads, so the caller keeps preparing the
+    next artifacts while the previous ones are written to slow media.
+
+    Directories are created in one pass by makedirs() before the writes are
+    queued. With sync, each file is flushed to the media by the thread
+    that wrote it, and close() flushes the directories holding the new
+    entries, so only the files of the writer are synced rather than every
+    filesystem of the host. Errors are reported per tag (e.g. the serial
+    number the file belongs to) and do not stop the other writes.
+    """
+    _QUEUE_SIZE = 256
+
+    def __init__(self, threads=1, sync=True):
+        self.sync = sync
+        self._queue = queue.Queue(maxsize=self._QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self.errors = dict()
+        self.files = 0
+        self.bytes = 0
+        # Directories with new entries, flushed by close()
+        self._dirs = set()
+        self._syncSeconds = 0
+        self._start = time.perf_counter()
+        self._threads = [
+            threading.Thread(target=self._run, daemon=True)
+            for _ in range(max(threads, 1))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def makedirs(self, dirs):
+        """
+        Creates the directories, each one once
+        : param dirs : {directory: tag}
+        """
+        created = set()
+        for directory, tag in sorted(dirs.items()):
+            if directory in created:
+                continue
+            # The new directories and the parent of the topmost one get
+            # new entries
+            new = [directory]
+            while new[-1] and not os.path.isdir(new[-1]):
+                new.append(os.path.dirname(new[-1]))
+            with self._lock:
+                self._dirs.update(d or os.curdir for d in new)
+            try:
+                os.makedirs(directory, exist_ok=True)
+            except OSError as e:
+                self.fail(tag, e)
+                continue
+            created.add(directory)
+
+    def write(self, path, data, tag=None):
+        """
+        Queues data to be written to path. Blocks while the queue is full.
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        self._queue.put((path, data, tag))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            path, data, tag = item
+            if tag in self.errors:
+                continue
+            syncSeconds = 0
+            try:
+                with Profile.span('write', len(data)):
+                    with open(path, 'wb') as f:
+                        f.write(data)
+                        if self.sync:
+                            f.flush()
+                            syncStart = time.perf_counter()
+                            os.fsync(f.fileno())
+                            syncSeconds = time.perf_counter() - syncStart
+            except OSError as e:
+                self.fail(tag, e)
+                continue
+
+            with self._lock:
+                self.files += 1
+                self.bytes += len(data)
+                self._syncSeconds += syncSeconds
+                self._dirs.add(os.path.dirname(path) or os.curdir)
+
+    def fail(self, tag, error):
+        """
+        Records the error of tag, only its first one is kept. The writes
+        of tag still queued are skipped.
+        """
+        with self._lock:
+            self.errors.setdefault(tag, str(error))
+
+    def close(self):
+        """
+        Waits for the queued writes and flushes the directories they
+        added entries to
+        : return : statistics of the writes, syncSeconds is the time spent
+                   flushing files and directories, summed over the threads
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+        syncStart = time.perf_counter()
+        if self.sync and self.files:
+            with Profile.span('sync'):
+                for directory in sorted(self._dirs):
+                    self._syncDir(directory)
+        end = time.perf_counter()
+
+        return {
+            'files': self.files,
+            'bytes': self.bytes,
+            'seconds': end - self._start,
+            'syncSeconds': self._syncSeconds + end - syncStart,
+        }
+
+    @staticmethod
+    def _syncDir(directory):
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            # Some filesystems do not support syncing a directory
+            pass
+        finally:
+            os.close(fd)